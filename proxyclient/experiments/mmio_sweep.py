@@ -199,7 +199,7 @@ else:
 	# no --domain flag, do a plain sweep
 	hitmask = do_sweep(maskrange)
 
-al = u.adt.build_addr_lookup()
+al = u.adt.build_addr_lookup().clone()
 for start, stop in describe_mask(hitmask, maskrange):
 	# bit ugly but it makes addrlookup do all the heavy lifting for us
 	al.add(range(start, stop), "hit")
@@ -1,5 +1,5 @@
 # SPDX-License-Identifier: MIT
-import itertools, fnmatch, sys
+import itertools, fnmatch, struct, sys
 from construct import *
 import sys
 
@@ -516,6 +516,20 @@ def build_prop(path, name, v, t=None):
 
     return t.build(v)
 
+class ADTChanges:
+    '''Changes made below a node since the last take(), see
+    ADTNode.track_changes().'''
+    def __init__(self):
+        self.props = set()
+        self.children = set()
+
+    def take(self):
+        '''Return and clear the (node, property name) pairs that were set or
+        deleted and the nodes whose children were added, removed or replaced.'''
+        ret = self.props, self.children
+        self.props, self.children = set(), set()
+        return ret
+
 class ADTNode:
     def __init__(self, val=None, path="/", parent=None):
         self._children = []
@@ -523,6 +537,17 @@ class ADTNode:
         self._types = {}
         self._parent_path = path
         self._parent = parent
+        self._child_index = None
+        self._path_index = {}
+        self._addr_lookup = None
+        self._addr_entries = None
+        self._addr_dirty = set()
+        self._addr_order = {}
+        self._addr_layout_dirty = False
+        self._offsets = {}
+        self._dirty = set()
+        self._struct_dirty = False
+        self._trackers = []
 
         if val is not None:
             for p in val.properties:
@@ -562,17 +587,96 @@ class ADTNode:
     def _path(self):
         return self._parent_path + self.name
 
+    def _child(self, name):
+        if self._child_index is None:
+            index = {}
+            for c in self._children:
+                index.setdefault(c.name, c)
+            self._child_index = index
+        try:
+            return self._child_index[name]
+        except KeyError:
+            raise KeyError(f"Child node '{name}' not found") from None
+
+    def _lookup(self, path):
+        node = self
+        *parents, name = path.lstrip("/").split("/")
+        for p in parents:
+            if p:
+                node = node._child(p)
+        return node._child(name)
+
+    def _invalidate(self, node=None, layout=False):
+        # Called on the node whose children changed (layout) or whose reg
+        # changed (node). Path and address caches are only held by this
+        # node and its ancestors.
+        n = self
+        while n is not None:
+            n._path_index.clear()
+            if n._addr_lookup is not None:
+                n._addr_layout_dirty |= layout
+                if node is not None:
+                    n._addr_dirty.add(node)
+            n = n._parent
+
+    def _invalidate_translation(self):
+        # ranges/#*-cells affect the translated reg of every node below us
+        n = self
+        while n is not None:
+            n._path_index.clear()
+            n._addr_lookup = None
+            n = n._parent
+
+        stack = list(self._children)
+        while stack:
+            n = stack.pop()
+            n._addr_lookup = None
+            stack.extend(n._children)
+
+    def _notify(self, name=None):
+        n = self
+        while n is not None:
+            for changes in n._trackers:
+                if name is None:
+                    changes.children.add(self)
+                else:
+                    changes.props.add((self, name))
+            n = n._parent
+
+    def track_changes(self):
+        '''Return an ADTChanges that collects changes to this node and the
+        nodes below it from now on.'''
+        changes = ADTChanges()
+        self._trackers.append(changes)
+        return changes
+
+    def untrack_changes(self, changes):
+        self._trackers.remove(changes)
+
+    def _children_changed(self):
+        self._child_index = None
+        self._struct_dirty = True
+        self._invalidate(layout=True)
+        self._notify()
+
+    def _prop_changed(self, name):
+        self._dirty.add(name)
+        self._notify(name)
+        if name == "name":
+            if self._parent is not None:
+                self._parent._child_index = None
+            self._invalidate(node=self, layout=True)
+        elif name == "reg":
+            self._invalidate(node=self)
+        elif name in ("ranges", "#address-cells", "#size-cells"):
+            self._invalidate_translation()
+
     def __getitem__(self, item):
         if isinstance(item, str):
-            while item.startswith("/"):
-                item = item[1:]
-            if "/" in item:
-                a, b = item.split("/", 1)
-                return self[a][b]
-            for i in self._children:
-                if i.name == item:
-                    return i
-            raise KeyError(f"Child node '{item}' not found")
+            node = self._path_index.get(item, None)
+            if node is None:
+                node = self._path_index[item] = self._lookup(item)
+            return node
         return self._children[item]
 
     def __setitem__(self, item, value):
@@ -591,6 +695,7 @@ class ADTNode:
                 self._children.append(value)
         else:
             self._children[item] = value
+        self._children_changed()
 
     def __delitem__(self, item):
         if isinstance(item, str):
@@ -603,10 +708,12 @@ class ADTNode:
             for i, c in enumerate(self._children):
                 if c.name == item:
                     del self._children[i]
+                    self._children_changed()
                     return
             raise KeyError(f"Child node '{item}' not found")
 
         del self._children[item]
+        self._children_changed()
 
     def __contains__(self, item):
         if isinstance(item, str):
@@ -615,10 +722,11 @@ class ADTNode:
             if "/" in item:
                 a, b = item.split("/", 1)
                 return b in self[a]
-            for c in self._children:
-                if c.name == item:
-                    return True
-            return False
+            try:
+                self._child(item)
+            except KeyError:
+                return False
+            return True
 
         return item in self._children
 
@@ -636,6 +744,7 @@ class ADTNode:
         attr = attr.replace("_", "-")
         attr = attr.replace("--", "_")
         self._properties[attr] = value
+        self._prop_changed(attr)
 
     def __delattr__(self, attr):
         if attr[0] == "_":
@@ -644,6 +753,7 @@ class ADTNode:
         attr = attr.replace("_", "-")
         attr = attr.replace("--", "_")
         del self._properties[attr]
+        self._prop_changed(attr)
 
     def getprop(self, name, default=None):
         return self._properties.get(name, default)
@@ -785,26 +895,139 @@ class ADTNode:
     def build(self):
         return ADTNodeStruct.build(self.tostruct())
 
+    def touch(self, name):
+        '''Mark a property as modified after changing its value in place'''
+        self._dirty.add(name)
+        self._notify(name)
+
+    def _all_nodes(self):
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node._children))
+
+    def _sync(self, data=None, offset=0):
+        '''Clear modification tracking. If data (the blob built from this
+        tree, starting at offset) is given, also record property offsets.'''
+        self._dirty = set()
+        self._struct_dirty = False
+
+        if data is None:
+            for child in self._children:
+                child._sync()
+            return offset
+
+        self._offsets = {}
+        prop_count, child_count = struct.unpack_from("<II", data, offset)
+        offset += 8
+        for i in range(prop_count):
+            name = data[offset:offset + 32].split(b"\0", 1)[0].decode("ascii")
+            size = struct.unpack_from("<I", data, offset + 32)[0] & 0x7fffffff
+            self._offsets[name] = (offset + 36, size)
+            offset += 36 + ((size + 3) & ~3)
+
+        assert child_count == len(self._children)
+        for child in self._children:
+            offset = child._sync(data, offset)
+        return offset
+
+    def build_patches(self):
+        '''Return (offset, data) pairs for the properties modified since the
+        tree was loaded or last synced, or None if the blob layout changed
+        (nodes or properties were added or removed, or a value changed size)
+        and a full build() is required.'''
+        patches = []
+        for node in self._all_nodes():
+            if node._struct_dirty:
+                return None
+            for name in node._dirty:
+                if name not in node._properties or name not in node._offsets:
+                    return None
+                offset, size = node._offsets[name]
+                t, is_template = node._types.get(name, (None, False))
+                value = build_prop(node._path, name, node._properties[name], t=t)
+                if len(value) != size:
+                    return None
+                patches.append((offset, value))
+
+        return sorted(patches)
+
     def walk_tree(self):
         yield self
         for child in self:
             yield from child
 
-    def build_addr_lookup(self):
-        lookup = AddrLookup()
-        for node in self.walk_tree():
-            reg = getattr(node, 'reg', None)
-            if not isinstance(reg, list):
+    def _reg_entries(self):
+        reg = getattr(self, 'reg', None)
+        if not isinstance(reg, list):
+            return []
+
+        entries = []
+        for index in range(len(reg)):
+            try:
+                addr, size = self.get_reg(index)
+            except AttributeError:
+                continue
+            if size == 0:
                 continue
+            entries.append((range(addr, addr + size), self.name + f"[{index}]"))
+        return entries
 
-            for index in range(len(reg)):
-                try:
-                    addr, size = node.get_reg(index)
-                except AttributeError:
-                    continue
-                if size == 0:
-                    continue
-                lookup.add(range(addr, addr + size), node.name + f"[{index}]")
+    def build_addr_lookup(self):
+        '''Return an AddrLookup of the reg ranges of nodes in walk_tree().
+
+        The lookup is memoized and updated incrementally when nodes are
+        added, removed or renamed or their reg property is reassigned, so
+        it is shared between callers: clone() it before modifying it.'''
+        if self._addr_lookup is None:
+            self._addr_lookup = AddrLookup()
+            self._addr_entries = {}
+            self._addr_dirty = set()
+            self._addr_layout_dirty = True
+        elif not self._addr_layout_dirty and not self._addr_dirty:
+            return self._addr_lookup
+
+        lookup, entries = self._addr_lookup, self._addr_entries
+        dirty, self._addr_dirty = self._addr_dirty, set()
+        removed = False
+        added = []
+        initial = not entries
+
+        if self._addr_layout_dirty:
+            nodes = list(self.walk_tree())
+            self._addr_order = {node: i for i, node in enumerate(nodes)}
+            for node in [n for n in entries if n not in self._addr_order]:
+                for zone, name in entries.pop(node):
+                    lookup.remove(zone, name)
+                    removed = True
+            dirty.update(n for n in nodes if n not in entries)
+            self._addr_layout_dirty = False
+
+        order = self._addr_order
+        for node in sorted((n for n in dirty if n in order), key=order.__getitem__):
+            for zone, name in entries.get(node, ()):
+                lookup.remove(zone, name)
+                removed = True
+            entries[node] = node._reg_entries()
+            for zone, name in entries[node]:
+                lookup.add(zone, name)
+                added.append(zone)
+
+        if added and not initial:
+            # Re-added entries went to the back; restore the walk_tree()
+            # order a fresh build has, since lookup() returns the first one
+            keys = {}
+            for node, node_entries in entries.items():
+                for index, (zone, name) in enumerate(node_entries):
+                    key = order[node], index
+                    keys[(name, zone)] = min(keys.get((name, zone), key), key)
+            for zone in added:
+                for r, values in lookup.overlaps(zone):
+                    values.sort(key=keys.__getitem__)
+
+        if removed:
+            lookup.compact()
 
         return lookup
 
@@ -855,6 +1078,7 @@ class ADTNode:
 
 def load_adt(data):
     node = ADTNode(ADTNodeStruct.parse(data))
+    node._sync(data)
     node.pmgr_init()
     return node
 
@@ -866,6 +1090,7 @@ if __name__ == "__main__":
     parser.add_argument('output', nargs='?', type=pathlib.Path)
     parser.add_argument('-r', '--retrieve', help='retrieve and store the adt from m1n1', action='store_true')
     parser.add_argument('-a', '--dump-addr', help='dump address lookup table', action='store_true')
+    parser.add_argument('-b', '--bench', help='benchmark node lookups', action='store_true')
     args = parser.parse_args()
 
     if args.retrieve:
@@ -890,3 +1115,45 @@ if __name__ == "__main__":
     if args.dump_addr:
         print("Address lookup table:")
         print(adt.build_addr_lookup())
+
+    if args.bench:
+        import time
+
+        def all_nodes(node):
+            yield node
+            for child in node:
+                yield from all_nodes(child)
+
+        def drop_caches():
+            for node in all_nodes(adt):
+                node._child_index = None
+                node._path_index = {}
+                node._addr_lookup = None
+
+        def bench(desc, func, count=20, setup=None):
+            total = 0
+            for i in range(count):
+                if setup:
+                    setup()
+                start = time.perf_counter()
+                func()
+                total += time.perf_counter() - start
+            print(f"{desc:<40} {total / count * 1000:10.3f} ms")
+
+        nodes = list(all_nodes(adt))
+        paths = [n._path[len(adt._path):] for n in nodes[1:]]
+        print(f"Benchmarking {len(paths)} node paths")
+
+        def lookup_all():
+            for path in paths:
+                adt[path]
+
+        def touch_reg():
+            uart = adt["/arm-io/uart0"]
+            uart.reg = uart.reg
+
+        bench("path lookup (cold)", lookup_all, setup=drop_caches)
+        bench("path lookup (indexed)", lookup_all)
+        bench("build_addr_lookup (cold)", adt.build_addr_lookup, setup=drop_caches)
+        bench("build_addr_lookup (memoized)", adt.build_addr_lookup)
+        bench("build_addr_lookup (one reg changed)", adt.build_addr_lookup, setup=touch_reg)
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 # SPDX-License-Identifier: MIT
-import inspect, textwrap, json, re, sys, os
+import inspect, itertools, textwrap, json, re, sys, os
 
 from construct import *
 from construct.core import evaluate
@@ -139,6 +139,20 @@ class Dec(Adapter):
 class ConstructClassException(Exception):
     pass
 
+# Subcons whose compiled parser returns exactly what the interpreted one does
+# (no display adapters, pointers, versioned fields or nested classes)
+COMPILABLE_SUBCONS = (Struct, Renamed, FormatField, BytesInteger, Bytes, Array,
+                      Padded, Const, Default, type(Pass))
+
+def compilable(subcon):
+    if not isinstance(subcon, COMPILABLE_SUBCONS) or isinstance(subcon, type):
+        return False
+    if isinstance(subcon, Struct):
+        return all(compilable(i) for i in subcon.subcons)
+    if hasattr(subcon, "subcon"):
+        return compilable(subcon.subcon)
+    return True
+
 
 # We need to inherit Construct as a metaclass so things like If and Select will work
 class ReloadableConstructMeta(ReloadableMeta, Construct):
@@ -160,6 +174,9 @@ class ReloadableConstructMeta(ReloadableMeta, Construct):
 
         cls.docs = None
 
+        cls._layouts = {}
+        cls._parser = None
+
         cls._off = {}
         if "subcon" not in attrs:
             return cls
@@ -207,6 +224,8 @@ class ConstructClassBase(Reloadable, metaclass=ReloadableConstructMeta):
 
     """
     SHORT_NAME = None
+    # Parse fixed-layout structs of plain fields with a compiled parser
+    COMPILE = True
 
     parsed = None
 
@@ -283,54 +302,114 @@ class ConstructClassBase(Reloadable, metaclass=ReloadableConstructMeta):
         raise NotImplementedError()
 
     @classmethod
-    def _set_meta(cls, self, stream=None):
+    def _layout(cls):
+        '''Named fields of the fixed-size head of the struct, as
+        (name, offset, size, is_pointer). Computed once per Ver setting.'''
+        key = Ver.version_key()
+        try:
+            return cls._layouts[key][0]
+        except KeyError:
+            pass
+
+        layout = []
+        off = 0
+        subcons = cls.subcon.subcons
+        for i, subcon in enumerate(subcons):
+            try:
+                sizeof = subcon.sizeof()
+            except:
+                break
+            if isinstance(subcon, Ver):
+                if not subcon._active():
+                    continue
+                subcon = subcon.subcon
+            if isinstance(subcon, Renamed):
+                layout.append((subcon.name, off, sizeof, isinstance(subcon.subcon, Pointer)))
+            off += sizeof
+        else:
+            i = len(subcons)
+
+        # The variable-size tail is laid out per instance, starting at off
+        cls._layouts[key] = layout, off, subcons[i:]
+        return layout
+
+    @classmethod
+    def _tail(cls, values):
+        '''Named fields of the variable-size tail of the struct, as in
+        _layout(), sized from the parsed field values. Stops at the first
+        field whose size cannot be computed from them.'''
+        cls._layout()
+        layout, off, subcons = cls._layouts[Ver.version_key()]
+        if not subcons:
+            return
+
+        try:
+            context = {k: v for k, v in values.items() if isinstance(k, str)}
+        except AttributeError:
+            return
+        for subcon in subcons:
+            try:
+                sizeof = subcon.sizeof(**context)
+            except:
+                return
+            if isinstance(subcon, Ver):
+                if not subcon._active():
+                    continue
+                subcon = subcon.subcon
+            if isinstance(subcon, Renamed):
+                yield subcon.name, off, sizeof, isinstance(subcon.subcon, Pointer)
+            off += sizeof
+
+    @classmethod
+    def _get_parser(cls):
+        if cls._parser is None:
+            cls._parser = cls.subcon
+            if cls.COMPILE and isinstance(cls.subcon, Struct) and compilable(cls.subcon):
+                try:
+                    cls.sizeof()
+                    cls._parser = cls.subcon.compile()
+                except:
+                    pass
+        return cls._parser
+
+    @classmethod
+    def _set_meta(cls, self, stream=None, values=None):
         if stream is not None:
             self._pointers = set()
             self._meta = {}
             self._stream = stream
 
         if isinstance(cls.subcon, Struct):
-            subaddr = int(self._addr)
-            for subcon in cls.subcon.subcons:
+            base = int(self._addr)
+            meta_fn = getattr(stream, "meta_fn", None) if stream is not None else None
+            fields = itertools.chain(cls._layout(), cls._tail(self if values is None else values))
+            for name, off, sizeof, is_pointer in fields:
+                subaddr = base + off
+                if meta_fn:
+                    meta = meta_fn(subaddr, sizeof)
+                    if meta is not None:
+                        self._meta[name] = meta
+                if is_pointer:
+                    self._pointers.add(name)
+                    continue
                 try:
-                    sizeof = subcon.sizeof()
+                    val = self[name]
                 except:
-                    break
-                if isinstance(subcon, Ver):
-                    subcon = subcon.subcon
-                if isinstance(subcon, Renamed):
-                    name = subcon.name
-                    #print(name, subcon)
-                    subcon = subcon.subcon
-                    if stream is not None and getattr(stream, "meta_fn", None):
-                        meta = stream.meta_fn(subaddr, sizeof)
-                        if meta is not None:
-                            self._meta[name] = meta
-                    if isinstance(subcon, Pointer):
-                        self._pointers.add(name)
-                        continue
-                    try:
-                        #print(name, subcon)
-                        val = self[name]
-                    except:
-                        pass
-                    else:
-                        if isinstance(val, ConstructClassBase):
-                            val.set_addr(subaddr)
-                        if isinstance(val, list):
-                            subaddr2 = subaddr
-                            for i in val:
-                                if isinstance(i, ConstructClassBase):
-                                    i.set_addr(subaddr2)
-                                    subaddr2 += i.sizeof()
-
-                subaddr += sizeof
+                    continue
+                if isinstance(val, ConstructClassBase):
+                    val.set_addr(subaddr)
+                if isinstance(val, list):
+                    subaddr2 = subaddr
+                    for i in val:
+                        if isinstance(i, ConstructClassBase):
+                            i.set_addr(subaddr2)
+                            subaddr2 += i.sizeof()
 
     @classmethod
     def _parse(cls, stream, context, path):
         #print(f"parse {cls} @ {stream.tell():#x} {path}")
         addr = stream.tell()
-        obj = cls.subcon._parse(stream, context, path)
+        obj = cls._get_parser()._parse(stream, context, path)
         size = stream.tell() - addr
 
         # Don't instance Selects
@@ -343,7 +422,7 @@ class ConstructClassBase(Reloadable, metaclass=ReloadableConstructMeta):
         self._addr = addr
         self._path = path
         self._meta = {}
-        cls._set_meta(self, stream)
+        cls._set_meta(self, stream, obj)
 
         self._apply(obj)
 
@@ -800,6 +879,13 @@ class Ver(Subconstruct):
         _version = {"V": os.environ.get("AGX_FWVER", "V13_5"),
                     "G": os.environ.get("AGX_GPU", "G13")}
 
+    # Result of each version expression for the current _version, shared
+    # across reloads like _version itself and cleared when it changes
+    try:
+        _cache = sys.modules["m1n1.constructutils"].Ver._cache
+    except (KeyError, AttributeError):
+        _cache = {}
+
     MATRIX = {
         "V": ["V12_1", "V12_3", "V12_4", "V13_0B4", "V13_0B5", "V13_0B6", "V13_2", "V13_3", "V13_5B4", "V13_5"],
         "G": ["G13", "G14", "G14X"],
@@ -840,6 +926,7 @@ class Ver(Subconstruct):
     @classmethod
     def parse_ver(cls, version):
         expr = version.replace("&&", " and ").replace("||", " or ")
+        code = compile(expr, f"<Ver {version!r}>", "eval")
 
         base_loc = {j: i for row in cls.MATRIX.values() for i, j in enumerate(row)}
 
@@ -847,16 +934,24 @@ class Ver(Subconstruct):
             loc = dict(base_loc)
             for k, v in ver.items():
                 loc[k] = cls.MATRIX[k].index(v)
-            return eval(expr, None, loc)
+            return eval(code, None, loc)
 
         return check_ver
 
     @classmethod
     def check(cls, version):
-        return cls.parse_ver(version)(cls._version)
+        try:
+            return cls._cache[version]
+        except KeyError:
+            active = cls._cache[version] = bool(cls.parse_ver(version)(cls._version))
+            return active
 
     def _active(self):
-        return self.vcheck(self._version)
+        try:
+            return self._cache[self.cond]
+        except KeyError:
+            active = self._cache[self.cond] = bool(self.vcheck(self._version))
+            return active
 
     def _parse(self, stream, context, path):
         if not self._active():
@@ -874,8 +969,14 @@ class Ver(Subconstruct):
             return 0
         return self.subcon._sizeof(context, path)
 
+    @classmethod
+    def version_key(cls):
+        return tuple(sorted(cls._version.items()))
+
     @classmethod
     def set_version_key(cls, key, version):
+        if cls._version.get(key, None) != version:
+            cls._cache.clear()
         cls._version[key] = version
 
     @classmethod
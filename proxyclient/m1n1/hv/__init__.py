@@ -4,7 +4,7 @@ from construct import *
 
 from ..asm import ARMAsm
 from ..tgtypes import *
-from ..proxy import IODEV, START, EVENT, EXC, EXC_RET, ExcInfo
+from ..proxy import IODEV, START, EVENT, EXC, EXC_RET, ExcInfo, ExcContext, ProxyError
 from ..utils import *
 from ..sysreg import *
 from ..macho import MachO
@@ -15,6 +15,12 @@ from .gdbserver import *
 from .types import *
 from .virtutils import *
 from .virtio import *
+from .tracelog import TraceLogWriter
+from .decoder import AsyncDecoder
+from .logger import HVLog
+from .snapshot import GuestSnapshot
+from .resident import ResidentImage
+from .symbols import SymbolIndex
 
 __all__ = ["HV"]
 
@@ -38,6 +44,12 @@ class HV(Reloadable):
     SPTE_PROXY_HOOK_W       = 3 << 50
     SPTE_PROXY_HOOK_RW      = 4 << 50
 
+    XLATE_MASK = 0xfff
+    XLATE_BATCH = 512
+
+    PT_BATCH = 256
+    PT_TLBI_SCOPED_MAX = 0x100000
+
     MSR_REDIRECTS = {
         SCTLR_EL1: SCTLR_EL12,
         TTBR0_EL1: TTBR0_EL12,
@@ -75,6 +87,9 @@ class HV(Reloadable):
     IRQTRACE_IRQ = 1
 
     def __init__(self, iface, proxy, utils):
+        self.decoder = None
+        self.logger = HVLog()
+        self._ctx = None
         self.iface = iface
         self.p = proxy
         self.u = utils
@@ -88,19 +103,38 @@ class HV(Reloadable):
         self._wps = [None, None, None, None]
         self._wpcs = [0, 0, 0, 0]
         self.sym_offset = 0
-        self.symbols = []
-        self.symbol_dict = {}
+        self.symbols = SymbolIndex()
+        self.symbol_dict = self.symbols.names
         self.sysreg = {}
+        self.msr_handlers = {}
+        self._msr_iss = {}
+        self.log_msr = True
         self.novm = False
         self._in_handler = False
         self._sigint_pending = False
+        self._interrupt_requested = False
+        self._virtio_kick = False
         self._in_shell = False
         self._gdbserver = None
         self.vm_hooks = [None]
         self.interrupt_map = {}
         self.mmio_maps = DictRangeMap()
+        self._mmio_dispatch = {}
+        # Sorted keys of _mmio_dispatch, so a flush only visits its zone
+        self._mmio_dispatch_addrs = []
+        self.tracelog = None
         self.dirty_maps = BoolRangeMap()
+        self._pt_state = RangeMap()
+        self._pt_ops = None
+        self._pt_tlbi = False
+        self._pt_tlbi_size = 0
+        self._pt_buf = None
+        self.pt_stats = {"updates": 0, "ops": 0, "last_ops": 0, "skipped": 0,
+                         "tlbi_scoped": 0, "tlbi_all": 0}
+        self._msr_update()
         self.tracer_caches = {}
+        self._xlate_cache = {}
+        self._xlate_buf = None
         self.shell_locals = {}
         self.xnu_mode = False
         self._update_shell_locals()
@@ -114,11 +148,25 @@ class HV(Reloadable):
         self.switching_context = False
         self.show_timestamps = False
         self.virtio_devs = {}
+        self._resources = None
+        self._resident = None
 
     def _reloadme(self):
         super()._reloadme()
+        self._msr_update()
         self._update_shell_locals()
 
+    @property
+    def ctx(self):
+        # Handlers running on the async decoder must not touch the target
+        if self.decoder is not None and self.decoder.in_worker():
+            return None
+        return self._ctx
+
+    @ctx.setter
+    def ctx(self, ctx):
+        self._ctx = ctx
+
     def _update_shell_locals(self):
         self.shell_locals.update({
             "hv": self,
@@ -136,21 +184,27 @@ class HV(Reloadable):
 
         self.shell_locals["ctx"] = self.context
 
-    def log(self, s, *args, show_cpu=True, **kwargs):
+    def log(self, s, *args, show_cpu=True, source=None, **kwargs):
+        '''s may be a callable returning the message, to defer formatting'''
+        prefix = ""
         if self.ctx is not None and show_cpu:
-            ts=""
+            prefix = f"[cpu{self.ctx.cpu_id}] "
             if self.show_timestamps:
-                ts = f"[{self.u.mrs(CNTPCT_EL0):#x}]"
-            print(ts+f"[cpu{self.ctx.cpu_id}] " + s, *args, **kwargs)
-            if self.print_tracer.log_file:
-                print(f"# {ts}[cpu{self.ctx.cpu_id}] " + s, *args, file=self.print_tracer.log_file, **kwargs)
-        else:
-            print(s, *args, **kwargs)
-            if self.print_tracer.log_file:
-                print("# " + s, *args, file=self.print_tracer.log_file, **kwargs)
+                # Only read the counter for lines that are actually written
+                cpu = prefix
+                prefix = lambda: f"[{self.u.mrs(CNTPCT_EL0):#x}]" + cpu
+        self.logger.log(s, *args, prefix=prefix, source=source, **kwargs)
+
+    def _hv_map(self, ipa, to, size, incr):
+        if self._pt_ops is not None:
+            self._pt_ops.append((ipa, to, size, incr | (2 if self._pt_tlbi else 0)))
+            return
+        # Mapped behind pt_update's back, its committed state is unknown now
+        self._pt_state.clear(irange(ipa, size))
+        assert self.p.hv_map(ipa, to, size, incr) >= 0
 
     def unmap(self, ipa, size):
-        assert self.p.hv_map(ipa, 0, size, 0) >= 0
+        self._hv_map(ipa, 0, size, 0)
 
     def map_hw(self, ipa, pa, size):
         '''map IPA (Intermediate Physical Address) to actual PA'''
@@ -171,14 +225,14 @@ class HV(Reloadable):
         size_p = align_down(size)
         if size_p > 0:
             #print(f"map_hw real {ipa_p:#x} -> {pa:#x} [{size_p:#x}]")
-            assert self.p.hv_map(ipa_p, pa | self.PTE_ATTRIBUTES | self.PTE_VALID, size_p, 1) >= 0
+            self._hv_map(ipa_p, pa | self.PTE_ATTRIBUTES | self.PTE_VALID, size_p, 1)
 
         if size_p != size:
             self.map_sw(ipa_p + size_p, pa + size_p, size - size_p)
 
     def map_sw(self, ipa, pa, size):
         #print(f"map_sw {ipa:#x} -> {pa:#x} [{size:#x}]")
-        assert self.p.hv_map(ipa, pa | self.SPTE_MAP, size, 1) >= 0
+        self._hv_map(ipa, pa | self.SPTE_MAP, size, 1)
 
     def map_hook(self, ipa, size, read=None, write=None, **kwargs):
         index = len(self.vm_hooks)
@@ -196,44 +250,78 @@ class HV(Reloadable):
         else:
             assert False
 
-        assert self.p.hv_map(ipa, (index << 2) | flags | t, size, 0) >= 0
+        self._hv_map(ipa, (index << 2) | flags | t, size, 0)
+
+    def _flush_xlate(self):
+        '''drop cached guest VA->PA translations'''
+        self._xlate_cache.clear()
+
+    def _translate_pages(self, va, count, w):
+        if count == 1:
+            pa = self.p.hv_translate(va, False, w)
+            return [pa & ~self.XLATE_MASK] if pa else []
+
+        if self._xlate_buf is None:
+            self._xlate_buf = self.u.heap.malloc(8 * self.XLATE_BATCH)
+        count = self.p.hv_translate_range(va, count, w, self._xlate_buf)
+        return list(struct.unpack(f"<{count}Q", self.iface.readmem(self._xlate_buf, 8 * count)))
+
+    def translate_range(self, va, size, w=False):
+        '''translate a virtual address range into (pa, size) runs
+ physically contiguous pages are merged, translation stops at the first fault'''
+        if size <= 0:
+            return []
+
+        mask = self.XLATE_MASK
+        base = va & ~mask
+        count = (va + size - base + mask) >> 12
+        cache = self._xlate_cache
+        pages = [cache.get((base + (i << 12), w)) for i in range(count)]
+
+        i = 0
+        while i < count:
+            if pages[i] is not None:
+                i += 1
+                continue
+            j = i + 1
+            while j < count and pages[j] is None and j - i < self.XLATE_BATCH:
+                j += 1
+            got = self._translate_pages(base + (i << 12), j - i, w)
+            for k, pa in enumerate(got):
+                pages[i + k] = pa
+                cache[(base + ((i + k) << 12), w)] = pa
+            if len(got) < j - i:
+                count = i + len(got)
+                break
+            i = j
+
+        runs = []
+        end = va + size
+        for i in range(count):
+            start = max(va, base + (i << 12))
+            stop = min(end, base + ((i + 1) << 12))
+            pa = pages[i] | (start & mask)
+            if runs and runs[-1][0] + runs[-1][1] == pa:
+                runs[-1][1] += stop - start
+            else:
+                runs.append([pa, stop - start])
+
+        return runs
 
     def readmem(self, va, size):
         '''read from virtual memory'''
         with io.BytesIO() as buffer:
-            while size > 0:
-                pa = self.p.hv_translate(va, False, False)
-                if pa == 0:
-                    break
-
-                size_in_page = 4096 - (va % 4096)
-                if size < size_in_page:
-                    buffer.write(self.iface.readmem(pa, size))
-                    break
-
-                buffer.write(self.iface.readmem(pa, size_in_page))
-                va += size_in_page
-                size -= size_in_page
+            for pa, run in self.translate_range(va, size, False):
+                buffer.write(self.iface.readmem(pa, run))
 
             return buffer.getvalue()
 
     def writemem(self, va, data):
         '''write to virtual memory'''
         written = 0
-        while written < len(data):
-            pa = self.p.hv_translate(va, False, True)
-            if pa == 0:
-                break
-
-            size_in_page = 4096 - (va % 4096)
-            if len(data) - written < size_in_page:
-                self.iface.writemem(pa, data[written:])
-                written = len(data)
-                break
-
-            self.iface.writemem(pa, data[written:written + size_in_page])
-            va += size_in_page
-            written += size_in_page
+        for pa, run in self.translate_range(va, len(data), True):
+            self.iface.writemem(pa, data[written:written + run])
+            written += run
 
         return written
 
@@ -257,16 +345,66 @@ class HV(Reloadable):
         assert mode in (TraceMode.RESERVED, TraceMode.OFF, TraceMode.BYPASS) or read or write
         self.mmio_maps[zone, ident] = (mode, ident, read, write, kwargs)
         self.dirty_maps.set(zone)
+        self._mmio_dispatch_flush(zone)
 
     def del_tracer(self, zone, ident):
         del self.mmio_maps[zone, ident]
         self.dirty_maps.set(zone)
+        self._mmio_dispatch_flush(zone)
 
     def clear_tracers(self, ident):
         for r, v in self.mmio_maps.items():
             if ident in v:
                 v.pop(ident)
                 self.dirty_maps.set(r)
+                self._mmio_dispatch_flush(r)
+
+    def _mmio_dispatch_flush(self, zone):
+        addrs = self._mmio_dispatch_addrs
+        lo = bisect.bisect_left(addrs, zone.start)
+        hi = bisect.bisect_left(addrs, zone.stop, lo)
+        for addr in addrs[lo:hi]:
+            del self._mmio_dispatch[addr]
+        del addrs[lo:hi]
+
+    def _mmio_handlers(self, addr):
+        '''return the sorted tracer maps for an address, plus the mmiotrace
+ read and write handler lists, split into (all, ASYNC only, others), compiled
+ on first use'''
+        entry = self._mmio_dispatch.get(addr, None)
+        if entry is None:
+            maps = tuple(sorted(self.mmio_maps[addr].values(), reverse=True))
+            reads = tuple((mode, ident, read, kwargs)
+                          for mode, ident, read, write, kwargs in maps
+                          if mode != TraceMode.OFF and (read or mode > TraceMode.WSYNC))
+            writes = tuple((mode, ident, write, kwargs)
+                           for mode, ident, read, write, kwargs in maps
+                           if mode != TraceMode.OFF and (write or mode > TraceMode.UNBUF))
+            def split(handlers):
+                return (handlers,
+                        tuple(h for h in handlers if h[0] == TraceMode.ASYNC),
+                        tuple(h for h in handlers if h[0] != TraceMode.ASYNC))
+            entry = self._mmio_dispatch[addr] = (maps, split(reads), split(writes))
+            bisect.insort(self._mmio_dispatch_addrs, addr)
+        return entry
+
+    def _tracer_fault(self, addr, evt, mode, ident, write, func, kwargs):
+        '''slow path for a tracer callback that raised: report it and hand
+ over to shellwrap for the debug shell and retries'''
+        def do_update():
+            nonlocal func, kwargs
+            func = lambda *args, **kwargs: None
+
+            m = self.mmio_maps[addr].get(ident, None)
+            if not m:
+                return
+
+            mode, ident_, read_, write_, kwargs = m
+            func = (write_ if write else read_) or func
+
+        self.shellwrap(lambda: func(evt, **kwargs),
+                       f"Tracer {ident}:{'write' if write else 'read'} ({mode.name})",
+                       update=do_update, failed=True)
 
     def trace_device(self, path, mode=TraceMode.ASYNC, ranges=None):
         node = self.adt[path]
@@ -288,6 +426,71 @@ class HV(Reloadable):
         else:
             self.del_tracer(zone, "PrintTracer")
 
+    def _pt_set(self, start, stop, desc, msg):
+        '''map [start, stop) as desc, unless the committed state already matches
+ desc is ("unmap",), ("hook", read, write, flags), ("sw", flags) or ("hw",)
+ msg describes the new mapping for the log'''
+        zone = range(start, stop)
+        pos = start
+        changed = tlbi = False
+        for r, old in self._pt_state.overlaps(zone):
+            if r.start > pos:
+                changed = tlbi = True
+            if old != desc:
+                changed = True
+                # Only valid (HW) stage 2 entries can be cached in the TLB
+                tlbi = tlbi or old[0] == "hw"
+            pos = r.stop
+        if pos < stop:
+            changed = tlbi = True
+
+        if not changed:
+            self.pt_stats["skipped"] += 1
+            return
+
+        self._pt_state.replace(zone, desc)
+        self._pt_tlbi = tlbi
+        if tlbi:
+            self._pt_tlbi_size += stop - start
+
+        size = stop - start
+        kind = desc[0]
+        if kind == "unmap":
+            self.unmap(start, size)
+        elif kind == "hook":
+            self.map_hook_idx(start, size, 0, desc[1], desc[2], flags=desc[3])
+        elif kind == "sw":
+            self.map_sw(start, start | desc[1], size)
+        elif kind == "hw":
+            self.map_hw(start, start, size)
+        self.log(lambda: f"PT[{start:09x}:{stop:09x}] -> {msg}", source="pt")
+
+    def _pt_commit(self):
+        ops, self._pt_ops = self._pt_ops, None
+        tlbi_size = self._pt_tlbi_size
+        tlbi_all = tlbi_size > self.PT_TLBI_SCOPED_MAX
+
+        if self._pt_buf is None:
+            self._pt_buf = self.u.heap.malloc(32 * self.PT_BATCH)
+
+        for i in range(0, max(len(ops), 1), self.PT_BATCH):
+            batch = ops[i:i + self.PT_BATCH]
+            last = i + self.PT_BATCH >= len(ops)
+            if not batch and not tlbi_all:
+                break
+            data = b"".join(struct.pack("<4Q", *op) for op in batch)
+            self.iface.writemem(self._pt_buf, data)
+            # Global invalidation happens once, with the last batch
+            assert self.p.hv_map_batch(self._pt_buf, len(batch), tlbi_all and last) == len(batch)
+
+        self.pt_stats["updates"] += 1
+        self.pt_stats["ops"] += len(ops)
+        self.pt_stats["last_ops"] = len(ops)
+        if tlbi_all:
+            self.pt_stats["tlbi_all"] += 1
+        elif tlbi_size:
+            self.pt_stats["tlbi_scoped"] += 1
+
     def pt_update(self):
         if not self.dirty_maps:
             return
@@ -295,80 +498,90 @@ class HV(Reloadable):
         self.dirty_maps.compact()
         self.mmio_maps.compact()
 
+        self._pt_ops = []
+        self._pt_tlbi_size = 0
         top = 0
 
-        for zone in self.dirty_maps:
-            if zone.stop <= top:
-                continue
-            top = max(top, zone.start)
-
-            for mzone, maps in self.mmio_maps.overlaps(zone):
-                if mzone.stop <= top:
-                    continue
-                if top < mzone.start:
-                    self.unmap(top, mzone.start - top)
-                    self.log(f"PT[{top:09x}:{mzone.start:09x}] -> *UNMAPPED*")
-
-                top = mzone.stop
-                if not maps:
-                    continue
-                maps = sorted(maps.values(), reverse=True)
-                mode, ident, read, write, kwargs = maps[0]
-
-                need_read = any(m[2] for m in maps)
-                need_write = any(m[3] for m in maps)
-
-                if mode == TraceMode.RESERVED:
-                    self.log(f"PT[{mzone.start:09x}:{mzone.stop:09x}] -> RESERVED {ident}")
-                    continue
-                elif mode in (TraceMode.HOOK, TraceMode.SYNC):
-                    self.map_hook_idx(mzone.start, mzone.stop - mzone.start, 0,
-                                      need_read, need_write)
-                    if mode == TraceMode.HOOK:
-                        for m2, i2, r2, w2, k2 in maps[1:]:
-                            if m2 == TraceMode.HOOK:
-                                self.log(f"!! Conflict: HOOK {i2}")
-                elif mode == TraceMode.WSYNC:
-                    flags = self.SPTE_TRACE_READ if need_read else 0
-                    self.map_hook_idx(mzone.start, mzone.stop - mzone.start, 0,
-                                      False, need_write, flags=flags)
-                elif mode in (TraceMode.UNBUF, TraceMode.ASYNC, TraceMode.BYPASS):
-                    pa = mzone.start
-                    if mode == TraceMode.UNBUF:
-                        pa |= self.SPTE_TRACE_UNBUF
-                    if need_read:
-                        pa |= self.SPTE_TRACE_READ
-                    if need_write:
-                        pa |= self.SPTE_TRACE_WRITE
-                    self.map_sw(mzone.start, pa, mzone.stop - mzone.start)
-                elif mode == TraceMode.OFF:
-                    self.map_hw(mzone.start, mzone.start, mzone.stop - mzone.start)
-                    self.log(f"PT[{mzone.start:09x}:{mzone.stop:09x}] -> HW:{ident}")
+        try:
+            for zone in self.dirty_maps:
+                if zone.stop <= top:
                     continue
+                top = max(top, zone.start)
+
+                for mzone, maps in self.mmio_maps.overlaps(zone):
+                    if mzone.stop <= top:
+                        continue
+                    if top < mzone.start:
+                        self._pt_set(top, mzone.start, ("unmap",), "*UNMAPPED*")
+
+                    top = mzone.stop
+                    if not maps:
+                        continue
+                    maps = sorted(maps.values(), reverse=True)
+                    mode, ident, read, write, kwargs = maps[0]
+
+                    need_read = any(m[2] for m in maps)
+                    need_write = any(m[3] for m in maps)
+
+                    rest = [m[1] for m in maps[1:] if m[0] != TraceMode.OFF]
+                    if rest:
+                        rest = " (+ " + ", ".join(rest) + ")"
+                    else:
+                        rest = ""
+                    msg = f"{mode.name}.{'R' if read else ''}{'W' if read else ''} {ident}{rest}"
+
+                    if mode == TraceMode.RESERVED:
+                        # Owned by someone else (vuart, virtio...), not tracked here
+                        self._pt_state.clear(mzone)
+                        self.log(f"PT[{mzone.start:09x}:{mzone.stop:09x}] -> RESERVED {ident}", source="pt")
+                        continue
+                    elif mode in (TraceMode.HOOK, TraceMode.SYNC):
+                        self._pt_set(mzone.start, mzone.stop,
+                                     ("hook", need_read, need_write, 0), msg)
+                        if mode == TraceMode.HOOK:
+                            for m2, i2, r2, w2, k2 in maps[1:]:
+                                if m2 == TraceMode.HOOK:
+                                    self.log(f"!! Conflict: HOOK {i2}")
+                    elif mode == TraceMode.WSYNC:
+                        flags = self.SPTE_TRACE_READ if need_read else 0
+                        self._pt_set(mzone.start, mzone.stop,
+                                     ("hook", False, need_write, flags), msg)
+                    elif mode in (TraceMode.UNBUF, TraceMode.ASYNC, TraceMode.BYPASS):
+                        flags = 0
+                        if mode == TraceMode.UNBUF:
+                            flags |= self.SPTE_TRACE_UNBUF
+                        if need_read:
+                            flags |= self.SPTE_TRACE_READ
+                        if need_write:
+                            flags |= self.SPTE_TRACE_WRITE
+                        self._pt_set(mzone.start, mzone.stop, ("sw", flags), msg)
+                    elif mode == TraceMode.OFF:
+                        self._pt_set(mzone.start, mzone.stop, ("hw",), f"HW:{ident}")
+
+                if top < zone.stop:
+                    self._pt_set(top, zone.stop, ("unmap",), "*UNMAPPED*")
+        finally:
+            self._pt_commit()
 
-                rest = [m[1] for m in maps[1:] if m[0] != TraceMode.OFF]
-                if rest:
-                    rest = " (+ " + ", ".join(rest) + ")"
-                else:
-                    rest = ""
-
-                self.log(f"PT[{mzone.start:09x}:{mzone.stop:09x}] -> {mode.name}.{'R' if read else ''}{'W' if read else ''} {ident}{rest}")
-
-            if top < zone.stop:
-                self.unmap(top, zone.stop - top)
-                self.log(f"PT[{top:09x}:{zone.stop:09x}] -> *UNMAPPED*")
-
-        self.u.inst(0xd50c83df) # tlbi vmalls12e1is
+        self._pt_state.compact()
+        self._flush_xlate()
         self.dirty_maps.clear()
 
-    def shellwrap(self, func, description, update=None, needs_ret=False):
+    def shellwrap(self, func, description, update=None, needs_ret=False, failed=False):
+        '''run func, dropping into the debug shell if it raises
+ with failed=True, the caller already ran func and is handling its exception'''
 
         while True:
-            try:
-                return func()
-            except Exception:
+            if failed:
+                failed = False
                 print(f"Exception in {description}")
                 traceback.print_exc()
+            else:
+                try:
+                    return func()
+                except Exception:
+                    print(f"Exception in {description}")
+                    traceback.print_exc()
 
             if not self.ctx:
                 print("Running in asynchronous context. Target operations are not available.")
@@ -401,6 +614,10 @@ class HV(Reloadable):
         def handle_sigusr2(signal, stack):
             raise shell.ExitConsole(EXC_RET.EXIT_GUEST)
 
+        if self.decoder is not None:
+            self.decoder.drain()
+        self.logger.flush()
+
         default_sigusr1 = signal.signal(signal.SIGUSR1, handle_sigusr1)
         try:
             default_sigusr2 = signal.signal(signal.SIGUSR2, handle_sigusr2)
@@ -435,39 +652,77 @@ class HV(Reloadable):
         self._gdbserver = None
 
     def handle_mmiotrace(self, data):
-        evt = EvtMMIOTrace.parse(data)
-
-        def do_update():
-            nonlocal mode, ident, read, write, kwargs
-            read = lambda *args, **kwargs: None
-            write = lambda *args, **kwargs: None
-
-            m = self.mmio_maps[evt.addr].get(ident, None)
-            if not m:
-                return
-
-            mode, ident, read_, write_, kwargs = m
-            read = read_ or read
-            write = write_ or write
+        decoder = self.decoder
+        if decoder is not None:
+            flags, addr = struct.unpack_from("<I12xQ", data)
+            maps, reads, writes = self._mmio_handlers(addr)
+            handlers, queued, inline = writes if flags & (1 << 5) else reads
+            if queued:
+                decoder.submit(data, queued)
+                if not inline:
+                    return
+            if decoder.pending(inline):
+                # Keep this tracer's queued ASYNC events ordered before it
+                decoder.drain()
+            handlers = inline
 
-        maps = sorted(self.mmio_maps[evt.addr].values(), reverse=True)
-        for mode, ident, read, write, kwargs in maps:
-            if mode > TraceMode.WSYNC or (evt.flags.WRITE and mode > TraceMode.UNBUF):
+        evt = EvtMMIOTrace.parse(data)
+        write = evt.flags.WRITE
+
+        if decoder is None:
+            maps, reads, writes = self._mmio_handlers(evt.addr)
+            handlers = (writes if write else reads)[0]
+        limit = TraceMode.UNBUF if write else TraceMode.WSYNC
+        for mode, ident, func, kwargs in handlers:
+            if mode > limit:
                 print(f"ERROR: mmiotrace event but expected {mode.name} mapping")
                 continue
-            if mode == TraceMode.OFF:
-                continue
-            if evt.flags.WRITE:
-                if write:
-                    self.shellwrap(lambda: write(evt, **kwargs),
-                                   f"Tracer {ident}:write ({mode.name})", update=do_update)
-            else:
-                if read:
-                    self.shellwrap(lambda: read(evt, **kwargs),
-                                   f"Tracer {ident}:read ({mode.name})", update=do_update)
+            try:
+                func(evt, **kwargs)
+            except Exception:
+                self._tracer_fault(evt.addr, evt, mode, ident, write, func, kwargs)
+
+    # The hook buffer at ctx.data is a VMProxyHookData; the guest sees the
+    # data words it holds when the hook returns.
+    HOOK_DATA = 16
+
+    def _hook_return(self, ctx, width, val):
+        words = 1 << max(0, width - 3)
+        self.iface.writemem(ctx.data + self.HOOK_DATA, struct.pack(f"<{words}Q", *val[:words]))
+
+    def _hook_read(self, ctx, addr, width):
+        '''read a SYNC access from the device into the hook buffer
+ multi-word accesses are copied on the target, with the same 64-bit loads
+ u.read would issue, and fetched back in one transfer'''
+        if width <= 3 or addr & 7:
+            val = self.u.read(addr, 8 << width)
+            if not isinstance(val, list) and not isinstance(val, tuple):
+                val = [val]
+            self._hook_return(ctx, width, val)
+            return val
+
+        size = 1 << width
+        self.p.memcpy64(ctx.data + self.HOOK_DATA, addr, size)
+        if self.p.get_exc_count():
+            raise ProxyError("Exception occurred")
+        return list(struct.unpack(f"<{size // 8}Q",
+                                  self.iface.readmem(ctx.data + self.HOOK_DATA, size)))
+
+    def _hook_write(self, ctx, addr, width, val):
+        if width <= 3 or addr & 7:
+            self.u.write(addr, val, 8 << width)
+            return
+        # The hook buffer already holds the written words
+        self.p.memcpy64(addr, ctx.data + self.HOOK_DATA, 1 << width)
+        if self.p.get_exc_count():
+            raise ProxyError("Exception occurred")
 
     def handle_vm_hook_mapped(self, ctx, data):
-        maps = sorted(self.mmio_maps[data.addr].values(), reverse=True)
+        if self.decoder is not None:
+            # Keep ASYNC events ordered before this synchronous access
+            self.decoder.drain()
+
+        maps = self._mmio_handlers(data.addr)[0]
 
         if not maps:
             raise Exception(f"VM hook without a mapping at {data.addr:#x}")
@@ -508,17 +763,15 @@ class HV(Reloadable):
                 first += 1
             elif mode == TraceMode.SYNC:
                 try:
-                    val = self.u.read(data.addr, 8 << data.flags.WIDTH)
+                    val = self._hook_read(ctx, data.addr, data.flags.WIDTH)
                 except:
                     self.log(f"MMIO read failed: {data.addr:#x} (w={data.flags.WIDTH})")
                     raise
-                if not isinstance(val, list) and not isinstance(val, tuple):
-                    val = [val]
             elif mode == TraceMode.WSYNC:
                 raise Exception(f"VM hook with unexpected mapping at {data.addr:#x}: {maps[0][0].name}")
 
-            for i in range(1 << max(0, data.flags.WIDTH - 3)):
-                self.p.write64(ctx.data + 16 + 8 * i, val[i])
+            if mode == TraceMode.HOOK:
+                self._hook_return(ctx, data.flags.WIDTH, val)
 
         elif mode == TraceMode.HOOK:
             first += 1
@@ -541,14 +794,13 @@ class HV(Reloadable):
             )
 
             for mode, ident, read, write, kwargs in maps[first:]:
-                if flags.WRITE:
-                    if write:
-                        self.shellwrap(lambda: write(evt, **kwargs),
-                                       f"Tracer {ident}:write ({mode.name})", update=do_update)
-                else:
-                    if read:
-                        self.shellwrap(lambda: read(evt, **kwargs),
-                                       f"Tracer {ident}:read ({mode.name})", update=do_update)
+                func = write if flags.WRITE else read
+                if not func:
+                    continue
+                try:
+                    func(evt, **kwargs)
+                except Exception:
+                    self._tracer_fault(data.addr, evt, mode, ident, flags.WRITE, func, kwargs)
 
         if data.flags.WRITE:
             mode, ident, read, write, kwargs = maps[0]
@@ -566,7 +818,7 @@ class HV(Reloadable):
                             f"Tracer {ident}:write (HOOK)", update=do_update)
             elif mode in (TraceMode.SYNC, TraceMode.WSYNC):
                 try:
-                    self.u.write(data.addr, wval, 8 << data.flags.WIDTH)
+                    self._hook_write(ctx, data.addr, data.flags.WIDTH, wval)
                 except:
                     if data.flags.WIDTH > 3:
                         wval = wval[0]
@@ -593,8 +845,7 @@ class HV(Reloadable):
             val = rfunc(base, data.addr - base, 8 << data.flags.WIDTH, **kwargs)
             if not isinstance(val, list) and not isinstance(val, tuple):
                 val = [val]
-            for i in range(1 << max(0, data.flags.WIDTH - 3)):
-                self.p.write64(ctx.data + 16 + 8 * i, val[i])
+            self._hook_return(ctx, data.flags.WIDTH, val)
 
         return True
 
@@ -603,19 +854,22 @@ class HV(Reloadable):
 
         if evt.type == self.AIC_EVT_TYPE_HW and evt.flags & self.IRQTRACE_IRQ:
             dev = self.interrupt_map[int(evt.num)]
-            print(f"IRQ: {dev}: {evt.num}")
+            if self.tracelog is not None:
+                self.tracelog.irq(evt, dev=dev)
+            else:
+                print(f"IRQ: {dev}: {evt.num}")
 
     def addr(self, addr):
         unslid_addr = addr + self.sym_offset
         if self.xnu_mode and (addr < self.tba.virt_base or unslid_addr < self.macho.vmin):
             return f"0x{addr:x}"
 
-        saddr, name = self.sym(addr)
+        name = self.symbols.format(unslid_addr)
 
         if name is None:
             return f"0x{addr:x} (0x{unslid_addr:x})"
 
-        return f"0x{addr:x} ({name}+0x{unslid_addr - saddr:x})"
+        return f"0x{addr:x} ({name})"
 
     def resolve_symbol(self, name):
         return self.symbol_dict[name] - self.sym_offset
@@ -626,11 +880,7 @@ class HV(Reloadable):
         if self.xnu_mode and (addr < self.tba.virt_base or unslid_addr < self.macho.vmin):
             return None, None
 
-        idx = bisect.bisect_left(self.symbols, (unslid_addr + 1, "")) - 1
-        if idx < 0 or idx >= len(self.symbols):
-            return None, None
-
-        return self.symbols[idx]
+        return self.symbols.lookup(unslid_addr)
 
     def get_sym(self, addr):
         a, name = self.sym(addr)
@@ -639,86 +889,135 @@ class HV(Reloadable):
         else:
             return None
 
+    MSR_SHADOW = {
+        #SPRR_CONFIG_EL1,
+        #SPRR_PERM_EL0,
+        #SPRR_PERM_EL1,
+        VMSA_LOCK_EL1,
+        #SPRR_UNK1_EL1,
+        #SPRR_UNK2_EL1,
+        MDSCR_EL1,
+    }
+    MSR_SKIP = set()
+    MSR_RO = {
+        ACC_CFG_EL1,
+        ACC_OVRD_EL1,
+    }
+    MSR_XLATE = {
+        DC_CIVAC,
+    }
+
+    def _msr_update(self):
+        policy = {}
+        for enc in self.MSR_XLATE:
+            policy[enc] = MSRPolicy.XLATE
+        for enc in self.MSR_RO:
+            policy[enc] = MSRPolicy.RO
+        for enc in self.MSR_SKIP:
+            policy[enc] = MSRPolicy.SKIP
+        for enc in self.MSR_SHADOW:
+            policy[enc] = MSRPolicy.SHADOW
+        for i in range(len(self._bps)):
+            policy[DBGBCRn_EL1(i)] = MSRPolicy.SHADOW
+            policy[DBGBVRn_EL1(i)] = MSRPolicy.SHADOW
+        for i in range(len(self._wps)):
+            policy[DBGWCRn_EL1(i)] = MSRPolicy.SHADOW
+            policy[DBGWVRn_EL1(i)] = MSRPolicy.SHADOW
+        policy[CYC_OVRD_EL1] = MSRPolicy.CYC_OVRD
+        for enc in self.msr_handlers:
+            policy[enc] = MSRPolicy.HANDLER
+        self.msr_policy = policy
+
+    def add_msr_handler(self, reg, read=None, write=None):
+        '''handle guest accesses to a trapped sysreg in Python
+ reg is a name or encoding; read() returns the value, write(value) consumes it.
+ A missing direction is passed through to the real register.'''
+        enc = sysreg_parse(reg)
+        self.msr_handlers[enc] = read, write
+        self._msr_update()
+
+    def del_msr_handler(self, reg):
+        self.msr_handlers.pop(sysreg_parse(reg), None)
+        self._msr_update()
+
     def handle_msr(self, ctx, iss=None):
         if iss is None:
             iss = ctx.esr.ISS
-        iss = ESR_ISS_MSR(iss)
-        enc = iss.Op0, iss.Op1, iss.CRn, iss.CRm, iss.Op2
-
-        name = sysreg_name(enc)
-
-        skip = set()
-        shadow = {
-            #SPRR_CONFIG_EL1,
-            #SPRR_PERM_EL0,
-            #SPRR_PERM_EL1,
-            VMSA_LOCK_EL1,
-            #SPRR_UNK1_EL1,
-            #SPRR_UNK2_EL1,
-            MDSCR_EL1,
-        }
-        ro = {
-            ACC_CFG_EL1,
-            ACC_OVRD_EL1,
-        }
-        xlate = {
-            DC_CIVAC,
-        }
-        for i in range(len(self._bps)):
-            shadow.add(DBGBCRn_EL1(i))
-            shadow.add(DBGBVRn_EL1(i))
-        for i in range(len(self._wps)):
-            shadow.add(DBGWCRn_EL1(i))
-            shadow.add(DBGWVRn_EL1(i))
+        iss = int(iss)
+        decoded = self._msr_iss.get(iss, None)
+        if decoded is None:
+            r = ESR_ISS_MSR(iss)
+            decoded = self._msr_iss[iss] = (
+                (r.Op0, r.Op1, r.CRn, r.CRm, r.Op2), r.DIR == MSR_DIR.READ, r.Rt)
+        enc, read, rt = decoded
+        log = self.log_msr
+
+        policy = self.msr_policy.get(enc, MSRPolicy.PASS)
+        if policy == MSRPolicy.HANDLER:
+            handler = self.msr_handlers[enc][0 if read else 1]
+            if handler is None:
+                policy = MSRPolicy.PASS
+        elif policy == MSRPolicy.RO and read:
+            policy = MSRPolicy.PASS
+        elif policy == MSRPolicy.XLATE and read:
+            policy = MSRPolicy.PASS
 
         value = 0
-        if enc == CYC_OVRD_EL1 and iss.DIR == MSR_DIR.WRITE:
-            if iss.Rt != 31:
-                value = ctx.regs[iss.Rt]
-            self.log(f"Skip: msr {name}, x{iss.Rt} = {value:x}")
+        if not read and rt != 31:
+            value = ctx.regs[rt]
+
+        if policy == MSRPolicy.CYC_OVRD and not read:
+            if log:
+                self.log(f"Skip: msr {sysreg_name(enc)}, x{rt} = {value:x}")
             if value & 1:
                 self.log("Guest is shutting down CPU")
                 self.p.hv_exit_cpu()
                 del self.started_cpus[self.ctx.cpu_id]
-        elif enc in shadow:
-            if iss.DIR == MSR_DIR.READ:
+        elif policy == MSRPolicy.HANDLER:
+            if read:
+                value = handler()
+            else:
+                handler(value)
+            if log:
+                if read:
+                    self.log(f"Handler: mrs x{rt}, {sysreg_name(enc)} = {value:x}")
+                else:
+                    self.log(f"Handler: msr {sysreg_name(enc)}, x{rt} = {value:x}")
+        elif policy == MSRPolicy.SHADOW:
+            if read:
                 value = self.sysreg[self.ctx.cpu_id].setdefault(enc, 0)
-                self.log(f"Shadow: mrs x{iss.Rt}, {name} = {value:x}")
-                if iss.Rt != 31:
-                    ctx.regs[iss.Rt] = value
+                if log:
+                    self.log(f"Shadow: mrs x{rt}, {sysreg_name(enc)} = {value:x}")
             else:
-                if iss.Rt != 31:
-                    value = ctx.regs[iss.Rt]
-                self.log(f"Shadow: msr {name}, x{iss.Rt} = {value:x}")
+                if log:
+                    self.log(f"Shadow: msr {sysreg_name(enc)}, x{rt} = {value:x}")
                 self.sysreg[self.ctx.cpu_id][enc] = value
-        elif enc in skip or (enc in ro and iss.DIR == MSR_DIR.WRITE):
-            if iss.DIR == MSR_DIR.READ:
-                self.log(f"Skip: mrs x{iss.Rt}, {name} = 0")
-                if iss.Rt != 31:
-                    ctx.regs[iss.Rt] = 0
-            else:
-                if iss.Rt != 31:
-                    value = ctx.regs[iss.Rt]
-                self.log(f"Skip: msr {name}, x{iss.Rt} = {value:x}")
+        elif policy in (MSRPolicy.SKIP, MSRPolicy.RO):
+            if log:
+                if read:
+                    self.log(f"Skip: mrs x{rt}, {sysreg_name(enc)} = 0")
+                else:
+                    self.log(f"Skip: msr {sysreg_name(enc)}, x{rt} = {value:x}")
         else:
-            if iss.DIR == MSR_DIR.READ:
-                enc2 = self.MSR_REDIRECTS.get(enc, enc)
+            enc2 = self.MSR_REDIRECTS.get(enc, enc)
+            if read:
                 value = self.u.mrs(enc2)
-                self.log(f"Pass: mrs x{iss.Rt}, {name} = {value:x} ({sysreg_name(enc2)})")
-                if iss.Rt != 31:
-                    ctx.regs[iss.Rt] = value
+                if log:
+                    self.log(f"Pass: mrs x{rt}, {sysreg_name(enc)} = {value:x} ({sysreg_name(enc2)})")
             else:
-                if iss.Rt != 31:
-                    value = ctx.regs[iss.Rt]
-                enc2 = self.MSR_REDIRECTS.get(enc, enc)
                 sys.stdout.flush()
-                if enc in xlate:
+                if policy == MSRPolicy.XLATE:
                     value = self.p.hv_translate(value, True, False)
                 call=None
                 if self.u.cpu_features.apple_sysregs_unlocked:
                     call=self.p.gl2_call
                 self.u.msr(enc2, value, call=call)
-                self.log(f"Pass: msr {name}, x{iss.Rt} = {value:x} (OK) ({sysreg_name(enc2)})")
+                self._flush_xlate()
+                if log:
+                    self.log(f"Pass: msr {sysreg_name(enc)}, x{rt} = {value:x} (OK) ({sysreg_name(enc2)})")
+
+        if read and rt != 31:
+            ctx.regs[rt] = value
 
         ctx.elr += 4
 
@@ -927,15 +1226,15 @@ class HV(Reloadable):
             return self.handle_dabort(ctx)
 
     def _load_context(self):
-        self._info_data = self.iface.readmem(self.exc_info, ExcInfo.sizeof())
-        self.ctx = ExcInfo.parse(self._info_data)
+        self._flush_xlate()
+        self.ctx = ExcContext(self.iface.readmem(self.exc_info, ExcContext.sizeof()))
         return self.ctx
 
     def _commit_context(self):
-        new_info = ExcInfo.build(self.ctx)
-        if new_info != self._info_data:
-            self.iface.writemem(self.exc_info, new_info)
-            self._info_data = new_info
+        # Only the modified words go back, nearby runs merged into one write
+        for offset, data in self.ctx.dirty_runs():
+            self.iface.writemem(self.exc_info + offset, data)
+        self.ctx.clean()
 
     def handle_exception(self, reason, code, info):
         self.exc_info = info
@@ -952,7 +1251,7 @@ class HV(Reloadable):
             self.switching_context = False
             return
 
-        self._in_handler = True
+        self._set_in_handler(True)
 
         ctx = self._load_context()
         self.exc_orig_cpu = self.ctx.cpu_id
@@ -974,7 +1273,9 @@ class HV(Reloadable):
                     handled = self.handle_vm_hook(ctx)
                 elif code == HV_EVENT.USER_INTERRUPT:
                     handled = True
-                    user_interrupt = True
+                    # Otherwise it is a kick_virtio() exit
+                    user_interrupt = self._interrupt_requested
+                    self._interrupt_requested = False
         except Exception as e:
             self.log(f"Python exception while handling guest exception:")
             traceback.print_exc()
@@ -1000,18 +1301,22 @@ class HV(Reloadable):
                 ret = EXC_RET.HANDLED
 
         self.pt_update()
+        if self._virtio_kick:
+            self.poll_virtio()
 
         self._commit_context()
         self.ctx = None
         self.exc_orig_cpu = None
         self.p.exit(ret)
 
-        self._in_handler = False
+        self._set_in_handler(False)
         if self._sigint_pending:
             self._handle_sigint()
+        elif self._virtio_kick:
+            self.kick_virtio()
 
     def handle_bark(self, reason, code, info):
-        self._in_handler = True
+        self._set_in_handler(True)
         self._sigint_pending = False
 
         signal.signal(signal.SIGINT, self.default_sigint)
@@ -1021,10 +1326,14 @@ class HV(Reloadable):
         self.p.exit(0)
 
     def attach_virtio(self, dev, base=None, irq=None, verbose=False):
+        if self._resources is None or self._resources.adt is not self.adt:
+            if self._resources is not None:
+                self._resources.close()
+            self._resources = ResourceIndex(self.adt)
         if base is None:
-            base = alloc_mmio_base(self.adt, 0x1000)
+            base = self._resources.alloc_mmio_base(0x1000)
         if irq is None:
-            irq = alloc_aic_irq(self.adt)
+            irq = self._resources.alloc_aic_irq()
 
         data = dev.config_data
         data_base = self.u.heap.malloc(len(data))
@@ -1068,6 +1377,7 @@ class HV(Reloadable):
         self.virtio_devs[base] = dev
 
     def handle_virtio(self, reason, code, info):
+        self._set_in_handler(True)
         ctx = self.iface.readstruct(info, ExcInfo)
         self.virtio_ctx = info = self.iface.readstruct(ctx.data, VirtioExcInfo)
 
@@ -1083,8 +1393,14 @@ class HV(Reloadable):
             self.run_shell("Entering hypervisor shell", "Returning")
             signal.signal(signal.SIGINT, self._handle_sigint)
 
+        if self._virtio_kick:
+            self.poll_virtio()
         self.p.exit(EXC_RET.HANDLED)
 
+        self._set_in_handler(False)
+        if self._virtio_kick:
+            self.kick_virtio()
+
     def skip(self):
         self.ctx.elr += 4
         self.cont()
@@ -1357,7 +1673,81 @@ class HV(Reloadable):
         self.vbar_el1 = vbar
 
     def set_logfile(self, fd):
-        self.print_tracer.log_file = fd
+        self.logger.flush()
+        self.logger.file = fd
+
+    def set_log_mode(self, buffered=False, rate=None, quiet=False, fold=False):
+        '''configure HV.log output
+ buffered writes log lines from a background thread, rate limits each
+ tracer to that many lines per second, quiet only keeps counters and
+ fold collapses identical consecutive lines into a repeat count'''
+        self.logger.flush()
+        self.logger.rate = rate
+        self.logger.quiet = quiet
+        self.logger.fold = fold
+        self.logger.set_buffered(buffered)
+
+    def log_stats(self):
+        '''show HV.log line counters'''
+        self.logger.flush()
+        for k, v in self.logger.stats().items():
+            print(f"{k:>10}: {v}")
+
+    def async_decode(self, enable=True, depth=1 << 16, block=False):
+        '''handle ASYNC trace events on a background thread
+ depth bounds the queue; when full, events are dropped unless block is set'''
+        if self.decoder is not None:
+            self.decoder.drain()
+            self.decoder.stop()
+            self.decoder = None
+            self.iface.forbidden_thread = None
+        if enable:
+            self.decoder = AsyncDecoder(self, depth, block)
+            self.iface.forbidden_thread = self.decoder.in_worker
+
+    def async_stats(self):
+        '''show async decoder queue depth and dropped event counters'''
+        if self.decoder is None:
+            print("Async decoding is disabled")
+            return
+        for k, v in self.decoder.stats().items():
+            print(f"{k:>10}: {v}")
+
+    def set_tracelog(self, path):
+        '''record trace events to a binary log instead of printing them
+ view it with tools/tracelog.py; None stops logging'''
+        if self.tracelog is not None:
+            self.tracelog.close()
+            self.tracelog = None
+        if path is not None:
+            self.tracelog = TraceLogWriter(path, self.device_addr_tbl)
+
+    def guest_ram(self):
+        '''return the RAM zones handed to the guest'''
+        return [irange(self.tba.phys_base, self.tba.mem_size)]
+
+    def snapshot(self, path, name=None, ranges=None):
+        '''save guest RAM (default: guest_ram()), CPU state and stage 2 maps to path
+ pages unchanged since the previous snapshot in the file are not transferred'''
+        snap = GuestSnapshot(self, path)
+        try:
+            name = snap.take(name, ranges)
+        finally:
+            snap.file.close()
+        st = snap.stats
+        print(f"Snapshot {name}: {st['pages']} pages, {st['read']} read, "
+              f"{st['zero']} zero, {st['new']} new in file")
+        return name
+
+    def restore_snapshot(self, path, name=None):
+        '''restore a snapshot (default: the latest one in path) into the stopped guest'''
+        snap = GuestSnapshot(self, path)
+        try:
+            snap.restore(name)
+        finally:
+            snap.file.close()
+        st = snap.stats
+        print(f"Restored: {st['written']} of {st['pages']} pages written")
 
     def init(self):
         self.adt = load_adt(self.u.get_adt())
@@ -1695,7 +2085,15 @@ class HV(Reloadable):
         self.p.hv_set_time_stealing(False)
 
 
-    def load_raw(self, image, entryoffset=0x800, use_xnu_symbols=False, vmin=0):
+    def load_raw(self, image, entryoffset=0x800, use_xnu_symbols=False, vmin=0, size=None):
+        '''Load a raw image and set up the guest to boot it
+
+ image is either the image data or, with size given, an iterable of
+ (offset, data, clear) segments making up an image of that size.'''
+        if size is None:
+            size = len(image)
+            image = [(0, image, 0)]
+
         sepfw_start, sepfw_length = self.u.adt["chosen"]["memory-map"].SEPFW
         tc_start, tc_size = self.u.adt["chosen"]["memory-map"].TrustCache
         if hasattr(self.u.adt["chosen"]["memory-map"], "preoslog"):
@@ -1703,7 +2101,7 @@ class HV(Reloadable):
         else:
             preoslog_size = 0
 
-        image_size = align(len(image))
+        image_size = align(size)
         sepfw_off = image_size
         image_size += align(sepfw_length)
         preoslog_off = image_size
@@ -1736,10 +2134,14 @@ class HV(Reloadable):
         self.add_tracer(irange(phys_base, self.u.ba.mem_size_actual - phys_base + self.ram_base), "RAM-HIGH", TraceMode.OFF)
         self.unmap_carveouts()
 
-        print(f"Loading kernel image (0x{len(image):x} bytes)...")
-        self.u.compressed_writemem(guest_base, image, True)
-        self.p.dc_cvau(guest_base, len(image))
-        self.p.ic_ivau(guest_base, len(image))
+        print(f"Loading kernel image (0x{size:x} bytes)...")
+        if self._resident is None:
+            self._resident = ResidentImage(self.u)
+        stats = self._resident.write_segments(guest_base, image, True)
+        if stats["chunks_skipped"]:
+            print(f"  {stats['chunks_skipped']} chunks already resident, {stats['chunks_sent']} sent")
+        self.p.dc_cvau(guest_base, size)
+        self.p.ic_ivau(guest_base, size)
 
         print(f"Copying SEPFW (0x{sepfw_length:x} bytes)...")
         self.p.memcpy8(guest_base + sepfw_off, sepfw_start, sepfw_length)
@@ -1807,10 +2209,13 @@ class HV(Reloadable):
                 print(f"  {cpu.name}: [0x{addr:x}] = 0x{rvbar:x}")
                 self.p.write64(addr, rvbar)
 
-    def _load_macho_symbols(self):
-        self.symbol_dict = self.macho.symbols
-        self.symbols = [(v, k) for k, v in self.macho.symbols.items()]
-        self.symbols.sort()
+    def _load_macho_symbols(self, symbols=None):
+        '''index symbols, a dict of name -> address just added to self.macho,
+ or reindex all of self.macho.symbols'''
+        if symbols is None:
+            self.symbols.clear()
+            symbols = self.macho.symbols
+        self.symbols.add(symbols)
 
     def load_macho(self, data, symfile=None):
         if isinstance(data, str):
@@ -1901,13 +2306,13 @@ class HV(Reloadable):
             print("Done.")
             return a.tobytes()
 
-        #image = macho.prepare_image(load_hook)
+        #segments = macho.segments(load_hook)
         chip_id = self.u.adt["/chosen"].chip_id
         if chip_id in (0x8122, 0x6030, 0x6031, 0x6032, 0x6034):
-            image = macho.prepare_image(load_hook_m3)
+            segments = macho.segments(load_hook_m3)
         else:
-            image = macho.prepare_image()
-        self.load_raw(image, entryoffset=(macho.entry - macho.vmin), use_xnu_symbols=self.xnu_mode and symfile is not None, vmin=macho.vmin)
+            segments = macho.segments()
+        self.load_raw(segments, entryoffset=(macho.entry - macho.vmin), use_xnu_symbols=self.xnu_mode and symfile is not None, vmin=macho.vmin, size=macho.load_size())
 
     def update_pac_mask(self):
         tcr = TCR(self.u.mrs(TCR_EL12))
@@ -1926,23 +2331,16 @@ class HV(Reloadable):
         # Assume Linux
         self.sym_offset = 0
         self.xnu_mode = False
-        self.symbols = []
-        self.symbol_dict = {}
+        self.symbols.clear()
         with open(path) as fd:
-            for line in fd.readlines():
-                addr, t, name = line.split()
-                addr = int(addr, 16)
-                self.symbols.append((addr, name))
-                self.symbol_dict[name] = addr
-        self.symbols.sort()
+            self.symbols.add((name, int(addr, 16)) for addr, t, name in map(str.split, fd))
 
     def add_kext_symbols(self, kext, demangle=False):
         info_plist = plistlib.load(open(f"{kext}/Contents/Info.plist", "rb"))
         identifier = info_plist["CFBundleIdentifier"]
         name = info_plist["CFBundleName"]
         macho = MachO(open(f"{kext}/Contents/MacOS/{name}", "rb"))
-        self.macho.add_symbols(identifier, macho, demangle=demangle)
-        self._load_macho_symbols()
+        self._load_macho_symbols(self.macho.add_symbols(identifier, macho, demangle=demangle))
 
     def _handle_sigint(self, signal=None, stack=None):
         self._sigint_pending = True
@@ -1953,8 +2351,30 @@ class HV(Reloadable):
             return
 
         # Kick the proxy to break out of the hypervisor
+        self._interrupt_requested = True
         self.iface.dev.write(b"!")
 
+    def _set_in_handler(self, value):
+        # Serialized with kick_virtio(), so a kick is either written before the
+        # handler starts talking to the target or seen and polled by it
+        with self.iface.write_lock:
+            self._in_handler = value
+
+    def kick_virtio(self):
+        '''request an exit to return completed virtio buffers (any thread)'''
+        self._virtio_kick = True
+        with self.iface.write_lock:
+            if self._in_handler or self._in_shell:
+                # Polled before the handler returns to the guest
+                return
+
+            self.iface.dev.write(b"!")
+
+    def poll_virtio(self):
+        self._virtio_kick = False
+        for dev in self.virtio_devs.values():
+            dev.poll()
+
     def run_script(self, path):
         new_locals = runpy.run_path(path, init_globals=self.shell_locals, run_name="<hv_script>")
         self.shell_locals.clear()
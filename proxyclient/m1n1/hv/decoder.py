@@ -0,0 +1,108 @@
+# SPDX-License-Identifier: MIT
+import queue, threading, traceback
+
+from ..utils import *
+from .types import EvtMMIOTrace
+
+__all__ = ["AsyncDecoder"]
+
+class AsyncDecoder(Reloadable):
+    '''Runs ASYNC-mode tracer handlers on a background thread
+
+ Events are queued in arrival order and handled by a single worker, so the
+ order seen by each tracer is preserved; a tracer's inline handlers wait for its
+ queued events. Handlers run in asynchronous context: hv.ctx reads as None on
+ the worker, and target requests from it fail an assertion.
+ With block=False a full queue drops events (counted in stats) instead of
+ stalling the proxy link.'''
+
+    def __init__(self, hv, depth=1 << 16, block=False):
+        self.hv = hv
+        self.block = block
+        self.queue = queue.Queue(depth)
+        self.queued = 0
+        self.handled = 0
+        self.dropped = 0
+        self.errors = 0
+        self.max_depth = 0
+        # ident -> events queued for it and not handled yet
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.thread = threading.Thread(target=self._worker, name="m1n1-decoder", daemon=True)
+        self.thread.start()
+
+    def in_worker(self):
+        return threading.get_ident() == self.thread.ident
+
+    def submit(self, data, handlers):
+        '''queue a raw EvtMMIOTrace payload for a tuple of (mode, ident, func, kwargs)'''
+        with self._lock:
+            for handler in handlers:
+                self._pending[handler[1]] = self._pending.get(handler[1], 0) + 1
+        try:
+            self.queue.put((data, handlers), self.block)
+        except queue.Full:
+            self._done(handlers)
+            self.dropped += 1
+            return
+        self.queued += 1
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                data, handlers = item
+                try:
+                    evt = EvtMMIOTrace.parse(data)
+                    for mode, ident, func, kwargs in handlers:
+                        try:
+                            func(evt, **kwargs)
+                        except Exception:
+                            self.errors += 1
+                            print(f"Exception in Tracer {ident}:"
+                                  f"{'write' if evt.flags.WRITE else 'read'} ({mode.name}, async)")
+                            traceback.print_exc()
+                    self.handled += 1
+                finally:
+                    self._done(handlers)
+            finally:
+                self.queue.task_done()
+
+    def _done(self, handlers):
+        with self._lock:
+            for handler in handlers:
+                ident = handler[1]
+                count = self._pending[ident] - 1
+                if count:
+                    self._pending[ident] = count
+                else:
+                    del self._pending[ident]
+
+    def pending(self, handlers):
+        '''whether any tracer in a tuple of (mode, ident, func, kwargs) has queued events'''
+        pending = self._pending
+        return pending and any(handler[1] in pending for handler in handlers)
+
+    def drain(self):
+        '''wait until every queued event has been handled'''
+        if self.queue.unfinished_tasks and not self.in_worker():
+            self.queue.join()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def stats(self):
+        return {
+            "depth": self.queue.qsize(),
+            "max_depth": self.max_depth,
+            "queued": self.queued,
+            "handled": self.handled,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
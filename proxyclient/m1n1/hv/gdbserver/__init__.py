@@ -21,6 +21,11 @@ class GDBServer:
     )
     __separator = re.compile("[,;:]")
 
+    # Guest memory is cached per stop in lines of this size, and misses near
+    # a stack pointer read ahead this far up the stack in the same transfer
+    LINE = 0x1000
+    STACK_READAHEAD = 0x4000
+
     def __init__(self, hv, address, log):
         self.__hc = None
         self.__hg = None
@@ -28,6 +33,10 @@ class GDBServer:
         self.__interrupt_eventfd = os.eventfd(0, flags=os.EFD_CLOEXEC | os.EFD_NONBLOCK)
         self.__interrupt_selector = selectors.DefaultSelector()
         self.__request = None
+        self.__lines = {}
+        self.__fpregs = {}
+        # GDB negotiates binary-upload in qSupported, LLDB probes with x0,0
+        self.__binary_upload = False
         self.log = log
 
         self.__interrupt_selector.register(self.__interrupt_eventfd, selectors.EVENT_READ)
@@ -59,6 +68,81 @@ class GDBServer:
 
         self.__hv.cpu(cpu)
 
+    def invalidate(self):
+        '''drop cached guest memory and registers, the guest may have changed them'''
+        self.__lines = {}
+        self.__fpregs = {}
+        # ProxyUtils keeps one SIMD copy for whichever CPU read it last
+        self.__hv.u.simd = self.__hv.u.simd_type = None
+
+    def __fill(self, key, line):
+        cpu, addr = key
+        end = addr + self.LINE
+        for sp in self.__hv.ctx.sp[:2]:
+            if sp & ~(self.LINE - 1) <= addr < sp + self.STACK_READAHEAD:
+                end = max(end, align_up(sp + self.STACK_READAHEAD, self.LINE))
+
+        # Stop short of lines that are already cached
+        stop = addr + self.LINE
+        while stop < end and (cpu, stop) not in self.__lines:
+            stop += self.LINE
+
+        data = self.__hv.readmem(addr, stop - addr)
+        for offset in range(0, stop - addr, self.LINE):
+            self.__lines[(cpu, addr + offset)] = data[offset:offset + self.LINE]
+
+        return self.__lines[key]
+
+    def __readmem(self, addr, size):
+        cpu = self.__hv.ctx.cpu_id
+        end = addr + size
+        chunks = []
+        while addr < end:
+            line = addr & ~(self.LINE - 1)
+            key = (cpu, line)
+            data = self.__lines.get(key)
+            if data is None:
+                data = self.__fill(key, line)
+
+            chunk = data[addr - line:end - line]
+            chunks.append(chunk)
+            addr += len(chunk)
+            if len(data) < self.LINE and addr < end:
+                # Faulted inside this line
+                break
+
+        return b"".join(chunks)
+
+    def __writemem(self, addr, data):
+        self.__lines = {}
+        return self.__hv.writemem(addr, data)
+
+    def __fp(self):
+        cpu = self.__hv.ctx.cpu_id
+        regs = self.__fpregs.get(cpu)
+        if regs is None:
+            u = self.__hv.u
+            u.simd = u.simd_type = None
+            regs = self.__fpregs[cpu] = Container(q=list(u.q), fpsr=u.mrs(FPSR), fpcr=u.mrs(FPCR))
+
+        return regs
+
+    def __memory_map(self):
+        hv = self.__hv
+        user_top = 1 << (64 - hv.pac_mask.bit_count())
+        regions = [(0, user_top)]
+        if hv.xnu_mode:
+            regions.append((hv.tba.virt_base, hv.tba.mem_size))
+        else:
+            regions.append(((1 << 64) - user_top, user_top))
+
+        entries = "".join(f'<memory type="ram" start="0x{start:x}" length="0x{length:x}"/>'
+                          for start, length in regions)
+        return bytes('<?xml version="1.0"?>'
+                     '<!DOCTYPE memory-map PUBLIC "+//IDN gnu.org//DTD GDB Memory Map V1.0//EN" '
+                     '"http://sourceware.org/gdb/gdb-memory-map.dtd">'
+                     f'<memory-map>{entries}</memory-map>', "utf-8")
+
     def __stop_reply(self):
         self.__hc = None
         self.__hg = None
@@ -115,6 +199,7 @@ class GDBServer:
                 self.__cpu(self.__hc)
                 self.__hv.ctx.elr = int(data[1:].decode(), 16)
 
+            self.invalidate()
             self.__hv.cont()
             self.__wait_shell()
             return self.__stop_reply()
@@ -126,9 +211,10 @@ class GDBServer:
             g.regs[31] = self.__hv.ctx.sp[1]
             g.pc = self.__hv.ctx.elr
             g.spsr = self.__hv.ctx.spsr.value
-            g.q = self.__hv.u.q
-            g.fpsr = self.__hv.u.mrs(FPSR)
-            g.fpcr = self.__hv.u.mrs(FPCR)
+            fp = self.__fp()
+            g.q = fp.q
+            g.fpsr = fp.fpsr
+            g.fpcr = fp.fpcr
 
             return bytes(GDBServer.__g.build(g).hex(), "utf-8")
 
@@ -141,15 +227,20 @@ class GDBServer:
 
             self.__hv.ctx.sp[1] = g.regs[31]
             self.__hv.ctx.elr = g.pc
-            self.__hv.ctx.spsr = g.spsr.value
+            self.__hv.ctx.spsr = g.spsr
 
+            fp = self.__fp()
+            self.__hv.u.simd = self.__hv.u.simd_type = None
             q = self.__hv.u.q
             for index, value in enumerate(g.q):
                 q[index] = value
             self.__hv.u.push_simd()
+            fp.q = list(g.q)
 
             self.__hv.u.msr(FPSR, g.fpsr, silent=True)
-            self.__hv.u.msr(FPCR, g.fpsr, silent=True)
+            self.__hv.u.msr(FPCR, g.fpcr, silent=True)
+            fp.fpsr = g.fpsr
+            fp.fpcr = g.fpcr
 
             return b"OK"
 
@@ -174,17 +265,18 @@ class GDBServer:
             return b""
 
         if data[0] in b"krR":
+            self.invalidate()
             self.__hv.reboot()
 
         if data[0] in b"m":
             split = GDBServer.__separator.split(data[1:].decode(), maxsplit=1)
             fields = [int(field, 16) for field in split]
-            return bytes(self.__hv.readmem(fields[0], fields[1]).hex(), "utf-8")
+            return bytes(self.__readmem(fields[0], fields[1]).hex(), "utf-8")
 
         if data[0] in b"M":
             split = GDBServer.__separator.split(data[1:].decode(), maxsplit=2)
             mem = bytes.fromhex(split[2])[:int(split[1], 16)]
-            if self.__hv.writemem(int(split[0], 16), mem) < len(mem):
+            if self.__writemem(int(split[0], 16), mem) < len(mem):
                 return "E22"
 
             return b"OK"
@@ -201,11 +293,11 @@ class GDBServer:
             elif number == 33:
                 reg = GDBServer.__g.spsr.build(self.__hv.ctx.spsr.value)
             elif number < 66:
-                reg = GDBServer.__g.q.subcon.subcon.build(self.__hv.u.q[number - 34])
+                reg = GDBServer.__g.q.subcon.subcon.build(self.__fp().q[number - 34])
             elif number == 66:
-                reg = GDBServer.__g.fpsr.build(self.__hv.u.mrs(FPSR))
+                reg = GDBServer.__g.fpsr.build(self.__fp().fpsr)
             elif number == 67:
-                reg = GDBServer.__g.fpcr.build(self.__hv.u.mrs(FPCR))
+                reg = GDBServer.__g.fpcr.build(self.__fp().fpcr)
             else:
                 return b"E01"
 
@@ -217,20 +309,28 @@ class GDBServer:
             reg = bytes.fromhex(partition[2].decode())
             self.__cpu(self.__hg)
             if number < 31:
-                self.__hv.ctx.regs[number] = GDBServer.__g.regs.subcon.subcon.unpack(reg)
+                self.__hv.ctx.regs[number] = GDBServer.__g.regs.subcon.subcon.parse(reg)
             elif number == 31:
-                self.__hv.ctx.regs[1] = GDBServer.__g.regs.subcon.subcon.unpack(reg)
+                self.__hv.ctx.sp[1] = GDBServer.__g.regs.subcon.subcon.parse(reg)
             elif number == 32:
                 self.__hv.ctx.elr = GDBServer.__g.pc.parse(reg)
             elif number == 33:
                 self.__hv.ctx.spsr.value = GDBServer.__g.spsr.parse(reg)
             elif number < 66:
-                self.__hv.u.q[number - 34] = GDBServer.__g.q.subcon.subcon.parse(reg)
+                fp = self.__fp()
+                value = GDBServer.__g.q.subcon.subcon.parse(reg)
+                self.__hv.u.simd = self.__hv.u.simd_type = None
+                self.__hv.u.q[number - 34] = value
                 self.__hv.u.push_simd()
+                fp.q[number - 34] = value
             elif number == 66:
-                self.__hv.u.msr(FPSR, GDBServer.__g.fpsr.parse(reg), silent=True)
+                fp = self.__fp()
+                fp.fpsr = GDBServer.__g.fpsr.parse(reg)
+                self.__hv.u.msr(FPSR, fp.fpsr, silent=True)
             elif number == 67:
-                self.__hv.u.msr(FPCR, GDBServer.__g.fpcr.parse(reg), silent=True)
+                fp = self.__fp()
+                fp.fpcr = GDBServer.__g.fpcr.parse(reg)
+                self.__hv.u.msr(FPCR, fp.fpcr, silent=True)
             else:
                 return b"E01"
 
@@ -251,11 +351,14 @@ class GDBServer:
 
             if split[0] == "Rcmd":
                 self.__cpu(self.__hg)
+                self.invalidate()
                 self.__hv.run_code(split[1])
+                self.invalidate()
                 return b"OK"
 
             if split[0] == "Supported":
-                return b"PacketSize=65536;qXfer:features:read+;hwbreak+"
+                self.__binary_upload = len(split) > 1 and "binary-upload+" in split[1].split(";")
+                return b"PacketSize=65536;qXfer:features:read+;qXfer:memory-map:read+;binary-upload+;hwbreak+"
 
             if split[0] == "ThreadExtraInfo":
                 thread_id = int(split[1], 16)
@@ -267,9 +370,12 @@ class GDBServer:
 
             if split[0] == "Xfer":
                 xfer = GDBServer.__separator.split(split[1], maxsplit=4)
-                if xfer[0] == "features" and xfer[1] == "read":
-                    resource = os.path.join("features", xfer[2])
-                    annex = pkgutil.get_data(__name__, resource)
+                if xfer[0] in ("features", "memory-map") and xfer[1] == "read":
+                    if xfer[0] == "memory-map":
+                        annex = self.__memory_map()
+                    else:
+                        resource = os.path.join("features", xfer[2])
+                        annex = pkgutil.get_data(__name__, resource)
                     if annex is None:
                         return b"E00"
 
@@ -292,6 +398,7 @@ class GDBServer:
             if len(data) != 1:
                 self.__hv.ctx.elr = int(data[1:].decode(), 16)
 
+            self.invalidate()
             self.__hv.step()
             return self.__stop_reply()
 
@@ -301,11 +408,24 @@ class GDBServer:
 
             return b"E01"
 
+        if data[0] in b"x":
+            split = GDBServer.__separator.split(data[1:].decode(), maxsplit=1)
+            fields = [int(field, 16) for field in split]
+            prefix = b"b" if self.__binary_upload else b""
+            if fields[1] == 0:
+                return prefix or b"OK"
+
+            mem = self.__readmem(fields[0], fields[1])
+            if not mem:
+                return b"E14"
+
+            return prefix + mem
+
         if data[0] in b"X":
             partition = data[1:].partition(b":")
             split = GDBServer.__separator.split(partition[0].decode(), maxsplit=1)
             mem = partition[2][:int(split[1], 16)]
-            if self.__hv.writemem(int(split[0], 16), mem) < len(mem):
+            if self.__writemem(int(split[0], 16), mem) < len(mem):
                 return b"E22"
 
             return b"OK"
@@ -381,6 +501,7 @@ class GDBServer:
 
     def __handle(self, request):
         self.__request = request
+        self.__binary_upload = False
         input_buffer = b""
 
         if not self.__hv.in_shell:
@@ -427,7 +548,7 @@ class GDBServer:
                         input_index = 0
                         input_last = 0
                         while input_index < len(input_data):
-                            if input_data[input_index] == b"*":
+                            if input_data[input_index] == ord("*"):
                                 input_decoded.write(input_data[input_last:input_index])
                                 instance = input_decoded.getvalue()[-1]
                                 input_index += 1
@@ -436,7 +557,7 @@ class GDBServer:
                                 input_decoded.write(input_run)
                                 input_index += 1
                                 input_last = input_index
-                            elif input_data[input_index] == b"}":
+                            elif input_data[input_index] == ord("}"):
                                 input_decoded.write(input_data[input_last:input_index])
                                 input_index += 1
                                 input_decoded.write(bytes([input_data[input_index] ^ 0x20]))
@@ -457,6 +578,7 @@ class GDBServer:
             self.__interrupt_selector.unregister(self.__request)
 
     def notify_in_shell(self):
+        self.invalidate()
         os.eventfd_write(self.__interrupt_eventfd, 1)
 
     def activate(self):
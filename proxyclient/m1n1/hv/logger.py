@@ -0,0 +1,179 @@
+# SPDX-License-Identifier: MIT
+import atexit, queue, sys, threading, time, traceback
+
+from ..utils import *
+
+__all__ = ["HVLog"]
+
+class HVLog(Reloadable):
+    '''Output backend for HV.log
+
+ Messages are strings or callables returning one, so formatting can be left
+ until a line is actually written. With rate set each named source is limited
+ to that many lines per second, the rest only being counted. In quiet mode
+ no lines are written and only the counters are kept. Log file records (such
+ as PrintTracer replay statements) are written in either case.
+
+ With fold set, identical consecutive lines are folded into a repeat count,
+ written when a different line follows, on flush(), and when buffered, once
+ the log has been idle for IDLE seconds.
+
+ When buffered, lines are queued and written by a background thread. flush()
+ waits for everything queued so far and is called before the shell is
+ entered, so log output stays ordered with shell output.'''
+
+    IDLE = 0.2
+
+    def __init__(self, depth=1 << 16):
+        self.depth = depth
+        self.file = None
+        self.quiet = False
+        self.rate = None
+        self.fold = False
+        self.lock = threading.Lock()
+        self.out_lock = threading.Lock()
+        self.queue = None
+        self.thread = None
+        # source -> [logged, suppressed]
+        self.counts = {}
+        # source -> [window start, lines, suppressed]
+        self._windows = {}
+        self._last = None
+        self._repeat = 0
+        self.written = 0
+        self.repeated = 0
+
+    def log(self, msg, *args, prefix="", source=None, record=None, **kwargs):
+        '''log msg, with print() style args and kwargs, attributed to source
+ prefix may be a callable, only called for lines that are written. record, if
+ given, is written only to the log file, after the line, and is kept even
+ when the line itself is suppressed or quiet is set'''
+        with self.lock:
+            counts = self.counts.get(source)
+            if counts is None:
+                counts = self.counts[source] = [0, 0]
+            counts[0] += 1
+            # Queued under the lock, so concurrent callers keep their order
+            if self.quiet or not self._admit(source, counts):
+                if record and self.file:
+                    self._put("", None, (), {"record": record})
+                return
+            if callable(prefix):
+                prefix = prefix()
+            if record:
+                kwargs["record"] = record
+            self._put(prefix, msg, args, kwargs)
+
+    def _admit(self, source, counts):
+        if self.rate is None or source is None:
+            return True
+        now = time.monotonic()
+        window = self._windows.get(source)
+        if window is None or now - window[0] >= 1:
+            if window is not None and window[2]:
+                self._put("", f"[{source}] {window[2]} messages suppressed", (), {})
+            window = self._windows[source] = [now, 0, 0]
+        if window[1] >= self.rate:
+            window[2] += 1
+            counts[1] += 1
+            return False
+        window[1] += 1
+        return True
+
+    def _put(self, prefix, msg, args, kwargs):
+        if self.queue is not None:
+            self.queue.put((prefix, msg, args, kwargs))
+        else:
+            with self.out_lock:
+                self._emit(prefix, msg, args, kwargs)
+
+    def _emit(self, prefix, msg, args, kwargs):
+        record = kwargs.get("record")
+        if msg is not None:
+            self._emit_line(prefix, msg, args, kwargs)
+        if record and self.file:
+            self.file.write(record)
+
+    def _emit_line(self, prefix, msg, args, kwargs):
+        if callable(msg):
+            try:
+                msg = msg()
+            except Exception:
+                traceback.print_exc()
+                msg = f"<failed to format {msg!r}>"
+        line = prefix + kwargs.get("sep", " ").join([str(msg), *map(str, args)])
+        end = kwargs.get("end", "\n")
+        if self.fold and (line, end) == self._last:
+            self._repeat += 1
+            self.repeated += 1
+            return
+        self._end_repeat()
+        if self.fold:
+            self._last = line, end
+        self._write(line + end)
+
+    def _end_repeat(self):
+        if self._repeat:
+            self._write(f"  (last message repeated {self._repeat} times)\n")
+            self._repeat = 0
+        self._last = None
+
+    def _write(self, text):
+        self.written += 1
+        sys.stdout.write(text)
+        if self.file:
+            self.file.write("# " + text)
+
+    def _worker(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.IDLE)
+            except queue.Empty:
+                with self.out_lock:
+                    self._end_repeat()
+                sys.stdout.flush()
+                continue
+            try:
+                if item is None:
+                    return
+                with self.out_lock:
+                    self._emit(*item)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        '''write out everything logged so far, including pending repeat and suppression counts'''
+        with self.lock:
+            for source, window in self._windows.items():
+                if window[2]:
+                    self._put("", f"[{source}] {window[2]} messages suppressed", (), {})
+                    window[2] = 0
+        if self.queue is not None and threading.get_ident() != self.thread.ident:
+            self.queue.join()
+        with self.out_lock:
+            self._end_repeat()
+        sys.stdout.flush()
+
+    def set_buffered(self, buffered):
+        if buffered == (self.queue is not None):
+            return
+        if buffered:
+            self.queue = queue.Queue(self.depth)
+            self.thread = threading.Thread(target=self._worker, name="m1n1-log", daemon=True)
+            self.thread.start()
+            atexit.register(self.flush)
+        else:
+            self.flush()
+            self.queue.put(None)
+            self.thread.join()
+            self.queue = self.thread = None
+            atexit.unregister(self.flush)
+
+    def stats(self):
+        return {
+            "written": self.written,
+            "repeated": self.repeated,
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            **{source or "hv": f"{logged} logged, {suppressed} suppressed"
+               for source, (logged, suppressed) in self.counts.items()},
+        }
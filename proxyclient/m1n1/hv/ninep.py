@@ -0,0 +1,349 @@
+# SPDX-License-Identifier: MIT
+import getpass, os, stat, struct, threading
+from concurrent.futures import ThreadPoolExecutor
+from enum import IntEnum
+
+__all__ = ["NinePServer"]
+
+class P9(IntEnum):
+    Tversion = 100
+    Tauth = 102
+    Tattach = 104
+    Rerror = 107
+    Tflush = 108
+    Twalk = 110
+    Topen = 112
+    Tcreate = 114
+    Tread = 116
+    Twrite = 118
+    Tclunk = 120
+    Tremove = 122
+    Tstat = 124
+    Twstat = 126
+
+QTDIR = 0x80
+DMDIR = 0x80000000
+NOFID = 0xffffffff
+OTRUNC = 0x10
+ORCLOSE = 0x40
+
+HEADER = struct.Struct("<IBH")
+QID = struct.Struct("<BIQ")
+
+class NinePError(Exception):
+    pass
+
+class Fid:
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.dirents = None
+        self.dir_offset = 0
+        self.rclose = False
+
+def _string(s):
+    s = s.encode("utf-8")
+    return struct.pack("<H", len(s)) + s
+
+class _Reader:
+    def __init__(self, data, offset=HEADER.size):
+        self.data = data
+        self.offset = offset
+
+    def unpack(self, fmt):
+        ret = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return ret
+
+    def string(self):
+        length, = self.unpack("<H")
+        s = bytes(self.data[self.offset:self.offset + length]).decode("utf-8")
+        self.offset += length
+        return s
+
+class NinePServer:
+    '''9P2000 file server for a local directory
+
+ Requests are independent of each other apart from their fids, so they are
+ run on a thread pool and several tagged requests can be in flight at once.
+ File data is read and written with preadv/pwritev straight into and out of
+ the message buffers.'''
+
+    MSIZE = 0x80000
+
+    def __init__(self, root, workers=4):
+        self.root = os.path.realpath(root)
+        self.user = getpass.getuser()
+        self.msize = self.MSIZE
+        self.fids = {}
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="9p")
+
+    def close(self):
+        self.pool.shutdown()
+        for fid in self.fids.values():
+            if fid.fd is not None:
+                os.close(fid.fd)
+        self.fids.clear()
+
+    def submit(self, req, callback):
+        '''handle req on the thread pool and pass the response to callback'''
+        size, mtype, tag = HEADER.unpack_from(req)
+        flushed = None
+        with self.lock:
+            if mtype == P9.Tflush:
+                flushed = self.pending.get(struct.unpack_from("<H", req, HEADER.size)[0])
+            future = self.pool.submit(self.handle, req)
+            self.pending[tag] = future
+
+        def done(future):
+            with self.lock:
+                if self.pending.get(tag) is future:
+                    del self.pending[tag]
+            resp = future.result()
+            if flushed is not None:
+                # The flushed request is answered first, its tag must not be
+                # reused before then
+                flushed.add_done_callback(lambda _: callback(resp))
+            else:
+                callback(resp)
+
+        future.add_done_callback(done)
+        return future
+
+    def handle(self, req):
+        '''handle a single request, returns the response message'''
+        size, mtype, tag = HEADER.unpack_from(req)
+        r = _Reader(req)
+        try:
+            resp = self.HANDLERS[P9(mtype)](self, r)
+        except Exception as e:
+            # Every request must be answered, or its tag is lost
+            if isinstance(e, OSError):
+                msg = os.strerror(e.errno) if e.errno else str(e)
+            elif isinstance(e, KeyError):
+                msg = "unknown fid"
+            else:
+                msg = str(e)
+            resp = _string(msg)
+            mtype = P9.Rerror - 1
+
+        if isinstance(resp, bytearray):
+            # Preallocated by the handler with room for the header
+            HEADER.pack_into(resp, 0, len(resp), mtype + 1, tag)
+            return resp
+        return HEADER.pack(HEADER.size + len(resp), mtype + 1, tag) + resp
+
+    def _fid(self, fid):
+        with self.lock:
+            return self.fids[fid]
+
+    def _qid(self, st):
+        qtype = QTDIR if stat.S_ISDIR(st.st_mode) else 0
+        return QID.pack(qtype, int(st.st_mtime) & 0xffffffff, st.st_ino)
+
+    def _stat(self, path):
+        st = os.stat(path)
+        mode = st.st_mode & 0o777
+        if stat.S_ISDIR(st.st_mode):
+            mode |= DMDIR
+        name = "/" if path == self.root else os.path.basename(path)
+        body = (struct.pack("<HI", 0, 0) + self._qid(st) +
+                struct.pack("<IIIQ", mode, int(st.st_atime), int(st.st_mtime),
+                            0 if mode & DMDIR else st.st_size) +
+                _string(name) + _string(self.user) + _string(self.user) + _string(self.user))
+        return struct.pack("<H", len(body)) + body
+
+    def _child(self, path, name):
+        if name == "..":
+            return path if path == self.root else os.path.dirname(path)
+        if "/" in name or name in ("", "."):
+            raise NinePError("Invalid argument")
+        return os.path.join(path, name)
+
+    def _version(self, r):
+        msize, = r.unpack("<I")
+        version = r.string()
+        self.msize = min(msize, self.MSIZE)
+        with self.lock:
+            fids, self.fids = self.fids, {}
+        for fid in fids.values():
+            if fid.fd is not None:
+                os.close(fid.fd)
+        return struct.pack("<I", self.msize) + _string("9P2000" if version.startswith("9P2000") else "unknown")
+
+    def _auth(self, r):
+        raise NinePError("authentication not required")
+
+    def _attach(self, r):
+        fid, afid = r.unpack("<II")
+        with self.lock:
+            self.fids[fid] = Fid(self.root)
+        return self._qid(os.stat(self.root))
+
+    def _flush(self, r):
+        return b""
+
+    def _walk(self, r):
+        fid, newfid, nwname = r.unpack("<IIH")
+        path = self._fid(fid).path
+        qids = []
+        for i in range(nwname):
+            name = r.string()
+            child = self._child(path, name)
+            try:
+                st = os.stat(child)
+            except OSError:
+                if i == 0:
+                    raise
+                break
+            qids.append(self._qid(st))
+            path = child
+
+        if len(qids) == nwname:
+            with self.lock:
+                if newfid != fid and newfid in self.fids:
+                    raise NinePError("fid in use")
+                self.fids[newfid] = Fid(path)
+        return struct.pack("<H", len(qids)) + b"".join(qids)
+
+    def _flags(self, mode):
+        flags = (os.O_RDONLY, os.O_WRONLY, os.O_RDWR, os.O_RDONLY)[mode & 3]
+        if mode & OTRUNC:
+            flags |= os.O_TRUNC
+        return flags
+
+    def _open(self, r):
+        fid, mode = r.unpack("<IB")
+        f = self._fid(fid)
+        st = os.stat(f.path)
+        if stat.S_ISDIR(st.st_mode):
+            f.dirents = []
+        else:
+            f.fd = os.open(f.path, self._flags(mode))
+        f.rclose = bool(mode & ORCLOSE)
+        return self._qid(st) + struct.pack("<I", 0)
+
+    def _create(self, r):
+        fid, = r.unpack("<I")
+        name = r.string()
+        perm, mode = r.unpack("<IB")
+        f = self._fid(fid)
+        path = self._child(f.path, name)
+        if perm & DMDIR:
+            os.mkdir(path, perm & 0o777)
+            f.dirents = []
+        else:
+            f.fd = os.open(path, self._flags(mode) | os.O_CREAT | os.O_EXCL, perm & 0o777)
+        f.path = path
+        f.rclose = bool(mode & ORCLOSE)
+        return self._qid(os.stat(path)) + struct.pack("<I", 0)
+
+    def _read(self, r):
+        fid, offset, count = r.unpack("<IQI")
+        f = self._fid(fid)
+        count = min(count, self.msize - HEADER.size - 4)
+
+        if f.dirents is not None:
+            if offset == 0:
+                f.dirents = [self._stat(os.path.join(f.path, name))
+                             for name in sorted(os.listdir(f.path))]
+                f.dir_offset = 0
+            elif offset != f.dir_offset:
+                raise NinePError("Invalid argument")
+            out = []
+            size = 0
+            while f.dirents and size + len(f.dirents[0]) <= count:
+                entry = f.dirents.pop(0)
+                out.append(entry)
+                size += len(entry)
+            f.dir_offset += size
+            return struct.pack("<I", size) + b"".join(out)
+
+        if f.fd is None:
+            raise NinePError("fid not open")
+        buf = bytearray(HEADER.size + 4 + count)
+        n = os.preadv(f.fd, [memoryview(buf)[HEADER.size + 4:]], offset)
+        del buf[HEADER.size + 4 + n:]
+        struct.pack_into("<I", buf, HEADER.size, n)
+        return buf
+
+    def _write(self, r):
+        fid, offset, count = r.unpack("<IQI")
+        f = self._fid(fid)
+        if f.fd is None:
+            raise NinePError("fid not open")
+        data = memoryview(r.data)[r.offset:r.offset + count]
+        return struct.pack("<I", os.pwritev(f.fd, [data], offset))
+
+    def _clunk(self, r):
+        fid, = r.unpack("<I")
+        with self.lock:
+            f = self.fids.pop(fid)
+        if f.fd is not None:
+            os.close(f.fd)
+        if f.rclose:
+            self._unlink(f.path)
+        return b""
+
+    def _unlink(self, path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            os.rmdir(path)
+        else:
+            os.unlink(path)
+
+    def _remove(self, r):
+        fid, = r.unpack("<I")
+        with self.lock:
+            f = self.fids.pop(fid)
+        if f.fd is not None:
+            os.close(f.fd)
+        if f.path == self.root:
+            raise NinePError("Permission denied")
+        self._unlink(f.path)
+        return b""
+
+    def _getstat(self, r):
+        fid, = r.unpack("<I")
+        st = self._stat(self._fid(fid).path)
+        return struct.pack("<H", len(st)) + st
+
+    def _wstat(self, r):
+        fid, = r.unpack("<I")
+        f = self._fid(fid)
+        r.unpack("<HHHI")  # n, size, type, dev
+        r.unpack("<BIQ")   # qid
+        mode, atime, mtime, length = r.unpack("<IIIQ")
+        name = r.string()
+
+        if mode != 0xffffffff:
+            os.chmod(f.path, mode & 0o777)
+        if length != 0xffffffffffffffff:
+            os.truncate(f.path, length)
+        if mtime != 0xffffffff:
+            st = os.stat(f.path)
+            os.utime(f.path, (st.st_atime, mtime))
+        if name and name != os.path.basename(f.path):
+            if f.path == self.root:
+                raise NinePError("Permission denied")
+            path = self._child(os.path.dirname(f.path), name)
+            os.rename(f.path, path)
+            f.path = path
+        return b""
+
+    HANDLERS = {
+        P9.Tversion: _version,
+        P9.Tauth: _auth,
+        P9.Tattach: _attach,
+        P9.Tflush: _flush,
+        P9.Twalk: _walk,
+        P9.Topen: _open,
+        P9.Tcreate: _create,
+        P9.Tread: _read,
+        P9.Twrite: _write,
+        P9.Tclunk: _clunk,
+        P9.Tremove: _remove,
+        P9.Tstat: _getstat,
+        P9.Twstat: _wstat,
+    }
@@ -0,0 +1,115 @@
+# SPDX-License-Identifier: MIT
+import hashlib, os, struct
+from array import array
+
+from ..utils import *
+
+__all__ = ["ResidentImage"]
+
+# Record file: RECORD_MAGIC, then one ENTRY per chunk known to be resident:
+# target address, host digest of the chunk data, target-side memhash64 of it
+RECORD_MAGIC = b"m1n1RES\x01"
+ENTRY = struct.Struct("<Q16sQ")
+
+class ResidentImage(Reloadable):
+    '''Uploads guest images, skipping chunks that are already in target memory
+
+ A record of the chunks written to each address (the host digest of the data
+ and the target-side memhash64 of the result) is kept, and is saved to
+ resident.rec in M1N1LOADCACHE if set. Before uploading, the target hashes
+ the destination, and chunks whose data and hash both match the record are
+ not sent again. Reloading the same image after a guest reboot then only
+ transfers what the guest changed.'''
+
+    CHUNK = 0x10000
+    HASH_BATCH = 4096
+
+    def __init__(self, u):
+        self.u = u
+        self.record = {}
+        self.stats = {}
+        self.path = None
+        cache_dir = os.environ.get("M1N1LOADCACHE", "")
+        if cache_dir:
+            self.path = os.path.join(cache_dir, "resident.rec")
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as fd:
+                data = fd.read()
+        except FileNotFoundError:
+            return
+        if not data.startswith(RECORD_MAGIC):
+            return
+        body = memoryview(data)[len(RECORD_MAGIC):]
+        body = body[:len(body) - len(body) % ENTRY.size]
+        for addr, digest, thash in ENTRY.iter_unpack(body):
+            self.record[addr] = digest, thash
+
+    def _save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + f".{os.getpid()}.tmp"
+        with open(tmp, "wb") as fd:
+            fd.write(RECORD_MAGIC)
+            fd.write(b"".join(ENTRY.pack(addr, digest, thash)
+                              for addr, (digest, thash) in self.record.items()))
+        os.replace(tmp, self.path)
+
+    def _hash(self, addr, count):
+        p, u = self.u.proxy, self.u
+        hashes = array("Q")
+        with u.heap.guarded_malloc(self.HASH_BATCH * 8) as buf:
+            for i in range(0, count, self.HASH_BATCH):
+                n = min(self.HASH_BATCH, count - i)
+                p.memhash64(addr + i * self.CHUNK, self.CHUNK, n, buf)
+                hashes.frombytes(u.iface.readmem(buf, n * 8))
+        return hashes
+
+    def _digest(self, data):
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def write_segments(self, base, segments, progress=None):
+        '''Write (offset, data, clear) segments to base, like ProxyUtils.write_segments'''
+        chunk = self.CHUNK
+        todo = []
+        written = []
+        sent = skipped = 0
+
+        for offset, data, clear in segments:
+            dest = base + offset
+            count = len(data) // chunk if dest % 8 == 0 else 0
+            if count:
+                digests = [self._digest(data[i * chunk:(i + 1) * chunk]) for i in range(count)]
+                current = self._hash(dest, count)
+                send = [self.record.get(dest + i * chunk) != (digests[i], current[i])
+                        for i in range(count)]
+                run = None
+                for i in range(count + 1):
+                    if i < count and send[i]:
+                        if run is None:
+                            run = i
+                    elif run is not None:
+                        todo.append((offset + run * chunk, data[run * chunk:i * chunk], 0))
+                        run = None
+                if any(send):
+                    written.append((dest, digests))
+                sent += sum(send)
+                skipped += count - sum(send)
+            # Partial chunks and zero fill are always written
+            tail = count * chunk
+            if tail < len(data) or clear:
+                todo.append((offset + tail, data[tail:], clear))
+
+        self.u.write_segments(base, todo, progress)
+
+        for dest, digests in written:
+            hashes = self._hash(dest, len(digests))
+            for i, (digest, thash) in enumerate(zip(digests, hashes)):
+                self.record[dest + i * chunk] = digest, thash
+        self._save()
+
+        self.stats = {"chunks_sent": sent, "chunks_skipped": skipped}
+        return self.stats
@@ -0,0 +1,405 @@
+# SPDX-License-Identifier: MIT
+import hashlib, json, os, struct, time, zlib
+from array import array
+
+from ..utils import *
+from ..sysreg import *
+from ..proxy import ExcContext
+from .types import TraceMode
+
+__all__ = ["SnapshotFile", "GuestSnapshot", "memhash64"]
+
+# File layout:
+#   MAGIC
+#   record*: RECORD header, payload
+#
+# PAGE records hold one deduplicated, zlib-compressed guest page, and are
+# numbered in file order from 1 (0 is the zero page). SNAP records hold the
+# JSON-encoded CPU and tracer map state followed by, for each RAM range, the
+# page numbers and the target-side hashes the pages had when they were taken.
+
+MAGIC = b"m1n1SNP\x01"
+RECORD = struct.Struct("<4sIQ")
+DIGEST_SIZE = 20
+
+TAG_PAGE = b"PAGE"
+TAG_SNAP = b"SNAP"
+
+PAGE_SIZE = 0x4000
+
+MEMHASH_PRIMES = (0x9e3779b185ebca87, 0xc2b2ae3d27d4eb4f, 0x165667b19e3779f9,
+                  0x85ebca77c2b2ae63, 0x27d4eb2f165667c5)
+
+def memhash64(data):
+    '''reference implementation of the target's memhash64()
+
+ XXH64 with seed 0, except that all-zero data (and only that) hashes to 0.'''
+    M = 0xffffffffffffffff
+    P1, P2, P3, P4, P5 = MEMHASH_PRIMES
+
+    def rotl(v, n):
+        return ((v << n) | (v >> (64 - n))) & M
+
+    def round_(acc, word):
+        return rotl((acc + word * P2) & M, 31) * P1 & M
+
+    words = struct.unpack(f"<{len(data) // 8}Q", data[:len(data) & ~7])
+    stripes = len(words) & ~3
+    if stripes:
+        v = [(P1 + P2) & M, P2, 0, (-P1) & M]
+        for i in range(0, stripes, 4):
+            for j in range(4):
+                v[j] = round_(v[j], words[i + j])
+        h = (rotl(v[0], 1) + rotl(v[1], 7) + rotl(v[2], 12) + rotl(v[3], 18)) & M
+        for acc in v:
+            h = ((h ^ round_(0, acc)) * P1 + P4) & M
+    else:
+        h = P5
+
+    h = (h + len(data)) & M
+    for word in words[stripes:]:
+        h = (rotl(h ^ round_(0, word), 27) * P1 + P4) & M
+
+    h = (h ^ (h >> 33)) * P2 & M
+    h = (h ^ (h >> 29)) * P3 & M
+    h ^= h >> 32
+
+    if not any(words):
+        return 0
+    return h or 1
+
+ZERO_HASH = memhash64(bytes(PAGE_SIZE))
+
+class SnapshotFile:
+    '''Append-only store of guest snapshots with page-level deduplication'''
+
+    def __init__(self, path):
+        self.path = path
+        self.pages = [None]
+        self.digests = {}
+        self.snapshots = {}
+        self.last = None
+
+        if os.path.exists(path) and os.path.getsize(path):
+            self.f = open(path, "r+b")
+            if self.f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a m1n1 snapshot file")
+            self._scan()
+        else:
+            self.f = open(path, "w+b")
+            self.f.write(MAGIC)
+
+    def __del__(self):
+        if hasattr(self, "f"):
+            self.close()
+
+    def _scan(self):
+        f = self.f
+        end = f.tell()
+        size = os.fstat(f.fileno()).st_size
+        while True:
+            hdr = f.read(RECORD.size)
+            if len(hdr) < RECORD.size:
+                break
+            tag, _, length = RECORD.unpack(hdr)
+            offset = f.tell()
+            if offset + length > size:
+                break # truncated record, ignored
+            if tag == TAG_PAGE:
+                digest = f.read(DIGEST_SIZE)
+                self.digests[digest] = len(self.pages)
+                self.pages.append((offset + DIGEST_SIZE, length - DIGEST_SIZE))
+            elif tag == TAG_SNAP:
+                name = f.read(struct.unpack("<H", f.read(2))[0]).decode("utf-8")
+                self.snapshots[name] = self.last = offset
+            else:
+                break
+            f.seek(offset + length)
+            end = offset + length
+        f.seek(end)
+        f.truncate()
+
+    def _append(self, tag, payload):
+        self.f.seek(0, os.SEEK_END)
+        self.f.write(RECORD.pack(tag, 0, len(payload)))
+        offset = self.f.tell()
+        self.f.write(payload)
+        return offset
+
+    def add_page(self, data):
+        '''store a page if its contents are new, and return its number'''
+        if not any(data):
+            return 0
+        digest = hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+        idx = self.digests.get(digest, None)
+        if idx is None:
+            payload = zlib.compress(data, 1)
+            offset = self._append(TAG_PAGE, digest + payload)
+            idx = self.digests[digest] = len(self.pages)
+            self.pages.append((offset + DIGEST_SIZE, len(payload)))
+        return idx
+
+    def read_page(self, idx):
+        if idx == 0:
+            return bytes(PAGE_SIZE)
+        offset, length = self.pages[idx]
+        self.f.seek(offset)
+        return zlib.decompress(self.f.read(length))
+
+    def add_snapshot(self, name, state, ranges):
+        '''ranges is a list of (start, page numbers, page hashes)'''
+        meta = dict(state)
+        meta["ranges"] = [(start, len(pages)) for start, pages, hashes in ranges]
+        header = zlib.compress(json.dumps(meta).encode("utf-8"))
+        blobs = []
+        for start, pages, hashes in ranges:
+            blobs.append(zlib.compress(array("I", pages).tobytes()))
+            blobs.append(zlib.compress(array("Q", hashes).tobytes()))
+
+        name_data = name.encode("utf-8")
+        payload = b"".join([struct.pack("<H", len(name_data)), name_data,
+                            struct.pack("<I", len(header)), header,
+                            struct.pack(f"<{len(blobs)}I", *map(len, blobs))] + blobs)
+        self.snapshots[name] = self.last = self._append(TAG_SNAP, payload)
+        self.f.flush()
+
+    def load_snapshot(self, name=None):
+        '''return (state, ranges) for the named or the latest snapshot'''
+        offset = self.last if name is None else self.snapshots[name]
+        if offset is None:
+            raise KeyError("No snapshots in file")
+        f = self.f
+        f.seek(offset)
+        f.seek(struct.unpack("<H", f.read(2))[0], os.SEEK_CUR)
+        length = struct.unpack("<I", f.read(4))[0]
+        meta = json.loads(zlib.decompress(f.read(length)))
+        count = len(meta["ranges"])
+        lengths = struct.unpack(f"<{2 * count}I", f.read(8 * count))
+
+        ranges = []
+        for (start, npages), plen, hlen in zip(meta.pop("ranges"), lengths[::2], lengths[1::2]):
+            pages = array("I", zlib.decompress(f.read(plen)))
+            hashes = array("Q", zlib.decompress(f.read(hlen)))
+            assert len(pages) == len(hashes) == npages
+            ranges.append((start, pages, hashes))
+        return meta, ranges
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
+
+class GuestSnapshot(Reloadable):
+    '''Takes and restores guest snapshots, for a paused HV guest
+
+ Guest RAM is compared page by page through target-side hashes, so only
+ pages that changed since the previous snapshot in the file are read back,
+ and only pages that differ from the snapshot are written on restore.
+
+ The stage 2 maps are saved as the tracer map layout (zone, mode and ident of
+ each tracer). Handlers cannot be saved, so on restore each tracer is bound to
+ the handlers the same ident has in the current session, tracers that need
+ handlers and have none are dropped, and the maps are rebuilt by pt_update().'''
+
+    HASH_BATCH = 4096
+    RUN_MAX = 0x100000
+
+    SYSREGS = [
+        VBAR_EL12, CPACR_EL12, CNTKCTL_EL12, ELR_EL12, SPSR_EL12,
+        TPIDR_EL0, TPIDRRO_EL0, TPIDR_EL1, PAR_EL1, FPSR, FPCR,
+    ]
+
+    def __init__(self, hv, path):
+        self.hv = hv
+        self.file = SnapshotFile(path)
+        self.stats = {}
+
+    def _hash_pages(self, start, count):
+        p, u = self.hv.p, self.hv.u
+        hashes = array("Q")
+        with u.heap.guarded_malloc(self.HASH_BATCH * 8) as buf:
+            for i in range(0, count, self.HASH_BATCH):
+                n = min(self.HASH_BATCH, count - i)
+                p.memhash64(start + i * PAGE_SIZE, PAGE_SIZE, n, buf)
+                hashes.frombytes(self.hv.iface.readmem(buf, n * 8))
+        return hashes
+
+    def _runs(self, pages):
+        '''group page indices into runs of consecutive pages, at most RUN_MAX long'''
+        run = []
+        for i in pages:
+            if run and (i != run[-1] + 1 or len(run) * PAGE_SIZE >= self.RUN_MAX):
+                yield run
+                run = []
+            run.append(i)
+        if run:
+            yield run
+
+    def _sysregs(self):
+        return list(self.hv.MSR_REDIRECTS.values()) + self.SYSREGS
+
+    def _save_cpu(self):
+        hv, u = self.hv, self.hv.u
+        regs = {}
+        for enc in self._sysregs():
+            try:
+                regs[sysreg_name(enc)] = u.mrs(enc, silent=True)
+            except Exception:
+                pass # not implemented on this CPU
+
+        u.push_simd()
+        hv.p.get_simd_state(u.simd_buf)
+        simd = hv.iface.readmem(u.simd_buf, 32 * 16)
+
+        return {
+            "ctx": hv.ctx.build().hex(),
+            "sysregs": regs,
+            "simd": simd.hex(),
+            "shadow": [[list(enc), v] for enc, v in hv.sysreg.get(hv.ctx.cpu_id, {}).items()],
+        }
+
+    def _restore_cpu(self, state):
+        hv, u = self.hv, self.hv.u
+        saved = ExcContext(bytes.fromhex(state["ctx"]))
+        hv.ctx.regs[:] = saved.regs
+        hv.ctx.sp[:] = saved.sp
+        hv.ctx.spsr = saved.spsr
+        hv.ctx.elr = saved.elr
+
+        call = None
+        if u.cpu_features.apple_sysregs_unlocked:
+            call = hv.p.gl2_call
+        for name, value in state["sysregs"].items():
+            u.msr(sysreg_parse(name), value, silent=True, call=call)
+
+        u.simd = u.simd_type = None
+        hv.iface.writemem(u.simd_buf, bytes.fromhex(state["simd"]))
+        hv.p.put_simd_state(u.simd_buf)
+
+        hv.sysreg[hv.ctx.cpu_id] = {tuple(enc): v for enc, v in state["shadow"]}
+
+    def _restore_tracers(self, tracers):
+        hv = self.hv
+        handlers = {}
+        for r, maps in hv.mmio_maps.items():
+            for mode, ident, read, write, kwargs in maps.values():
+                handlers.setdefault(ident, {})[r.start] = read, write, kwargs
+
+        for r, maps in hv.mmio_maps.items():
+            if maps:
+                hv.dirty_maps.set(r)
+        hv.mmio_maps.clear()
+        hv._mmio_dispatch_flush(range(0, 1 << 64))
+
+        for start, stop, maps in tracers:
+            for mode, ident in maps:
+                mode = TraceMode(mode)
+                # Prefer the handlers bound to the same zone now
+                bound = handlers.get(ident, {})
+                read, write, kwargs = bound.get(start, next(iter(bound.values()), (None, None, {})))
+                if not (read or write) and mode not in (TraceMode.RESERVED, TraceMode.OFF,
+                                                        TraceMode.BYPASS):
+                    print(f"Snapshot: no handlers for {ident}, not tracing {start:#x}:{stop:#x}")
+                    continue
+                hv.add_tracer(irange(start, stop - start), ident, mode, read, write, **kwargs)
+
+        hv.pt_update()
+
+    def _cpus(self):
+        hv = self.hv
+        orig = hv.ctx.cpu_id
+        try:
+            for cpu in sorted(hv.started_cpus) or [orig]:
+                hv.cpu(cpu)
+                yield cpu
+        finally:
+            hv.cpu(orig)
+
+    def take(self, name=None, ranges=None):
+        '''snapshot the given RAM zones (default: guest RAM), CPUs and stage 2 maps'''
+        hv = self.hv
+        if hv.ctx is None:
+            raise Exception("The guest must be stopped to take a snapshot")
+        if name is None:
+            name = time.strftime("%Y%m%d-%H%M%S")
+        if ranges is None:
+            ranges = hv.guest_ram()
+
+        prev = {}
+        if self.file.last is not None:
+            for start, pages, hashes in self.file.load_snapshot()[1]:
+                prev[start] = pages, hashes
+
+        stats = self.stats = {"pages": 0, "read": 0, "zero": 0, "new": 0}
+        new_pages = len(self.file.pages)
+        out = []
+        for zone in ranges:
+            start = align_down(zone.start, PAGE_SIZE)
+            count = (align_up(zone.stop, PAGE_SIZE) - start) // PAGE_SIZE
+            hashes = self._hash_pages(start, count)
+            pages = array("I", [0] * count)
+            old_pages, old_hashes = prev.get(start, ((), ()))
+
+            changed = []
+            for i, h in enumerate(hashes):
+                if i < len(old_hashes) and old_hashes[i] == h:
+                    pages[i] = old_pages[i]
+                elif h == ZERO_HASH:
+                    # memhash64() checks the data: only zero pages hash to 0
+                    stats["zero"] += 1
+                else:
+                    changed.append(i)
+
+            for run in self._runs(changed):
+                data = hv.iface.readmem(start + run[0] * PAGE_SIZE, len(run) * PAGE_SIZE)
+                for j, i in enumerate(run):
+                    pages[i] = self.file.add_page(data[j * PAGE_SIZE:(j + 1) * PAGE_SIZE])
+
+            stats["pages"] += count
+            stats["read"] += len(changed)
+            out.append((start, pages, hashes))
+
+        stats["new"] = len(self.file.pages) - new_pages
+
+        state = {
+            "cpus": {str(cpu): self._save_cpu() for cpu in self._cpus()},
+            "tracers": [(r.start, r.stop, [(int(m[0]), m[1]) for m in maps.values()])
+                        for r, maps in hv.mmio_maps.items() if maps],
+        }
+        self.file.add_snapshot(name, state, out)
+        return name
+
+    def restore(self, name=None):
+        '''restore a snapshot taken with take() into the paused guest'''
+        hv = self.hv
+        if hv.ctx is None:
+            raise Exception("The guest must be stopped to restore a snapshot")
+
+        state, ranges = self.file.load_snapshot(name)
+        stats = self.stats = {"pages": 0, "written": 0}
+
+        for start, pages, hashes in ranges:
+            current = self._hash_pages(start, len(pages))
+            changed = [i for i, h in enumerate(current) if h != hashes[i]]
+            for run in self._runs(changed):
+                addr = start + run[0] * PAGE_SIZE
+                size = len(run) * PAGE_SIZE
+                if not any(pages[i] for i in run):
+                    hv.p.memset64(addr, 0, size)
+                else:
+                    data = b"".join(self.file.read_page(pages[i]) for i in run)
+                    hv.u.compressed_writemem(addr, data)
+            stats["pages"] += len(pages)
+            stats["written"] += len(changed)
+
+        if "tracers" in state:
+            self._restore_tracers(state["tracers"])
+
+        cpus = state["cpus"]
+        for cpu in self._cpus():
+            if str(cpu) in cpus:
+                self._restore_cpu(cpus[str(cpu)])
+
+        # Guest code, page tables and contexts all changed under the guest
+        hv.p.ic_ialluis()
+        hv.p.hv_tlbi_all()
+        hv._flush_xlate()
@@ -0,0 +1,117 @@
+# SPDX-License-Identifier: MIT
+import bisect
+from array import array
+from collections import OrderedDict
+
+from ..utils import *
+
+__all__ = ["SymbolIndex"]
+
+class SymbolIndex(Reloadable):
+    '''Address to symbol lookup, built from name -> address symbol sets
+
+ Each add() is sorted on its own and merged into the index by the next
+ lookup, so adding a kext does not re-sort the whole table. Lookups go
+ through a small LRU cache, since backtraces and tracers keep resolving the
+ same addresses.'''
+
+    CACHE_SIZE = 8192
+
+    def __init__(self):
+        self.names = {}
+        self._addrs = array("Q")
+        self._syms = []
+        self._pending = []
+        self._rebuild = False
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        self._merge()
+        return len(self._addrs)
+
+    def clear(self):
+        self.names.clear()
+        self._addrs = array("Q")
+        self._syms = []
+        self._pending = []
+        self._rebuild = False
+        self._cache.clear()
+
+    def add(self, symbols):
+        '''add a dict (or iterable of pairs) of name -> address'''
+        names = self.names
+        new = []
+        for name, addr in (symbols.items() if isinstance(symbols, dict) else symbols):
+            old = names.get(name, None)
+            if old == addr:
+                continue
+            if old is not None:
+                # A moved symbol leaves a stale entry behind, start over
+                self._rebuild = True
+            names[name] = addr
+            new.append((addr, name))
+        if new:
+            new.sort()
+            self._pending.append(new)
+            self._cache.clear()
+
+    def _merge(self):
+        if self._rebuild:
+            self._addrs = array("Q")
+            self._syms = []
+            self._pending = [sorted((addr, name) for name, addr in self.names.items())]
+            self._rebuild = False
+
+        for new in self._pending:
+            addrs, syms = self._addrs, self._syms
+            if not addrs:
+                self._addrs = array("Q", [addr for addr, name in new])
+                self._syms = [name for addr, name in new]
+                continue
+            out_addrs = array("Q")
+            out_syms = []
+            prev = 0
+            # Copy the existing index in slices between the insertion points
+            for addr, name in new:
+                pos = bisect.bisect_right(addrs, addr, prev)
+                while pos > prev and addrs[pos - 1] == addr and syms[pos - 1] > name:
+                    pos -= 1
+                out_addrs.extend(addrs[prev:pos])
+                out_syms.extend(syms[prev:pos])
+                out_addrs.append(addr)
+                out_syms.append(name)
+                prev = pos
+            out_addrs.extend(addrs[prev:])
+            out_syms.extend(syms[prev:])
+            self._addrs = out_addrs
+            self._syms = out_syms
+        self._pending = []
+
+    def _resolve(self, addr):
+        cache = self._cache
+        ret = cache.get(addr, None)
+        if ret is not None:
+            cache.move_to_end(addr)
+            return ret
+
+        self._merge()
+        ret = None, None, None
+        if 0 <= addr < (1 << 64):
+            idx = bisect.bisect_right(self._addrs, addr) - 1
+            if idx >= 0:
+                saddr, name = self._addrs[idx], self._syms[idx]
+                ret = saddr, name, f"{name}+0x{addr - saddr:x}"
+
+        cache[addr] = ret
+        if len(cache) > self.CACHE_SIZE:
+            cache.popitem(last=False)
+        return ret
+
+    def lookup(self, addr):
+        '''return (address, name) of the closest symbol at or below addr'''
+        saddr, name, text = self._resolve(addr)
+        return saddr, name
+
+    def format(self, addr):
+        '''return "name+0xoffset" for addr, or None'''
+        return self._resolve(addr)[2]
@@ -0,0 +1,315 @@
+# SPDX-License-Identifier: MIT
+import atexit, fnmatch, importlib, os, struct, threading, time
+from collections import namedtuple
+
+from ..utils import *
+from .types import MMIOTraceFlags
+
+__all__ = ["TraceLogWriter", "TraceLogReader", "TraceRecord"]
+
+# File layout:
+#   MAGIC
+#   chunk*: CHUNK header, meta entries (meta_len bytes), count * RECORD
+#
+# Meta entries declare the strings and register maps that records refer to by
+# index. They are cumulative across chunks, so a reader has to scan every chunk
+# header, but can skip record bodies whose summary does not match a query.
+
+MAGIC = b"m1n1TRC\x01"
+CHUNK_MAGIC = b"CHNK"
+
+CHUNK = struct.Struct("<4sIIQQQQQQ")
+META = struct.Struct("<BHH")
+RECORD = struct.Struct("<BBHHHIQQQQ")
+
+META_NAME = 0
+META_REGMAP = 1
+
+KIND_MMIO = 1
+KIND_IRQ = 2
+
+TraceRecord = namedtuple("TraceRecord",
+                         "kind cpu ident dev regmap flags ts pc addr data")
+
+class TraceLogWriter(Reloadable):
+    '''Append-only binary log of MMIO and IRQ trace events
+
+ Records hold the raw event fields; all text formatting happens when the log
+ is viewed (see TraceLogReader and tools/tracelog.py). Safe to call from the
+ async decoder and the main thread at once.'''
+
+    CHUNK_RECORDS = 4096
+
+    def __init__(self, path, addr_lookup=None):
+        self.path = path
+        self.addr_lookup = addr_lookup
+        self.names = {"": 0}
+        self.regmaps = {None: 0}
+        self._regmap_ids = {}
+        self._addr_dev = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(path) and os.path.getsize(path):
+            reader = TraceLogReader(path)
+            self.names.update((v, k) for k, v in enumerate(reader.names) if k)
+            self.regmaps.update((v, k) for k, v in enumerate(reader.regmaps) if k)
+            end = reader.end
+            del reader
+            self.f = open(path, "r+b")
+            self.f.truncate(end)
+            self.f.seek(end)
+        else:
+            self.f = open(path, "wb")
+            self.f.write(MAGIC)
+
+        self._reset()
+        atexit.register(self.close)
+
+    def _reset(self):
+        self._meta = []
+        self._records = []
+        self._cpus = 0
+        self._names = 0
+        self._t = [1 << 64, 0]
+        self._addr = [1 << 64, 0]
+
+    def _name(self, name):
+        idx = self.names.get(name, None)
+        if idx is None:
+            idx = self.names[name] = len(self.names)
+            data = name.encode("utf-8")
+            self._meta.append(META.pack(META_NAME, idx, len(data)) + data)
+        return idx
+
+    def _regmap(self, regmap):
+        if regmap is None:
+            return 0
+        idx = self._regmap_ids.get(id(regmap), None)
+        if idx is not None:
+            return idx
+
+        cls = type(regmap)
+        desc = f"{cls.__module__}:{cls.__qualname__}@{regmap._base:#x}"
+        idx = self.regmaps.get(desc, None)
+        if idx is None:
+            idx = self.regmaps[desc] = len(self.regmaps)
+            data = desc.encode("utf-8")
+            self._meta.append(META.pack(META_REGMAP, idx, len(data)) + data)
+        self._regmap_ids[id(regmap)] = idx
+        return idx
+
+    def _dev(self, addr):
+        idx = self._addr_dev.get(addr, None)
+        if idx is None:
+            if self.addr_lookup is None:
+                idx = 0
+            else:
+                idx = self._name(self.addr_lookup.lookup(addr)[0])
+            self._addr_dev[addr] = idx
+        return idx
+
+    def _append(self, kind, cpu, ident, dev, regmap, flags, pc, addr, data):
+        ts = time.time_ns()
+        self._records.append(RECORD.pack(kind, cpu, ident, dev, regmap, flags, ts, pc, addr, data))
+        self._cpus |= 1 << cpu
+        self._names |= (1 << (ident & 63)) | (1 << (dev & 63))
+        t, a = self._t, self._addr
+        if ts < t[0]: t[0] = ts
+        if ts > t[1]: t[1] = ts
+        if addr < a[0]: a[0] = addr
+        if addr > a[1]: a[1] = addr
+
+        if len(self._records) >= self.CHUNK_RECORDS:
+            self._flush()
+
+    def mmio(self, evt, ident, dev=None, regmap=None):
+        '''record an EvtMMIOTrace (or an equivalent Container)'''
+        flags = int(evt.flags)
+        with self.lock:
+            self._append(KIND_MMIO, (flags >> 16) & 0xff, self._name(ident),
+                         self._dev(evt.addr) if dev is None else self._name(dev),
+                         self._regmap(regmap), flags, evt.pc, evt.addr, evt.data)
+
+    def irq(self, evt, cpu=0, ident="IRQ", dev=None):
+        '''record an EvtIRQTrace, with the IRQ type in addr and number in data'''
+        with self.lock:
+            self._append(KIND_IRQ, cpu, self._name(ident),
+                         0 if dev is None else self._name(dev),
+                         0, evt.flags, 0, evt.type, evt.num)
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._records:
+            return
+        meta = b"".join(self._meta)
+        self.f.write(CHUNK.pack(CHUNK_MAGIC, len(self._records), len(meta), self._cpus,
+                                self._names, *self._t, *self._addr))
+        self.f.write(meta)
+        self.f.write(b"".join(self._records))
+        self.f.flush()
+        self._reset()
+
+    def close(self):
+        with self.lock:
+            if self.f.closed:
+                return
+            self._flush()
+            self.f.close()
+        atexit.unregister(self.close)
+
+class TraceChunk(namedtuple("TraceChunk", "offset count cpus names t_min t_max addr_min addr_max")):
+    def matches(self, addr=None, cpus=None, names=None, t_start=None, t_end=None):
+        if addr is not None and (self.addr_max < addr.start or self.addr_min >= addr.stop):
+            return False
+        if cpus is not None and not self.cpus & cpus:
+            return False
+        if names is not None and not self.names & names:
+            return False
+        if t_start is not None and self.t_max < t_start:
+            return False
+        if t_end is not None and self.t_min >= t_end:
+            return False
+        return True
+
+class TraceLogReader:
+    '''Chunk-indexed reader for TraceLogWriter logs'''
+
+    def __init__(self, path):
+        self.f = open(path, "rb")
+        if self.f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a m1n1 trace log")
+
+        self.names = [""]
+        self.regmaps = [None]
+        self.chunks = []
+        self._regmap_cls = {}
+        self._scan()
+
+    def __del__(self):
+        self.f.close()
+
+    def _scan(self):
+        f = self.f
+        self.end = f.tell()
+        size = os.fstat(f.fileno()).st_size
+        while True:
+            hdr = f.read(CHUNK.size)
+            if len(hdr) < CHUNK.size:
+                break
+            magic, count, meta_len, cpus, names, t_min, t_max, a_min, a_max = CHUNK.unpack(hdr)
+            if magic != CHUNK_MAGIC:
+                break
+            meta = f.read(meta_len)
+            offset = f.tell()
+            body = count * RECORD.size
+            f.seek(body, 1)
+            if len(meta) < meta_len or f.tell() > size:
+                break # truncated chunk, ignored
+
+            pos = 0
+            while pos < meta_len:
+                kind, idx, length = META.unpack_from(meta, pos)
+                pos += META.size
+                value = meta[pos:pos + length].decode("utf-8")
+                pos += length
+                table = self.names if kind == META_NAME else self.regmaps
+                assert idx == len(table)
+                table.append(value)
+
+            self.chunks.append(TraceChunk(offset, count, cpus, names, t_min, t_max, a_min, a_max))
+            self.end = offset + body
+
+    @property
+    def t_first(self):
+        return min((c.t_min for c in self.chunks), default=0)
+
+    def match_names(self, patterns):
+        '''return the name indices matching any of the glob patterns'''
+        return {i for i, name in enumerate(self.names)
+                if name and any(fnmatch.fnmatchcase(name, p) for p in patterns)}
+
+    def records(self, addr=None, cpus=None, devices=None, t_start=None, t_end=None):
+        '''yield TraceRecords matching all the given filters
+
+ addr is a range, cpus a set of CPU numbers, devices a set of name indices
+ matched against either the device or the tracer ident, and t_start/t_end
+ are absolute nanosecond timestamps.'''
+        cpu_mask = None
+        if cpus is not None:
+            cpu_mask = sum(1 << cpu for cpu in cpus)
+        dev_mask = None
+        if devices is not None:
+            dev_mask = 0
+            for dev in devices:
+                dev_mask |= 1 << (dev & 63)
+
+        for chunk in self.chunks:
+            if not chunk.matches(addr, cpu_mask, dev_mask, t_start, t_end):
+                continue
+            self.f.seek(chunk.offset)
+            body = self.f.read(chunk.count * RECORD.size)
+            for rec in RECORD.iter_unpack(body):
+                kind, cpu, ident, dev, regmap, flags, ts, pc, a, data = rec
+                if addr is not None and a not in addr:
+                    continue
+                if cpus is not None and cpu not in cpus:
+                    continue
+                if devices is not None and dev not in devices and ident not in devices:
+                    continue
+                if t_start is not None and ts < t_start:
+                    continue
+                if t_end is not None and ts >= t_end:
+                    continue
+                yield TraceRecord(*rec)
+
+    def _decoder(self, idx):
+        if idx in self._regmap_cls:
+            return self._regmap_cls[idx]
+
+        ret = None
+        desc = self.regmaps[idx]
+        try:
+            path, base = desc.rsplit("@", 1)
+            module, qualname = path.split(":", 1)
+            cls = importlib.import_module(module)
+            for part in qualname.split("."):
+                cls = getattr(cls, part)
+            ret = cls, int(base, 0)
+        except Exception:
+            pass
+
+        self._regmap_cls[idx] = ret
+        return ret
+
+    def format(self, rec, t0=None):
+        '''render a record the way the live tracers print it'''
+        if t0 is None:
+            t0 = self.t_first
+        ts = f"[{(rec.ts - t0) / 1e9:12.6f}]"
+        ident = self.names[rec.ident]
+        dev = self.names[rec.dev]
+
+        if rec.kind == KIND_IRQ:
+            return f"{ts} [{ident}] IRQ: {dev or 'type ' + str(rec.addr)}: {rec.data}"
+
+        flags = MMIOTraceFlags(rec.flags)
+        t = "W" if flags.WRITE else "R"
+        m = "+" if flags.MULTI else " "
+        s = f"0x{rec.addr:x} = 0x{rec.data:x}"
+        if rec.regmap:
+            decoder = self._decoder(rec.regmap)
+            if decoder is not None:
+                cls, base = decoder
+                name, index, rcls = cls.lookup_offset(rec.addr - base)
+                if name is not None:
+                    if index is not None:
+                        name = f"{name}[{index}]"
+                    value = rcls(rec.data) if rcls is not None else rec.data
+                    s = f"{name} = {value!s}"
+        if dev:
+            s += f" ({dev})"
+        return (f"{ts} [cpu{rec.cpu}] [{ident}] [0x{rec.pc:016x}] MMIO: "
+                f"{t}.{1<<flags.WIDTH:<2}{m} {s}")
@@ -6,7 +6,7 @@ from ..utils import *
 
 __all__ = [
     "MMIOTraceFlags", "EvtMMIOTrace", "EvtIRQTrace", "HV_EVENT",
-    "VMProxyHookData", "TraceMode",
+    "VMProxyHookData", "TraceMode", "MSRPolicy",
 ]
 
 class MMIOTraceFlags(Register32):
@@ -59,3 +59,15 @@ Different types of Tracing '''
     SYNC = 5
     HOOK = 6
     RESERVED = 7
+
+class MSRPolicy(IntEnum):
+    '''
+How trapped system register accesses are handled '''
+
+    PASS = 0        # forwarded to the real register
+    SHADOW = 1      # kept per CPU in hv.sysreg
+    SKIP = 2        # reads as zero, writes ignored
+    RO = 3          # passed through on read, writes ignored
+    XLATE = 4       # address operand translated from IPA to PA
+    HANDLER = 5     # hv.msr_handlers
+    CYC_OVRD = 6
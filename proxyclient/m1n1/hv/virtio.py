@@ -1,12 +1,19 @@
 # SPDX-License-Identifier: MIT
-from construct import Struct, Int8ul, Int16ul, Int32sl, Int32ul, Int64ul
+from construct import Container, Struct, Int8ul, Int16ul, Int32sl, Int32ul, Int64ul
 from subprocess import Popen, PIPE
+from enum import IntEnum
+import collections
+import functools
+import mmap
 import pathlib
 import struct
 import os
 import sys
+import threading
+import time
 
 from ..utils import *
+from .ninep import NinePServer
 
 VirtioConfig = Struct(
     "irq" / Int32sl,
@@ -32,14 +39,40 @@ VirtioDesc = Struct(
 VirtioExcInfo = Struct(
     "devbase" / Int64ul,
     "qu" / Int16ul,
-    "idx" / Int16ul,
-    "pad" / Int32ul, 
+    "start" / Int16ul,
+    "count" / Int16ul,
+    "size" / Int16ul,
     "descbase" / Int64ul,
+    "availbase" / Int64ul,
 )
 
+VIRTIO_DESC = struct.Struct("<QIHH")
+VIRTIO_QMAX = 256
+
+def coalesce(descs):
+    '''merge (addr, len) buffers that are contiguous in memory'''
+    runs = []
+    for addr, size in descs:
+        if runs and runs[-1][0] + runs[-1][1] == addr:
+            runs[-1][1] += size
+        else:
+            runs.append([addr, size])
+    return runs
+
 class VirtioDev:
+    '''Base class for virtio devices backed by Python
+
+ Each queue notification hands over every buffer the guest made available
+ since the last one. handle_exc() fetches the descriptor table and the
+ available ring, walks each chain and calls handle_request() with the
+ driver (read) and device (write) buffers as (addr, len) lists. Writes to
+ guest buffers are queued by scatter() and merged across requests, then all
+ used buffers are returned to the guest at once.'''
+
     def __init__(self):
         self.base, self.hv = None, None # assigned by HV object
+        self._used_buf = None
+        self._writes = []
 
     def read_buf(self, desc):
         return self.hv.iface.readmem(desc.addr, desc.len)
@@ -48,6 +81,100 @@ class VirtioDev:
         off = VirtioDesc.sizeof() * idx
         return self.hv.iface.readstruct(ctx.descbase + off, VirtioDesc)
 
+    def gather(self, descs):
+        '''read and concatenate (addr, len) buffers'''
+        return b"".join(self.hv.iface.readmem(addr, size) for addr, size in coalesce(descs))
+
+    def scatter(self, descs, data):
+        '''queue data to be written across (addr, len) buffers, returns the
+ length that fits'''
+        written = 0
+        for addr, size in coalesce(descs):
+            if written >= len(data):
+                break
+            chunk = data[written:written + size]
+            self._writes.append((addr, chunk))
+            written += len(chunk)
+        return written
+
+    def flush_writes(self):
+        '''write out queued guest buffers, merging adjacent ones'''
+        writes, self._writes = sorted(self._writes, key=lambda w: w[0]), []
+        start = end = None
+        run = []
+        for addr, data in writes:
+            if run and addr != end:
+                self.hv.iface.writemem(start, b"".join(run))
+                run = []
+            if not run:
+                start = end = addr
+            run.append(data)
+            end += len(data)
+        if run:
+            self.hv.iface.writemem(start, b"".join(run))
+
+    def read_queue(self, ctx):
+        '''return the descriptor table and the newly available chain heads'''
+        table = VIRTIO_DESC.size * ctx.size
+        ring = 4 + 2 * ctx.size
+        gap = ctx.availbase - ctx.descbase - table
+        if 0 <= gap < 0x1000:
+            # Split rings are usually laid out back to back, fetch both at once
+            data = self.hv.iface.readmem(ctx.descbase, table + gap + ring)
+            descs, avail = data[:table], data[table + gap:]
+        else:
+            descs = self.hv.iface.readmem(ctx.descbase, table)
+            avail = self.hv.iface.readmem(ctx.availbase, ring)
+
+        slots = struct.unpack_from(f"<{ctx.size}H", avail, 4)
+        heads = [slots[(ctx.start + i) % ctx.size] for i in range(ctx.count)]
+        return list(VIRTIO_DESC.iter_unpack(descs)), heads
+
+    def chains(self, ctx):
+        '''yield (head, driver buffers, device buffers) for each available chain'''
+        descs, heads = self.read_queue(ctx)
+        for head in heads:
+            rd, wr = [], []
+            idx = head
+            for _ in range(len(descs)):
+                addr, size, flags, nxt = descs[idx]
+                (wr if flags & (1 << VirtioDescFlags.WRITE) else rd).append((addr, size))
+                if not flags & (1 << VirtioDescFlags.NEXT):
+                    break
+                idx = nxt
+            yield head, rd, wr
+
+    def put_buffers(self, ctx, used):
+        '''return (head, written length) pairs to the used ring'''
+        if not used:
+            return
+        if len(used) == 1:
+            self.hv.p.virtio_put_buffer(ctx.devbase, ctx.qu, *used[0])
+            return
+        if self._used_buf is None:
+            self._used_buf = self.hv.u.heap.malloc(8 * VIRTIO_QMAX)
+        for i in range(0, len(used), VIRTIO_QMAX):
+            batch = used[i:i + VIRTIO_QMAX]
+            self.hv.iface.writemem(self._used_buf,
+                                   b"".join(struct.pack("<II", *u) for u in batch))
+            self.hv.p.virtio_put_buffers(ctx.devbase, ctx.qu, self._used_buf, len(batch))
+
+    def handle_request(self, rd, wr):
+        '''process one request, returns the length of the response'''
+        raise NotImplementedError()
+
+    def handle_exc(self, ctx):
+        used = []
+        for head, rd, wr in self.chains(ctx):
+            used.append((head, self.handle_request(rd, wr)))
+        self.flush_writes()
+        self.put_buffers(ctx, used)
+        return True
+
+    def poll(self):
+        '''return buffers completed outside of a notification, if any'''
+        return False
+
     @property
     def config_data(self):
         return b""
@@ -64,23 +191,16 @@ class VirtioDev:
     def feats(self):
         return 0
 
-class Virtio9PTransport(VirtioDev):
+class Virtio9PDev(VirtioDev):
     def __init__(self, tag="m1n1", root=None):
-        p_stdin, self.fin = os.pipe()
-        self.fout, p_stdout = os.pipe()
+        super().__init__()
         if root is None:
             root = str(pathlib.Path(__file__).resolve().parents[3])
+        self.root = root
         if type(tag) is str:
             self.tag = tag.encode("ascii")
         else:
             self.tag = tag
-        self.p = Popen([
-            "u9fs",
-            "-a", "none", # no auth
-            "-n", # not a network conn
-            "-u", os.getlogin(), # single user
-            root,
-        ], stdin=p_stdin, stdout=p_stdout, stderr=sys.stderr)
 
     @property
     def config_data(self):
@@ -98,36 +218,294 @@ class Virtio9PTransport(VirtioDev):
     def feats(self):
         return 1
 
+class Virtio9PTransport(Virtio9PDev):
+    '''9P transport backed by a u9fs process over pipes'''
+
+    def __init__(self, tag="m1n1", root=None):
+        super().__init__(tag, root)
+        p_stdin, self.fin = os.pipe()
+        self.fout, p_stdout = os.pipe()
+        self.p = Popen([
+            "u9fs",
+            "-a", "none", # no auth
+            "-n", # not a network conn
+            "-u", os.getlogin(), # single user
+            self.root,
+        ], stdin=p_stdin, stdout=p_stdout, stderr=sys.stderr)
+
+    def _read(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = os.read(self.fout, size - len(data))
+            if not chunk:
+                raise EOFError("9P server exited")
+            data += chunk
+        return data
+
     def call(self, req):
         os.write(self.fin, req)
-        resp = os.read(self.fout, 4)
+        resp = self._read(4)
         length = int.from_bytes(resp, byteorder="little")
-        resp += os.read(self.fout, length - 4)
+        resp += self._read(length - 4)
         return resp
 
+    def handle_request(self, rd, wr):
+        assert rd
+
+        resp = self.call(self.gather(rd))
+        self.scatter(wr, resp)
+        return len(resp)
+
+class Virtio9PServer(Virtio9PDev):
+    '''9P transport served in-process by a NinePServer
+
+ Requests are queued to the server's thread pool and the exit returns once
+ they are all answered or GRACE seconds have passed. Requests still running
+ then are completed on a later exit: the server kicks the HV once they are
+ done, so a slow host operation no longer stalls the guest.'''
+
+    GRACE = 0.002
+
+    def __init__(self, tag="m1n1", root=None, workers=4):
+        super().__init__(tag, root)
+        self.server = NinePServer(self.root, workers)
+        self._done = collections.deque()
+        self._cond = threading.Condition()
+
+    def _complete(self, qu, head, wr, batch, resp):
+        # Called from the server threads
+        self._done.append((qu, head, wr, resp))
+        with self._cond:
+            batch[0] -= 1
+            self._cond.notify_all()
+        if self.hv is not None and not batch[1]:
+            self.hv.kick_virtio()
+
     def handle_exc(self, ctx):
-        head = self.read_desc(ctx, ctx.idx)
-        assert not head.flags.WRITE
+        # Outstanding requests, and whether handle_exc() is still waiting
+        batch = [0, True]
+        for head, rd, wr in self.chains(ctx):
+            with self._cond:
+                batch[0] += 1
+            self.server.submit(self.gather(rd),
+                               functools.partial(self._complete, ctx.qu, head, wr, batch))
+        with self._cond:
+            self._cond.wait_for(lambda: batch[0] == 0, timeout=self.GRACE)
+            batch[1] = False
+        self.poll()
+        return True
 
-        req = bytearray()
+    def poll(self):
+        used = {}
+        while self._done:
+            qu, head, wr, resp = self._done.popleft()
+            used.setdefault(qu, []).append((head, self.scatter(wr, resp)))
+        if not used:
+            return False
 
-        while not head.flags.WRITE:
-            req += self.read_buf(head)
+        self.flush_writes()
+        for qu, bufs in used.items():
+            self.put_buffers(Container(devbase=self.base, qu=qu), bufs)
+        return True
 
-            if not head.flags.NEXT:
-                break
-            head = self.read_desc(ctx, head.next)
+    def close(self):
+        self.server.close()
 
-        resp = self.call(bytes(req))
-        resplen = len(resp)
+class VirtioBlkReq(IntEnum):
+    IN = 0
+    OUT = 1
+    FLUSH = 4
+    GET_ID = 8
 
-        while len(resp):
-            self.hv.iface.writemem(head.addr, resp[:head.len])
-            resp = resp[head.len:]
-            if not head.flags.NEXT:
-                break
-            head = self.read_desc(ctx, head.next)
+class VirtioBlkStatus(IntEnum):
+    OK = 0
+    IOERR = 1
+    UNSUPP = 2
+
+VirtioBlkReqHeader = struct.Struct("<IIQ")
+
+class VirtioBlk(VirtioDev):
+    '''virtio-blk device backed by an mmap'd disk image
+
+ With an overlay path, the image is opened read-only and writes go to a
+ sparse overlay file of the same size instead, copied in CLUSTER sized
+ blocks. The blocks present in the overlay are tracked in a bitmap stored
+ next to it (overlay + ".map"), so the overlay can be reused across runs.'''
+
+    SECTOR = 512
+    CLUSTER = 4096
+
+    F_SEG_MAX = 1 << 2
+    F_RO = 1 << 5
+    F_BLK_SIZE = 1 << 6
+    F_FLUSH = 1 << 9
+
+    def __init__(self, image, overlay=None, readonly=False, serial="m1n1"):
+        super().__init__()
+        self.readonly = readonly and overlay is None
+        writable = not readonly and overlay is None
+        self._image_file = open(image, "r+b" if writable else "rb")
+        self.size = os.fstat(self._image_file.fileno()).st_size // self.SECTOR * self.SECTOR
+        self.image = mmap.mmap(self._image_file.fileno(), self.size,
+                               access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        self.serial = serial.encode("ascii")[:20] if isinstance(serial, str) else serial[:20]
+
+        self.overlay = self.map = None
+        if overlay is not None:
+            clusters = align_up(self.size, self.CLUSTER) // self.CLUSTER
+            self._overlay_file = self._open_sized(overlay, self.size)
+            self._map_file = self._open_sized(str(overlay) + ".map", align_up(clusters, 8) // 8)
+            self.overlay = mmap.mmap(self._overlay_file.fileno(), self.size)
+            self.map = mmap.mmap(self._map_file.fileno(), 0)
+
+        # type -> [requests, bytes, total seconds, max seconds]
+        self.stats = {}
+
+    @staticmethod
+    def _open_sized(path, size):
+        f = open(path, "r+b" if os.path.exists(path) else "w+b")
+        if os.fstat(f.fileno()).st_size < size:
+            f.truncate(size)
+        return f
+
+    @property
+    def config_data(self):
+        # capacity, size_max, seg_max, geometry, blk_size
+        return struct.pack("<QIIHBBI", self.size // self.SECTOR, 0, VIRTIO_QMAX - 2,
+                           0, 0, 0, self.SECTOR)
+
+    @property
+    def devid(self):
+        return 2
+
+    @property
+    def feats(self):
+        feats = self.F_SEG_MAX | self.F_BLK_SIZE | self.F_FLUSH
+        if self.readonly:
+            feats |= self.F_RO
+        return feats
+
+    def _in_overlay(self, cluster):
+        return self.map[cluster >> 3] & (1 << (cluster & 7))
+
+    def read(self, offset, size):
+        '''read from the disk, picking runs of clusters from the overlay or the image'''
+        if self.overlay is None:
+            return self.image[offset:offset + size]
+
+        chunks = []
+        end = offset + size
+        while offset < end:
+            cluster = offset // self.CLUSTER
+            src = self.overlay if self._in_overlay(cluster) else self.image
+            stop = (cluster + 1) * self.CLUSTER
+            while stop < end and bool(self._in_overlay(stop // self.CLUSTER)) == (src is self.overlay):
+                stop += self.CLUSTER
+            stop = min(stop, end)
+            chunks.append(src[offset:stop])
+            offset = stop
+        return b"".join(chunks)
+
+    def write(self, offset, data):
+        '''write to the disk, copying partially written clusters to the overlay first'''
+        if self.overlay is None:
+            self.image[offset:offset + len(data)] = data
+            return
+
+        end = offset + len(data)
+        for cluster in range(offset // self.CLUSTER, (end - 1) // self.CLUSTER + 1):
+            if self._in_overlay(cluster):
+                continue
+            start = cluster * self.CLUSTER
+            if start < offset or start + self.CLUSTER > end:
+                self.overlay[start:start + self.CLUSTER] = self.image[start:start + self.CLUSTER]
+            self.map[cluster >> 3] |= 1 << (cluster & 7)
+        self.overlay[offset:end] = data
+
+    def flush(self):
+        if self.overlay is not None:
+            self.overlay.flush()
+            self.map.flush()
+        elif not self.readonly:
+            self.image.flush()
+
+    def close(self):
+        self.flush()
+        for m in (self.image, self.overlay, self.map):
+            if m is not None:
+                m.close()
+        self._image_file.close()
+        if self.overlay is not None:
+            self._overlay_file.close()
+            self._map_file.close()
 
-        self.hv.p.virtio_put_buffer(ctx.devbase, ctx.qu, ctx.idx, resplen)
+    def _request(self, rd, wr):
+        req = self.gather(rd)
+        rtype, _, sector = VirtioBlkReqHeader.unpack_from(req)
+        offset = sector * self.SECTOR
+        # The last device writable byte is the status
+        space = sum(size for addr, size in wr) - 1
 
+        if rtype == VirtioBlkReq.IN:
+            if offset + space > self.size:
+                return rtype, 0, b"", VirtioBlkStatus.IOERR
+            return rtype, space, self.read(offset, space), VirtioBlkStatus.OK
+
+        if rtype == VirtioBlkReq.OUT:
+            data = req[VirtioBlkReqHeader.size:]
+            if self.readonly or offset + len(data) > self.size:
+                return rtype, 0, b"", VirtioBlkStatus.IOERR
+            self.write(offset, data)
+            return rtype, len(data), b"", VirtioBlkStatus.OK
+
+        if rtype == VirtioBlkReq.FLUSH:
+            self.flush()
+            return rtype, 0, b"", VirtioBlkStatus.OK
+
+        if rtype == VirtioBlkReq.GET_ID:
+            return rtype, 0, self.serial.ljust(20, b"\0")[:space], VirtioBlkStatus.OK
+
+        return rtype, 0, b"", VirtioBlkStatus.UNSUPP
+
+    def _respond(self, wr, data, status):
+        self.scatter(wr, data)
+        # The status goes in the last device writable byte
+        addr, size = wr[-1]
+        self.scatter([(addr + size - 1, 1)], bytes([status]))
+        return len(data) + 1
+
+    def handle_request(self, rd, wr):
+        rtype, nbytes, data, status = self._request(rd, wr)
+        return self._respond(wr, data, status)
+
+    def handle_exc(self, ctx):
+        start = time.perf_counter()
+        done = []
+        used = []
+        for head, rd, wr in self.chains(ctx):
+            rtype, nbytes, data, status = self._request(rd, wr)
+            used.append((head, self._respond(wr, data, status)))
+            done.append((rtype, nbytes))
+        self.flush_writes()
+        self.put_buffers(ctx, used)
+
+        # Requests complete when the batch is returned to the guest
+        latency = time.perf_counter() - start
+        for rtype, nbytes in done:
+            try:
+                name = VirtioBlkReq(rtype).name.lower()
+            except ValueError:
+                name = "other"
+            st = self.stats.setdefault(name, [0, 0, 0., 0.])
+            st[0] += 1
+            st[1] += nbytes
+            st[2] += latency
+            st[3] = max(st[3], latency)
         return True
+
+    def format_stats(self):
+        lines = []
+        for name, (count, nbytes, total, peak) in sorted(self.stats.items()):
+            lines.append(f"{name:>6}: {count:8d} requests {nbytes / 1048576:10.1f} MiB "
+                         f"avg {total / count * 1e6:8.1f}us max {peak * 1e6:8.1f}us")
+        return "\n".join(lines)
@@ -1,5 +1,14 @@
 # SPDX-License-Identifier: MIT
-from m1n1.utils import align_up
+import bisect
+from collections import Counter
+
+from ..utils import align_up
+
+__all__ = ["ResourceIndex", "collect_aic_irqs_in_use", "usable_aic_irq_range",
+	   "alloc_aic_irq", "usable_mmio_range", "alloc_mmio_base"]
+
+TRANSLATION_PROPS = ("ranges", "#address-cells", "#size-cells")
+RESOURCE_PROPS = ("reg", "interrupts", "interrupt-parent")
 
 def collect_aic_irqs_in_use(adt):
 	used = set()
@@ -21,23 +30,177 @@ def usable_aic_irq_range(adt):
 	}.get(adt["/arm-io/aic"].compatible[0])
 
 def alloc_aic_irq(adt):
-	used = collect_aic_irqs_in_use(adt)
-	for no in usable_aic_irq_range(adt):
-		if no not in used:
-			return no
-	return None
+	index = ResourceIndex(adt)
+	try:
+		return index.alloc_aic_irq()
+	finally:
+		index.close()
 
 def usable_mmio_range(adt):
 	arm_io_range = adt["arm-io"].ranges[0]
 	return range(arm_io_range.parent_addr, arm_io_range.parent_addr + arm_io_range.size)
 
 def alloc_mmio_base(adt, size, alignment=0x4000):
-	span = usable_mmio_range(adt)
-	la = adt.build_addr_lookup()
-	for zone, devs in la.populate(span):
-		if len(devs) != 0:
-			continue
-		base = align_up(zone.start, alignment)
-		if zone.stop > base + size:
-			return base
-	return None
+	index = ResourceIndex(adt)
+	try:
+		return index.alloc_mmio_base(size, alignment)
+	finally:
+		index.close()
+
+class ResourceIndex:
+	'''Used MMIO ranges and AIC IRQs of an ADT, for allocating free ones
+
+	The tree is walked once, after which the index follows changes to the
+	ADT node by node (see ADTNode.track_changes()), so that allocations do
+	not rescan it. Keep one around to allocate for several devices.'''
+	def __init__(self, adt):
+		self.adt = adt
+		self.changes = adt.track_changes()
+		self._build()
+
+	def close(self):
+		'''Stop following changes to the ADT'''
+		self.adt.untrack_changes(self.changes)
+
+	def _build(self):
+		self.aic_phandle = getattr(self.adt["/arm-io/aic"], "AAPL,phandle")
+		self.mmio_span = usable_mmio_range(self.adt)
+		self.irq_span = usable_aic_irq_range(self.adt)
+		self.nodes = {}
+		self.children = {}
+		self.mmio = Counter()
+		self.irq_count = Counter()
+		self.irqs = []
+		self._gaps = None
+		self._add_tree(self.adt)
+
+	def _scan(self, node):
+		span = self.mmio_span
+		ranges = []
+		for zone, name in node._reg_entries():
+			start, stop = max(zone.start, span.start), min(zone.stop, span.stop)
+			if start < stop:
+				ranges.append((start, stop))
+		irqs = ()
+		if getattr(node, "interrupt_parent", None) == self.aic_phandle:
+			irqs = tuple(getattr(node, "interrupts", ()))
+		return ranges, irqs
+
+	def _add(self, node):
+		ranges, irqs = self.nodes[node] = self._scan(node)
+		if ranges:
+			self.mmio.update(ranges)
+			self._gaps = None
+		for no in irqs:
+			self.irq_count[no] += 1
+			if self.irq_count[no] == 1:
+				bisect.insort(self.irqs, no)
+
+	def _remove(self, node):
+		ranges, irqs = self.nodes.pop(node)
+		if ranges:
+			self.mmio.subtract(ranges)
+			for r in ranges:
+				if not self.mmio[r]:
+					del self.mmio[r]
+			self._gaps = None
+		for no in irqs:
+			self.irq_count[no] -= 1
+			if not self.irq_count[no]:
+				del self.irq_count[no]
+				del self.irqs[bisect.bisect_left(self.irqs, no)]
+
+	@staticmethod
+	def _walk(node):
+		# Unlike ADTNode.walk_tree(), visit every level of the subtree
+		stack = [node]
+		while stack:
+			n = stack.pop()
+			yield n
+			stack.extend(n)
+
+	def _add_tree(self, node):
+		for n in self._walk(node):
+			self._add(n)
+			self.children[n] = list(n)
+
+	def _remove_tree(self, node):
+		# Use the children as they were when indexed, the subtree may have
+		# changed since it was detached
+		stack = [node]
+		while stack:
+			n = stack.pop()
+			self._remove(n)
+			stack.extend(self.children.pop(n))
+
+	def update(self):
+		'''Apply the changes made to the ADT since the last update'''
+		props, children = self.changes.take()
+		if any(node is self.adt["/arm-io/aic"] or (node is self.adt["/arm-io"] and name == "ranges")
+		       for node, name in props):
+			self._build()
+			return
+
+		for node in children:
+			if node not in self.nodes:
+				continue
+			old, new = self.children[node], list(node)
+			for child in set(old) - set(new):
+				self._remove_tree(child)
+			for child in set(new) - set(old):
+				self._add_tree(child)
+			self.children[node] = new
+
+		for node, name in props:
+			if node not in self.nodes:
+				continue
+			if name in TRANSLATION_PROPS:
+				for n in self._walk(node):
+					self._remove(n)
+					self._add(n)
+			elif name in RESOURCE_PROPS:
+				self._remove(node)
+				self._add(node)
+
+	def _mmio_gaps(self):
+		if self._gaps is None:
+			starts, stops, longest = [], [], []
+			pos, span = self.mmio_span.start, self.mmio_span
+			for start, stop in sorted(self.mmio) + [(span.stop, span.stop)]:
+				if start > pos:
+					starts.append(pos)
+					stops.append(start)
+					longest.append(max(start - pos, longest[-1] if longest else 0))
+				pos = max(pos, stop)
+			self._gaps = starts, stops, longest
+		return self._gaps
+
+	def alloc_mmio_base(self, size, alignment=0x4000):
+		'''Return the lowest aligned base of a free MMIO range of size bytes'''
+		self.update()
+		starts, stops, longest = self._mmio_gaps()
+		# longest[i] is the longest of the first i + 1 gaps, so this finds
+		# the first gap that could hold size bytes
+		for i in range(bisect.bisect_right(longest, size), len(starts)):
+			base = align_up(starts[i], alignment)
+			if stops[i] > base + size:
+				return base
+		return None
+
+	def alloc_aic_irq(self):
+		'''Return the lowest AIC IRQ number that is not in use'''
+		self.update()
+		first = self.irq_span.start
+		used = self.irqs
+		# used[k] - k only grows, find the first k past a run of used IRQs
+		# starting at first
+		lo = base = bisect.bisect_left(used, first)
+		hi = len(used)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if used[mid] - (mid - base) > first:
+				hi = mid
+			else:
+				lo = mid + 1
+		no = first + lo - base
+		return no if no in self.irq_span else None
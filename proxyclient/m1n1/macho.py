@@ -1,12 +1,13 @@
 # SPDX-License-Identifier: MIT
-from io import BytesIO, SEEK_END, SEEK_SET
-import bisect
+from io import BytesIO, SEEK_END, SEEK_SET, UnsupportedOperation
+from array import array
+import bisect, mmap, os, struct, threading
 from construct import *
 import subprocess
 
 from .utils import *
 
-__all__ = ["MachO"]
+__all__ = ["MachO", "Demangler"]
 
 MachOLoadCmdType = "LoadCmdType" / Enum(Int32ul,
     SYMTAB = 0x02,
@@ -69,6 +70,13 @@ NList = Struct(
     "n_value" / Hex(Int64ul),
 )
 
+NLIST = struct.Struct("<IBBhQ")
+
+# Symbol cache files: magic, nsyms, strsize, symbol count, then the addresses
+# and the NUL separated names
+SYMCACHE_MAGIC = b"M1N1SYM1"
+SYMCACHE_HEADER = struct.Struct("<8sIIQ")
+
 MachOCmdSegment64 = Struct(
     "segname" / PaddedString(16, "ascii"),
     "vmaddr" / Hex(Int64ul),
@@ -119,6 +127,105 @@ MachOFile = Struct(
     "cmds" / Array(this.header.ncmds, MachOCmd),
 )
 
+class Demangler:
+    '''Demangle C++ symbol names through a persistent c++filt process
+
+ Names are written to c++filt's stdin in batches, one per line, and only
+ names with an Itanium mangling prefix (_Z, __Z, ...) are sent at all. If
+ M1N1SYMCACHE names a directory, results are also kept in demangle.txt
+ there, so each name is only ever demangled once.'''
+
+    BATCH = 0x10000
+
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = os.environ.get("M1N1SYMCACHE", "")
+        self.cache_path = os.path.join(cache_dir, "demangle.txt") if cache_dir else None
+        self.cache = None
+        self.proc = None
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc = None
+
+    @staticmethod
+    def mangled(name):
+        return name.lstrip("_").startswith("Z") and name.startswith("_")
+
+    def _load_cache(self):
+        self.cache = {}
+        if self.cache_path is None:
+            return
+        try:
+            with open(self.cache_path, "r", encoding="ascii") as fd:
+                for line in fd:
+                    mangled, sep, demangled = line.rstrip("\n").partition("\t")
+                    if sep:
+                        self.cache[mangled] = demangled
+        except FileNotFoundError:
+            pass
+
+    def _store_cache(self, pairs):
+        if self.cache_path is None or not pairs:
+            return
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        # One append per batch, so concurrent sessions do not interleave lines
+        with open(self.cache_path, "a", encoding="ascii") as fd:
+            fd.write("".join(f"{mangled}\t{demangled}\n" for mangled, demangled in pairs))
+
+    def _filt(self, names):
+        if self.proc is None:
+            self.proc = subprocess.Popen(["c++filt"], stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+        proc = self.proc
+
+        # Feed stdin from a thread so that neither pipe can fill up and stall
+        def writer():
+            proc.stdin.write(("\n".join(names) + "\n").encode("ascii"))
+            proc.stdin.flush()
+
+        thread = threading.Thread(target=writer, daemon=True)
+        thread.start()
+        chunks = []
+        lines = 0
+        try:
+            while lines < len(names):
+                chunk = proc.stdout.read1(0x10000)
+                if not chunk:
+                    self.close()
+                    raise Exception("c++filt exited unexpectedly")
+                chunks.append(chunk)
+                lines += chunk.count(b"\n")
+        finally:
+            thread.join()
+        return b"".join(chunks).decode("ascii").split("\n")[:-1]
+
+    def demangle(self, names):
+        '''return the demangled form of each name in names'''
+        if self.cache is None:
+            self._load_cache()
+        cache = self.cache
+
+        todo = list({name for name in names if name not in cache and self.mangled(name)})
+        for i in range(0, len(todo), self.BATCH):
+            batch = todo[i:i + self.BATCH]
+            pairs = list(zip(batch, self._filt(batch)))
+            cache.update(pairs)
+            self._store_cache(pairs)
+
+        return [cache.get(name, name) for name in names]
+
+_demangler = None
+
+def demangle_names(names):
+    '''demangle names with a shared Demangler'''
+    global _demangler
+    if _demangler is None:
+        _demangler = Demangler()
+    return _demangler.demangle(names)
+
 class MachO:
     def __init__(self, data):
         if isinstance(data, bytes):
@@ -133,6 +240,7 @@ class MachO:
         self.io.seek(self.off, SEEK_SET)
         self.obj = MachOFile.parse_stream(self.io)
         self.symbols = {}
+        self._view = None
         self.load_info()
         self.load_fileset()
 
@@ -146,30 +254,64 @@ class MachO:
             elif cmd.cmd == MachOLoadCmdType.UNIXTHREAD:
                 self.entry = cmd.args[0].data.pc
 
-    def prepare_image(self, load_hook=None):
+    def view(self):
+        '''Return a memoryview of the whole file, mapped rather than read if possible'''
+        if self._view is None:
+            if isinstance(self.io, BytesIO):
+                self._view = self.io.getbuffer()
+            else:
+                try:
+                    self._view = memoryview(mmap.mmap(self.io.fileno(), 0, access=mmap.ACCESS_READ))
+                except (AttributeError, OSError, ValueError, UnsupportedOperation):
+                    self.io.seek(0)
+                    self._view = memoryview(self.io.read())
+        return self._view
+
+    def load_size(self):
+        '''Return the size of the image built by segments()/prepare_image()'''
         memory_size = self.vmax - self.vmin
-
-        image = bytearray(memory_size)
-
         for cmd in self.get_cmds(MachOLoadCmdType.SEGMENT_64):
+            size = min(self.size, cmd.args.fileoff + cmd.args.filesize) - cmd.args.fileoff
+            if cmd.args.segname == "PYLD" and cmd.args.vmsize > size:
+                memory_size -= cmd.args.vmsize - size - 4
+        return memory_size
+
+    def segments(self, load_hook=None):
+        '''Yield (offset, data, clear) for each segment
+
+ data is to be loaded at offset from vmin, followed by clear zero bytes. The
+ clear bytes run up to the next segment, so the gaps between segments are
+ zeroed as in prepare_image(). Unless load_hook changes it, data is a view of
+ the file.'''
+        view = self.view()
+        cmds = list(self.get_cmds(MachOLoadCmdType.SEGMENT_64))
+        starts = sorted(cmd.args.vmaddr - self.vmin for cmd in cmds)
+        image_size = self.load_size()
+        for cmd in cmds:
             dest = cmd.args.vmaddr - self.vmin
             end = min(self.size, cmd.args.fileoff + cmd.args.filesize)
             size = end - cmd.args.fileoff
             print(f"LOAD: {cmd.args.segname} {size} bytes from {cmd.args.fileoff:x} to {dest:x}")
-            self.io.seek(self.off + cmd.args.fileoff)
-            data = self.io.read(size)
+            data = view[self.off + cmd.args.fileoff:self.off + end]
             if load_hook is not None:
-                data = load_hook(data, cmd.args.segname, size, cmd.args.fileoff, dest)
-            image[dest:dest + size] = data
-            if cmd.args.vmsize > size:
+                data = load_hook(bytes(data), cmd.args.segname, size, cmd.args.fileoff, dest)
+            i = bisect.bisect_right(starts, dest)
+            clearsize = (starts[i] if i < len(starts) else image_size) - (dest + size)
+            clear = 0
+            if cmd.args.segname == "PYLD" and cmd.args.vmsize > size:
                 clearsize = cmd.args.vmsize - size
-                if cmd.args.segname == "PYLD":
-                    print("SKIP: %d bytes from 0x%x to 0x%x" % (clearsize, dest + size, dest + size + clearsize))
-                    memory_size -= clearsize - 4 # leave a payload end marker
-                    image = image[:memory_size]
-                else:
-                    print("ZERO: %d bytes from 0x%x to 0x%x" % (clearsize, dest + size, dest + size + clearsize))
-                    image[dest + size:dest + cmd.args.vmsize] = bytes(clearsize)
+                print("SKIP: %d bytes from 0x%x to 0x%x" % (clearsize, dest + size, dest + size + clearsize))
+                clear = 4 # leave a payload end marker
+            elif clearsize > 0:
+                print("ZERO: %d bytes from 0x%x to 0x%x" % (clearsize, dest + size, dest + size + clearsize))
+                clear = clearsize
+            yield dest, data, clear
+
+    def prepare_image(self, load_hook=None):
+        image = bytearray(self.load_size())
+
+        for dest, data, clear in self.segments(load_hook):
+            image[dest:dest + len(data)] = data
 
         return image
 
@@ -197,6 +339,8 @@ class MachO:
                 self.symbols[f"{fe.args.name}:{seg.args.segname}"] = seg.args.vmaddr
 
     def add_symbols(self, filename, syms, demangle=False):
+        '''Add the symbols of syms, a separate symbol file for the fileset entry
+        filename, to self.symbols. Returns the name -> address pairs it set.'''
         try:
             subfile = self.subfiles[filename]
         except KeyError:
@@ -210,6 +354,7 @@ class MachO:
         symtab = [(v, k) for (k, v) in syms.symbols.items()]
         symtab.sort()
 
+        added = {}
         for seg in subfile.get_cmds(MachOLoadCmdType.SEGMENT_64):
             if seg.args.segname not in sym_segs:
                 continue
@@ -221,38 +366,88 @@ class MachO:
 
             for addr, sym in symtab[start:end]:
                 sname = f"{filename}:{sym}"
-                self.symbols[sname] = addr - sym_seg.args.vmaddr + seg.args.vmaddr
+                self.symbols[sname] = added[sname] = addr - sym_seg.args.vmaddr + seg.args.vmaddr
 
-    def load_symbols(self, demangle=False):
-        self.symbols = {}
+        return added
 
-        cmd = self.get_cmd(MachOLoadCmdType.SYMTAB)
+    @property
+    def uuid(self):
+        for cmd in self.get_cmds(MachOLoadCmdType.UUID):
+            return cmd.args
+        return None
 
-        nsyms = cmd.args.nsyms
-        length = NList.sizeof() * nsyms
-        self.io.seek(self.off + cmd.args.symoff)
-        symdata = self.io.read(length)
+    def _symcache_path(self):
+        cache_dir = os.environ.get("M1N1SYMCACHE", "")
+        if not cache_dir or self.uuid is None:
+            return None
+        return os.path.join(cache_dir, self.uuid.hex() + ".sym")
 
-        symbols = Array(nsyms, NList).parse(symdata)
+    def _symcache_load(self, path, cmd):
+        try:
+            with open(path, "rb") as fd:
+                data = fd.read()
+        except FileNotFoundError:
+            return None
+        if len(data) < SYMCACHE_HEADER.size:
+            return None
+        magic, nsyms, strsize, count = SYMCACHE_HEADER.unpack_from(data)
+        if (magic, nsyms, strsize) != (SYMCACHE_MAGIC, cmd.args.nsyms, cmd.args.strsize):
+            return None
+        addrs = array("Q")
+        names_off = SYMCACHE_HEADER.size + 8 * count
+        addrs.frombytes(data[SYMCACHE_HEADER.size:names_off])
+        names = data[names_off:].decode("ascii").split("\x00") if count else []
+        if len(addrs) != count or len(names) != count:
+            return None
+        return dict(zip(names, addrs))
+
+    def _symcache_store(self, path, cmd, symbols):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + f".{os.getpid()}.tmp"
+        with open(tmp, "wb") as fd:
+            fd.write(SYMCACHE_HEADER.pack(SYMCACHE_MAGIC, cmd.args.nsyms, cmd.args.strsize,
+                                          len(symbols)))
+            fd.write(array("Q", symbols.values()).tobytes())
+            fd.write("\x00".join(symbols.keys()).encode("ascii"))
+        os.replace(tmp, path)
+
+    def _read_symbols(self, cmd):
+        self.io.seek(self.off + cmd.args.symoff)
+        symdata = self.io.read(NLIST.size * cmd.args.nsyms)
+        self.io.seek(self.off + cmd.args.stroff)
+        strtab = self.io.read(cmd.args.strsize)
 
         symbols_dict = {}
-        for i in symbols:
-            off = cmd.args.stroff + i.n_strx
-            self.io.seek(self.off + off)
-            name = self.io.read(1024).split(b"\x00")[0].decode("ascii")
-            symbols_dict[name] = i.n_value
+        find = strtab.find
+        for n_strx, n_type, n_sect, n_desc, n_value in NLIST.iter_unpack(symdata):
+            end = find(b"\x00", n_strx)
+            if end < 0:
+                end = len(strtab)
+            symbols_dict[strtab[n_strx:end].decode("ascii")] = n_value
+        return symbols_dict
 
-        if demangle:
-            names = list(symbols_dict.keys())
-            argv = ["c++filt"]
-            argv += names
+    def load_symbols(self, demangle=False):
+        '''Load the symbol table into self.symbols (name -> address)
 
-            with subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE) as proc:
-                demangled, _ = proc.communicate()
+ The nlist array and the string table are each read in one go. If
+ M1N1SYMCACHE names a directory, the symbols are also cached there by
+ Mach-O UUID.'''
+        self.symbols = {}
+
+        cmd = self.get_cmd(MachOLoadCmdType.SYMTAB)
 
-            demangled = demangled.decode("ascii").split("\n")[:-1]
-            for name_mangled, name_demangled in zip(names, demangled):
-                self.symbols[name_demangled] = symbols_dict[name_mangled]
+        cache = self._symcache_path()
+        symbols_dict = None
+        if cache is not None:
+            symbols_dict = self._symcache_load(cache, cmd)
+        if symbols_dict is None:
+            symbols_dict = self._read_symbols(cmd)
+            if cache is not None:
+                self._symcache_store(cache, cmd, symbols_dict)
+
+        if demangle:
+            names = list(symbols_dict.keys())
+            self.symbols = dict(zip(demangle_names(names), symbols_dict.values()))
         else:
             self.symbols = symbols_dict
 
@@ -1,5 +1,5 @@
 # SPDX-License-Identifier: MIT
-import platform, os, sys, struct, serial, time
+import platform, os, sys, struct, serial, threading, time
 from construct import *
 from enum import IntEnum, IntFlag
 from serial.tools.miniterm import Miniterm
@@ -96,6 +96,131 @@ ExcInfo = Struct(
     "sp_phys" / Int64ul,
     "data" / Int64ul,
 )
+
+class ExcContextWords:
+    '''List-like view of consecutive ExcContext words (regs, sp)'''
+
+    def __init__(self, ctx, start, count):
+        self._ctx = ctx
+        self._start = start
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        words = self._ctx._words[self._start:self._start + self._count]
+        return words[i]
+
+    def __setitem__(self, i, value):
+        idx = range(self._start, self._start + self._count)[i]
+        if isinstance(idx, int):
+            self._ctx._set(idx, value)
+        else:
+            for j, v in zip(idx, value):
+                self._ctx._set(j, v)
+
+    def __iter__(self):
+        return iter(self._ctx._words[self._start:self._start + self._count])
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def copy(self):
+        return list(self)
+
+    def __repr__(self):
+        return repr(list(self))
+
+class ExcContext:
+    '''ExcInfo decoded with struct, tracking which words were modified
+
+ Attribute access matches ExcInfo.parse(). spsr and esr are Register objects
+ that may be modified in place; dirty_runs() picks those changes up too.'''
+
+    FORMAT = struct.Struct("<46Q")
+    FIELDS = {
+        "spsr": 32, "elr": 33, "esr": 34, "far": 35, "afsr1": 36,
+        "cpu_id": 40, "mpidr": 41, "elr_phys": 42, "far_phys": 43,
+        "sp_phys": 44, "data": 45,
+    }
+    REGISTERS = {32: SPSR, 34: ESR}
+
+    def __init__(self, data):
+        self.__dict__["_words"] = list(self.FORMAT.unpack(data))
+        self.__dict__["_dirty"] = set()
+        self.__dict__["_regs"] = {}
+        self.__dict__["regs"] = ExcContextWords(self, 0, 32)
+        self.__dict__["sp"] = ExcContextWords(self, 37, 3)
+
+    @classmethod
+    def sizeof(cls):
+        return cls.FORMAT.size
+
+    def _set(self, idx, value):
+        value = int(value)
+        if self._words[idx] != value:
+            self._words[idx] = value
+            self._dirty.add(idx)
+        self._regs.pop(idx, None)
+
+    def __getattr__(self, attr):
+        idx = self.FIELDS.get(attr, None)
+        if idx is None:
+            raise AttributeError(attr)
+        rcls = self.REGISTERS.get(idx, None)
+        if rcls is None:
+            return self._words[idx]
+        reg = self._regs.get(idx, None)
+        if reg is None:
+            reg = self._regs[idx] = rcls(self._words[idx])
+        return reg
+
+    def __setattr__(self, attr, value):
+        idx = self.FIELDS.get(attr, None)
+        if idx is None:
+            raise AttributeError(f"ExcContext has no field {attr}")
+        if isinstance(value, Register):
+            value = value.value
+        self._set(idx, value)
+
+    def dirty_runs(self, max_gap=8):
+        '''return the modified words as (offset, bytes) runs
+ runs closer than max_gap words are merged into one transfer'''
+        for idx, reg in self._regs.items():
+            if reg.value != self._words[idx]:
+                self._words[idx] = reg.value
+                self._dirty.add(idx)
+
+        runs = []
+        for idx in sorted(self._dirty):
+            if runs and idx - runs[-1][1] <= max_gap:
+                runs[-1][1] = idx + 1
+            else:
+                runs.append([idx, idx + 1])
+
+        return [(8 * start, struct.pack(f"<{stop - start}Q", *self._words[start:stop]))
+                for start, stop in runs]
+
+    def clean(self):
+        self._dirty.clear()
+
+    def build(self):
+        self.dirty_runs()
+        return self.FORMAT.pack(*self._words)
+
+    def __str__(self):
+        return str(ExcInfo.parse(self.build()))
+
+    def __repr__(self):
+        fields = sorted([(0, "regs"), (37, "sp"), *((idx, k) for k, idx in self.FIELDS.items())])
+        def fmt(value):
+            if isinstance(value, ExcContextWords):
+                return "[" + ", ".join(f"{i:#x}" for i in value) + "]"
+            if isinstance(value, Register):
+                return repr(value)
+            return f"{value:#x}"
+        return "ExcContext(" + ", ".join(f"{k}={fmt(getattr(self, k))}" for _, k in fields) + ")"
 # Sends 56+ byte Commands and Expects 36 Byte Responses
 # Commands are format <I48sI
 #   4 byte command, 48 byte null padded data + 4 byte checksum
@@ -174,6 +299,11 @@ class UartInterface(Reloadable):
         self.handlers = {}
         self.evt_handlers = {}
         self.enabled_features = Feature(0)
+        # Returns True on threads that must not talk to the target
+        self.forbidden_thread = None
+        # Held while a request is written, so bytes from other threads
+        # (HV.kick_virtio) land between requests
+        self.write_lock = threading.RLock()
 
     def checksum(self, data):
         sum = 0xDEADBEEF;
@@ -200,6 +330,8 @@ class UartInterface(Reloadable):
         return d
 
     def cmd(self, cmd, payload=b""):
+        assert self.forbidden_thread is None or not self.forbidden_thread(), \
+            "target request from a background thread"
         if len(payload) > self.CMD_LEN:
             raise ValueError("Incorrect payload size %d"%len(payload))
 
@@ -208,7 +340,8 @@ class UartInterface(Reloadable):
         command += struct.pack("<I", self.checksum(command))
         if self.debug:
             print("<<", hexdump(command))
-        self.dev.write(command)
+        with self.write_lock:
+            self.dev.write(command)
 
     def unkhandler(self, s):
         if not self.tty_enable:
@@ -391,20 +524,21 @@ class UartInterface(Reloadable):
         checksum = self.data_checksum(data)
         size = len(data)
         req = struct.pack("<QQI", addr, size, checksum)
-        self.cmd(self.REQ_MEMWRITE, req)
-        if self.debug:
-            print("<< DATA:")
-            chexdump(data)
-        for i in range(0, len(data), 8192):
-            self.dev.write(data[i:i + 8192])
+        with self.write_lock:
+            self.cmd(self.REQ_MEMWRITE, req)
+            if self.debug:
+                print("<< DATA:")
+                chexdump(data)
+            for i in range(0, len(data), 8192):
+                self.dev.write(data[i:i + 8192])
+                if progress:
+                    sys.stdout.write(".")
+                    sys.stdout.flush()
             if progress:
-                sys.stdout.write(".")
-                sys.stdout.flush()
-        if progress:
-            print()
-        if self.enabled_features & Feature.DISABLE_DATA_CSUMS:
-            # Extra sentinel after the data to make sure no data is lost
-            self.dev.write(struct.pack("<I", self.DATA_END_SENTINEL))
+                print()
+            if self.enabled_features & Feature.DISABLE_DATA_CSUMS:
+                # Extra sentinel after the data to make sure no data is lost
+                self.dev.write(struct.pack("<I", self.DATA_END_SENTINEL))
 
         # should automatically report a CRC failure
         self.reply(self.REQ_MEMWRITE)
@@ -591,6 +725,7 @@ class M1N1Proxy(Reloadable):
 
     P_XZDEC = 0x400
     P_GZDEC = 0x401
+    P_MEMHASH64 = 0x402
 
     P_SMP_START_SECONDARIES = 0x500
     P_SMP_CALL = 0x501
@@ -654,6 +789,10 @@ class M1N1Proxy(Reloadable):
     P_VIRTIO_PUT_BUFFER = 0xc0e
     P_HV_EXIT_CPU = 0xc0f
     P_HV_ADD_TIME = 0xc10
+    P_HV_TRANSLATE_RANGE = 0xc11
+    P_HV_MAP_BATCH = 0xc12
+    P_VIRTIO_PUT_BUFFERS = 0xc13
+    P_HV_TLBI_ALL = 0xc14
 
     P_FB_INIT = 0xd00
     P_FB_SHUTDOWN = 0xd01
@@ -1006,6 +1145,12 @@ class M1N1Proxy(Reloadable):
         return self.request(self.P_GZDEC, inbuf, insize, outbuf,
                             outsize, signed=True)
 
+    def memhash64(self, addr, block, count, outbuf):
+        '''hash count blocks of block bytes at addr into a u64 array at outbuf'''
+        if addr & 7 or block & 7:
+            raise AlignmentError()
+        return self.request(self.P_MEMHASH64, addr, block, count, outbuf)
+
     def smp_start_secondaries(self):
         self.request(self.P_SMP_START_SECONDARIES)
     def smp_call(self, cpu, addr, *args):
@@ -1139,6 +1284,23 @@ class M1N1Proxy(Reloadable):
         return self.request(self.P_HV_EXIT_CPU, cpu)
     def hv_add_time(self, time):
         return self.request(self.P_HV_ADD_TIME, time)
+    def hv_translate_range(self, addr, count, w, buf):
+        '''Translate count consecutive 4K pages starting at addr into an
+ array of physical page addresses at buf; returns the number translated
+ before the first fault'''
+        return self.request(self.P_HV_TRANSLATE_RANGE, addr, count, w, buf)
+    def hv_map_batch(self, ops, count, tlbi_all=False):
+        '''Apply count (from, to, size, flags) hv_map operations from ops,
+ invalidating the stage 2 TLB for the flagged ranges (or all of it);
+ returns the number of operations applied'''
+        return self.request(self.P_HV_MAP_BATCH, ops, count, tlbi_all)
+    def virtio_put_buffers(self, base, qu, bufs, count):
+        '''Return count (id, len) used buffers from bufs to queue qu of the
+ virtio device at base, then raise its interrupt once'''
+        return self.request(self.P_VIRTIO_PUT_BUFFERS, base, qu, bufs, count)
+    def hv_tlbi_all(self):
+        '''Invalidate all stage 1 and 2 TLB entries of the guest'''
+        return self.request(self.P_HV_TLBI_ALL)
 
     def fb_init(self):
         return self.request(self.P_FB_INIT)
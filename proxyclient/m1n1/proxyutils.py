@@ -1,5 +1,6 @@
 # SPDX-License-Identifier: MIT
-import serial, os, struct, sys, time, json, os.path, gzip, functools
+import serial, os, struct, sys, time, json, os.path, gzip, functools, hashlib
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from construct import *
 
@@ -40,6 +41,8 @@ VERSION_MAP = {
 
 class ProxyUtils(Reloadable):
     CODE_BUFFER_SIZE = 0x10000
+    # Merge ADT patches closer than this into a single write
+    ADT_PATCH_GAP = 0x40
     def __init__(self, p, heap_size=1024 * 1024 * 1024):
         self.iface = p.iface
         self.proxy = p
@@ -242,7 +245,9 @@ class ProxyUtils(Reloadable):
         if not len(data):
             return
 
-        payload = gzip.compress(data, compresslevel=1)
+        self._gz_upload(dest, gzip.compress(data, compresslevel=1), len(data), progress)
+
+    def _gz_upload(self, dest, payload, size, progress=None):
         compressed_size = len(payload)
 
         with self.heap.guarded_malloc(compressed_size) as compressed_addr:
@@ -250,27 +255,148 @@ class ProxyUtils(Reloadable):
             timeout = self.iface.dev.timeout
             self.iface.dev.timeout = None
             try:
-                decompressed_size = self.proxy.gzdec(compressed_addr, compressed_size, dest, len(data))
+                decompressed_size = self.proxy.gzdec(compressed_addr, compressed_size, dest, size)
             finally:
                 self.iface.dev.timeout = timeout
 
-            assert decompressed_size == len(data)
+            assert decompressed_size == size
+
+    def write_segments(self, base, segments, progress=None):
+        '''Write (offset, data, clear) segments (see MachO.segments) to base
+
+ Each segment is compressed on a worker thread while the previous one is
+ being sent, and the clear bytes after it are zeroed on the target.'''
+        def upload(dest, job, size, clear):
+            if job is not None:
+                self._gz_upload(dest, job.result(), size, progress)
+            dest += size
+            if not clear:
+                return
+            if dest & 7 or clear & 7:
+                self.proxy.memset8(dest, 0, clear)
+            else:
+                self.proxy.memset64(dest, 0, clear)
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            prev = None
+            for offset, data, clear in segments:
+                job = pool.submit(gzip.compress, data, compresslevel=1) if len(data) else None
+                if prev is not None:
+                    upload(*prev)
+                prev = base + offset, job, len(data), clear
+            if prev is not None:
+                upload(*prev)
+
+    def _adt_region(self):
+        adt_base = (self.ba.devtree - self.ba.virt_base + self.ba.phys_base) & 0xffffffffffffffff
+        return adt_base, self.ba.devtree_size
+
+    def _adt_cache_path(self, adt_base, adt_size):
+        '''Local ADT cache file for the blob currently in target memory
+
+        The cache is keyed by a target-side hash of the whole blob, so returns
+        None if the target cannot hash it.'''
+        cache_dir = os.environ.get("M1N1ADTCACHE", "")
+        if not cache_dir or adt_base & 7:
+            return None
+
+        size = adt_size & ~7
+        try:
+            with self.heap.guarded_malloc(8) as buf:
+                self.proxy.memhash64(adt_base, size, 1, buf)
+                digest = self.iface.readmem(buf, 8)
+        except ProxyRemoteError:
+            return None # m1n1 too old for memhash64
+
+        h = hashlib.sha256()
+        h.update(struct.pack("<QQ", adt_base, adt_size))
+        h.update(digest)
+        if adt_size > size:
+            h.update(self.iface.readmem(adt_base + size, adt_size - size))
+        return os.path.join(cache_dir, h.hexdigest() + ".adt")
+
+    def _adt_cache_store(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + f".{os.getpid()}.tmp"
+        with open(tmp, "wb") as fd:
+            fd.write(data)
+        os.replace(tmp, path)
 
     def get_adt(self):
         if self.adt_data is not None:
             return self.adt_data
-        adt_base = (self.ba.devtree - self.ba.virt_base + self.ba.phys_base) & 0xffffffffffffffff
-        adt_size = self.ba.devtree_size
+        adt_base, adt_size = self._adt_region()
+
+        cache = self._adt_cache_path(adt_base, adt_size)
+        if cache is not None:
+            try:
+                with open(cache, "rb") as fd:
+                    data = fd.read()
+            except FileNotFoundError:
+                data = None
+            if data is not None and len(data) == adt_size:
+                print(f"Using cached ADT ({adt_size} bytes) from {cache}")
+                self.adt_data = data
+                return self.adt_data
+
         print(f"Fetching ADT ({adt_size} bytes)...")
-        self.adt_data = self.iface.readmem(adt_base, self.ba.devtree_size)
+        self.adt_data = self.iface.readmem(adt_base, adt_size)
+        if cache is not None:
+            self._adt_cache_store(cache, self.adt_data)
         return self.adt_data
 
     def push_adt(self):
-        self.adt_data = self.adt.build()
-        adt_base = (self.ba.devtree - self.ba.virt_base + self.ba.phys_base) & 0xffffffffffffffff
-        adt_size = len(self.adt_data)
-        print(f"Pushing ADT ({adt_size} bytes)...")
-        self.iface.writemem(adt_base, self.adt_data)
+        '''Write the (modified) ADT back to the target.
+
+        If only property values of unchanged size were assigned since the ADT
+        was fetched or last pushed, only the changed byte ranges are written.
+        The patched blob is checked against a full rebuild, so values modified
+        in place without ADTNode.touch() are not lost: if they are present the
+        whole ADT is pushed instead, and if nothing changed nothing is pushed.'''
+        adt_base, devtree_size = self._adt_region()
+        patches = self.adt_data is not None and self.adt.build_patches()
+        built = self.adt.build()
+
+        if patches:
+            data = bytearray(self.adt_data)
+            runs = []
+            for off, value in patches:
+                data[off:off + len(value)] = value
+                if runs and off <= runs[-1][1] + self.ADT_PATCH_GAP:
+                    runs[-1][1] = max(runs[-1][1], off + len(value))
+                else:
+                    runs.append([off, off + len(value)])
+            if data[:len(built)] != built:
+                # Other values were modified in place without touch()
+                patches = False
+
+        if patches:
+            self.adt_data = bytes(data)
+            size = sum(end - start for start, end in runs)
+            print(f"Patching ADT ({len(patches)} properties, {len(runs)} ranges, {size} bytes)...")
+            for start, end in runs:
+                self.iface.writemem(adt_base + start, self.adt_data[start:end])
+            self.adt._sync()
+        else:
+            data = built
+            if (patches is not None and self.adt_data is not None
+                    and data == self.adt_data[:len(data)]):
+                # Nothing was marked as modified, and nothing was modified in place
+                print("ADT unchanged, nothing to push")
+                return
+            self.adt_data = data
+            adt_size = len(self.adt_data)
+            print(f"Pushing ADT ({adt_size} bytes, full rebuild)...")
+            self.iface.writemem(adt_base, self.adt_data)
+            self.adt._sync(self.adt_data)
+
+        # Keep the cache in sync with what a later get_adt() will find
+        cache = devtree_size and self._adt_cache_path(adt_base, devtree_size)
+        if cache:
+            data = self.adt_data[:devtree_size]
+            if len(data) < devtree_size:
+                data += self.iface.readmem(adt_base + len(data), devtree_size - len(data))
+            self._adt_cache_store(cache, data)
 
     def disassemble_at(self, start, size, pc=None, vstart=None, sym=None):
         '''disassemble size bytes of memory from start
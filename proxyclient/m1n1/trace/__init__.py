@@ -91,7 +91,10 @@ class Tracer(Reloadable):
             if rcls is not None:
                 value = rcls(evt.data)
 
-        if self.verbose >= 3 or (reg is None and self.verbose >= 1):
+        tracelog = self.hv.tracelog
+        if tracelog is not None:
+            tracelog.mmio(evt, self.ident, regmap=regmap)
+        elif self.verbose >= 3 or (reg is None and self.verbose >= 1):
             if reg is None:
                 s = f"{evt.addr:#x} = {value:#x}"
             else:
@@ -110,7 +113,7 @@ class Tracer(Reloadable):
                     handler(value, index)
                 else:
                     handler(value)
-            elif self.verbose == 2:
+            elif self.verbose == 2 and tracelog is None:
                 s = f"{regmap.get_name(evt.addr)} = {value!s}"
                 m = "+" if evt.flags.MULTI else " "
                 self.log(f"MMIO: {t.upper()}.{1<<evt.flags.WIDTH:<2}{m} " + s)
@@ -148,15 +151,18 @@ class Tracer(Reloadable):
         self.hv.clear_tracers(self.ident)
 
     def log(self, msg, show_cpu=True):
-        self.hv.log(f"[{self.ident}] {msg}", show_cpu=show_cpu)
+        self.hv.log(f"[{self.ident}] {msg}", show_cpu=show_cpu, source=self.ident)
 
 class PrintTracer(Tracer):
     def __init__(self, hv, device_addr_tbl):
         super().__init__(hv)
         self.device_addr_tbl = device_addr_tbl
-        self.log_file = None
 
     def event_mmio(self, evt, name=None, start=None):
+        if self.hv.tracelog is not None:
+            self.hv.tracelog.mmio(evt, self.ident, dev=name)
+            return
+
         dev, zone2 = self.device_addr_tbl.lookup(evt.addr)
         if name is None:
             name = dev
@@ -165,15 +171,13 @@ class PrintTracer(Tracer):
         m = "+" if evt.flags.MULTI else " "
         logline = (f"[cpu{evt.flags.CPU}] [0x{evt.pc:016x}] MMIO: {t}.{1<<evt.flags.WIDTH:<2}{m} " +
                    f"0x{evt.addr:x} ({name}, offset {evt.addr - start:#04x}) = 0x{evt.data:x}")
-        print(logline)
-        if self.log_file:
-            self.log_file.write(f"# {logline}\n")
-            width = 8 << evt.flags.WIDTH
-            if evt.flags.WRITE:
-                stmt = f"p.write{width}({start:#x} + {evt.addr - start:#x}, {evt.data:#x})\n"
-            else:
-                stmt = f"p.read{width}({start:#x} + {evt.addr - start:#x})\n"
-            self.log_file.write(stmt)
+        width = 8 << evt.flags.WIDTH
+        if evt.flags.WRITE:
+            stmt = f"p.write{width}({start:#x} + {evt.addr - start:#x}, {evt.data:#x})\n"
+        else:
+            stmt = f"p.read{width}({start:#x} + {evt.addr - start:#x})\n"
+        # Through the HV logger, so file writes stay ordered with the log thread
+        self.hv.log(logline, show_cpu=False, source=self.ident, record=stmt)
 
 class ADTDevTracer(Tracer):
     REGMAPS = []
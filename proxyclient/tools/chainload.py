@@ -3,7 +3,7 @@
 import sys, pathlib
 sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
 
-import argparse, pathlib, time
+import argparse, itertools, pathlib, time
 
 parser = argparse.ArgumentParser(description='Mach-O loader for m1n1')
 parser.add_argument('-q', '--quiet', action="store_true", help="Disable framebuffer")
@@ -26,11 +26,13 @@ new_base = u.base
 if args.raw:
     image = args.payload.read_bytes()
     image += b"\x00\x00\x00\x00"
+    image_len = len(image)
+    segments = [(0, image, 0)]
     entry = new_base + args.entry_point
 else:
-    macho = MachO(args.payload.read_bytes())
-    image = macho.prepare_image()
-    image += b"\x00\x00\x00\x00"
+    macho = MachO(args.payload.open("rb"))
+    image_len = macho.load_size() + 4
+    segments = itertools.chain(macho.segments(), [(image_len - 4, b"", 4)])
     entry = macho.entry
     entry -= macho.vmin
     entry += new_base
@@ -46,7 +48,7 @@ if not args.no_sepfw:
     if hasattr(u.adt["chosen"]["memory-map"], "preoslog"):
         preoslog_start, preoslog_size = u.adt["chosen"]["memory-map"].preoslog
 
-image_size = align(len(image))
+image_size = align(image_len)
 sepfw_off = image_size
 image_size += align(sepfw_length)
 preoslog_off = image_size
@@ -58,9 +60,9 @@ image_size += bootargs_size
 print(f"Total region size: 0x{image_size:x} bytes")
 image_addr = u.malloc(image_size)
 
-print(f"Loading kernel image (0x{len(image):x} bytes)...")
-u.compressed_writemem(image_addr, image, True)
-p.dc_cvau(image_addr, len(image))
+print(f"Loading kernel image (0x{image_len:x} bytes)...")
+u.write_segments(image_addr, segments, True)
+p.dc_cvau(image_addr, image_len)
 
 if not args.no_sepfw:
     print(f"Copying SEPFW (0x{sepfw_length:x} bytes)...")
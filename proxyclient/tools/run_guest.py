@@ -17,6 +17,8 @@ parser.add_argument('-S', '--shell', action="store_true")
 parser.add_argument('-e', '--hook-exceptions', action="store_true")
 parser.add_argument('-d', '--debug-xnu', action="store_true")
 parser.add_argument('-l', '--logfile', type=pathlib.Path)
+parser.add_argument('-T', '--tracelog', type=pathlib.Path,
+                    help='Record trace events to a binary log (see tools/tracelog.py) instead of printing them')
 parser.add_argument('-C', '--cpus', default=None)
 parser.add_argument('-r', '--raw', action="store_true")
 parser.add_argument('-E', '--entry-point', action="store", type=int, help="Entry point for the raw image", default=0x800)
@@ -25,6 +27,8 @@ parser.add_argument('-v', '--volume', type=volumespec, action='append',
                     help='Attach a 9P virtio device for file export to the guest. The argument is a host path to the '
                          'exported tree, joined by colon (\':\') with a tag under which the tree will be advertised '
                          'on the guest side.')
+parser.add_argument('--u9fs', action="store_true",
+                    help='Serve --volume trees with an external u9fs process instead of the built-in 9P server')
 parser.add_argument('payload', type=pathlib.Path)
 parser.add_argument('boot_args', default=[], nargs="*")
 args = parser.parse_args()
@@ -35,7 +39,7 @@ from m1n1.utils import *
 from m1n1.shell import run_shell
 from m1n1.sysreg import *
 from m1n1.hv import HV
-from m1n1.hv.virtio import Virtio9PTransport
+from m1n1.hv.virtio import Virtio9PServer, Virtio9PTransport
 from m1n1.hw.pmu import PMU
 
 iface = UartInterface()
@@ -73,11 +77,15 @@ if args.debug_xnu:
 
 if args.volume:
     for path, tag in args.volume:
-        hv.attach_virtio(Virtio9PTransport(root=path, tag=tag))
+        transport = Virtio9PTransport if args.u9fs else Virtio9PServer
+        hv.attach_virtio(transport(root=path, tag=tag))
 
 if args.logfile:
     hv.set_logfile(args.logfile.open("w"))
 
+if args.tracelog:
+    hv.set_tracelog(args.tracelog)
+
 if len(args.boot_args) > 0:
     boot_args = " ".join(args.boot_args)
     hv.set_bootargs(boot_args)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+import sys, pathlib
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+
+import argparse
+
+from m1n1.hv.tracelog import TraceLogReader
+
+def addr_range(s):
+    if ":" in s:
+        start, end = s.split(":", 1)
+        return range(int(start, 0), int(end, 0))
+    elif "+" in s:
+        start, size = s.split("+", 1)
+        return range(int(start, 0), int(start, 0) + int(size, 0))
+    else:
+        return range(int(s, 0), int(s, 0) + 1)
+
+parser = argparse.ArgumentParser(description='Query a binary hypervisor trace log')
+parser.add_argument('-a', '--addr', type=addr_range,
+                    help='Address range, as start:end, start+size or a single address')
+parser.add_argument('-d', '--device', action='append',
+                    help='Device or tracer ident (glob pattern, may be repeated)')
+parser.add_argument('-c', '--cpu', type=int, action='append', help='CPU number (may be repeated)')
+parser.add_argument('-s', '--start', type=float, help='Start time, in seconds from the first event')
+parser.add_argument('-e', '--end', type=float, help='End time, in seconds from the first event')
+parser.add_argument('-n', '--count', action='store_true', help='Only count matching events')
+parser.add_argument('-i', '--info', action='store_true', help='Show the log summary')
+parser.add_argument('log', type=pathlib.Path)
+args = parser.parse_args()
+
+log = TraceLogReader(args.log)
+t0 = log.t_first
+
+if args.info:
+    events = sum(c.count for c in log.chunks)
+    print(f"{len(log.chunks)} chunks, {events} events")
+    print("Names:")
+    for name in log.names[1:]:
+        print(f"  {name}")
+    print("Register maps:")
+    for regmap in log.regmaps[1:]:
+        print(f"  {regmap}")
+    sys.exit(0)
+
+devices = None
+if args.device:
+    devices = log.match_names(args.device)
+
+t_start = t_end = None
+if args.start is not None:
+    t_start = t0 + int(args.start * 1e9)
+if args.end is not None:
+    t_end = t0 + int(args.end * 1e9)
+
+records = log.records(addr=args.addr, cpus=set(args.cpu) if args.cpu else None,
+                      devices=devices, t_start=t_start, t_end=t_end)
+
+if args.count:
+    print(sum(1 for _ in records))
+else:
+    try:
+        for rec in records:
+            print(log.format(rec, t0))
+    except BrokenPipeError:
+        pass
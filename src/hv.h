@@ -52,13 +52,26 @@ typedef enum _hv_entry_type {
 } hv_entry_type;
 
 /* VM */
+#define HV_MAP_INCR BIT(0)
+#define HV_MAP_TLBI BIT(1)
+
+struct hv_map_op {
+    u64 from;
+    u64 to;
+    u64 size;
+    u64 flags;
+};
+
 void hv_pt_init(void);
 int hv_map(u64 from, u64 to, u64 size, u64 incr);
+int hv_map_batch(struct hv_map_op *ops, u64 count, bool tlbi_all);
+void hv_tlbi_all(void);
 int hv_unmap(u64 from, u64 size);
 int hv_map_hw(u64 from, u64 to, u64 size);
 int hv_map_sw(u64 from, u64 to, u64 size);
 int hv_map_hook(u64 from, hv_hook_t *hook, u64 size);
 u64 hv_translate(u64 addr, bool s1only, bool w, u64 *par_out);
+u64 hv_translate_range(u64 addr, u64 count, bool w, u64 *pages);
 u64 hv_pt_walk(u64 addr);
 bool hv_handle_dabort(struct exc_info *ctx);
 bool hv_pa_write(struct exc_info *ctx, u64 addr, u64 *val, int width);
@@ -72,8 +85,13 @@ bool hv_trace_irq(u32 type, u32 num, u32 count, u32 flags);
 void hv_vuart_poll(void);
 void hv_map_vuart(u64 base, int irq, iodev_id_t iodev);
 struct virtio_conf;
+struct virtio_used {
+    u32 id;
+    u32 len;
+};
 void hv_map_virtio(u64 base, struct virtio_conf *conf);
 void virtio_put_buffer(u64 base, int qu, u32 id, u32 len);
+void virtio_put_buffers(u64 base, int qu, const struct virtio_used *bufs, u32 count);
 
 /* Exceptions */
 void hv_exc_proxy(struct exc_info *ctx, uartproxy_boot_reason_t reason, u32 type, void *extra);
@@ -42,10 +42,7 @@ struct availring {
 struct usedring {
     u16 flags;
     u16 idx;
-    struct {
-        u32 id;
-        u32 len;
-    } ring[];
+    struct virtio_used ring[];
 };
 
 struct desc {
@@ -101,36 +98,43 @@ struct virtio_dev {
 
 static struct virtio_dev *devlist;
 
-static void notify_avail(struct exc_info *ctx, struct virtio_q *q, int idx)
+static void notify_avail(struct exc_info *ctx, struct virtio_q *q, u16 start, u16 count)
 {
-    struct desc *d = &q->desc[idx];
     struct {
         u64 devbase;
         u16 qu;
-        u16 idx;
-        u32 pad;
+        u16 start;
+        u16 count;
+        u16 size;
         u64 descbase;
+        u64 availbase;
     } PACKED info = {
-        q->host->base, q->idx, idx, 0, (u64)q->desc,
+        q->host->base, q->idx, start, count, q->size, (u64)q->desc, (u64)q->avail,
     };
 
     if (q->host->verbose)
-        printf("virtio @ %lx: available %s buffer at %lx, size %x, flags %x\n", q->host->base,
-               (d->flags & DESC_WRITE) ? "device" : "driver", d->addr, d->len, d->flags);
+        printf("virtio @ %lx: %d buffers available on queue %d from %d\n", q->host->base, count,
+               q->idx, start);
 
     hv_exc_proxy(ctx, START_HV, HV_VIRTIO, &info);
 }
 
 static void notify_buffers(struct exc_info *ctx, struct virtio_dev *dev, u32 qidx)
 {
-    struct virtio_q *q = &dev->qs[qidx];
-    struct availring *avail = q->avail;
+    struct virtio_q *q;
+    u16 count;
 
     if (qidx >= (u32)dev->num_qus)
         return;
 
-    for (; avail->idx != q->avail_seen; q->avail_seen++)
-        notify_avail(ctx, q, avail->ring[q->avail_seen % q->size]);
+    q = &dev->qs[qidx];
+
+    /* Hand everything pending to the proxy in a single exit */
+    while ((count = q->avail->idx - q->avail_seen)) {
+        dma_rmb();
+        notify_avail(ctx, q, q->avail_seen, count);
+        q->avail_seen += count;
+    }
 }
 
 static struct virtio_dev *dev_by_base(u64 base)
@@ -144,34 +148,44 @@ static struct virtio_dev *dev_by_base(u64 base)
     return dev;
 }
 
-void virtio_put_buffer(u64 base, int qu, u32 id, u32 len)
+void virtio_put_buffers(u64 base, int qu, const struct virtio_used *bufs, u32 count)
 {
     struct virtio_dev *dev = dev_by_base(base);
     struct virtio_q *q;
     struct usedring *used;
+    u16 idx;
 
     if (!dev) {
-        printf("virtio_put_buffer: no device at %lx\n", base);
+        printf("virtio_put_buffers: no device at %lx\n", base);
         return;
     }
 
     q = &dev->qs[qu];
     used = q->used;
+    idx = used->idx;
+
+    for (u32 i = 0; i < count; i++, idx++)
+        used->ring[idx % q->size] = bufs[i];
 
-    used->ring[used->idx % q->size].id = id;
-    used->ring[used->idx % q->size].len = len;
-    used->idx++;
+    dma_wmb();
+    used->idx = idx;
 
     dev->irqstatus |= USED_BUFFER;
     aic_set_sw(dev->irq, true);
 }
 
+void virtio_put_buffer(u64 base, int qu, u32 id, u32 len)
+{
+    struct virtio_used buf = {id, len};
+
+    virtio_put_buffers(base, qu, &buf, 1);
+}
+
 static bool handle_virtio(struct exc_info *ctx, u64 addr, u64 *val, bool write, int width)
 {
     struct virtio_dev *dev;
     struct virtio_q *q;
     UNUSED(ctx);
-    UNUSED(width);
 
     dev = dev_by_base(addr & ~0xfff);
     if (!dev)
@@ -248,10 +262,10 @@ static bool handle_virtio(struct exc_info *ctx, u64 addr, u64 *val, bool write,
                 *val = dev->irqstatus;
                 break;
             case 0x100 ... 0x1000:
-                if (addr - 0x100 < dev->config_len)
-                    *val = dev->config[addr - 0x100];
-                else
-                    *val = 0;
+                *val = 0;
+                for (int i = 0; i < (1 << min(width, 3)); i++)
+                    if (addr - 0x100 + i < dev->config_len)
+                        *val |= (u64)dev->config[addr - 0x100 + i] << (8 * i);
                 break;
             default:
                 q = dev->currq;
@@ -367,6 +367,48 @@ int hv_map(u64 from, u64 to, u64 size, u64 incr)
     return 0;
 }
 
+int hv_map_batch(struct hv_map_op *ops, u64 count, bool tlbi_all)
+{
+    bool scoped = false;
+    u64 i;
+
+    for (i = 0; i < count; i++) {
+        if (hv_map(ops[i].from, ops[i].to, ops[i].size, ops[i].flags & HV_MAP_INCR) < 0)
+            break;
+
+        if (tlbi_all || !(ops[i].flags & HV_MAP_TLBI))
+            continue;
+
+        sysop("dsb ishst");
+        scoped = true;
+        for (u64 off = 0; off < ops[i].size; off += BIT(VADDR_L3_OFFSET_BITS))
+            asm volatile("tlbi ipas2e1is, %0" : : "r"((ops[i].from + off) >> 12));
+    }
+
+    if (tlbi_all) {
+        sysop("dsb ishst");
+        sysop("tlbi vmalls12e1is");
+    } else if (scoped) {
+        // Combined stage 1+2 entries are not covered by the IPA-based invalidation
+        sysop("dsb ish");
+        sysop("tlbi vmalle1is");
+    }
+    if (tlbi_all || scoped) {
+        sysop("dsb ish");
+        sysop("isb");
+    }
+
+    return i;
+}
+
+void hv_tlbi_all(void)
+{
+    sysop("dsb ishst");
+    sysop("tlbi vmalls12e1is");
+    sysop("dsb ish");
+    sysop("isb");
+}
+
 int hv_unmap(u64 from, u64 size)
 {
     return hv_map(from, 0, size, 0);
@@ -434,6 +476,21 @@ u64 hv_translate(u64 addr, bool s1, bool w, u64 *par_out)
     }
 }
 
+u64 hv_translate_range(u64 addr, u64 count, bool w, u64 *pages)
+{
+    u64 i;
+
+    addr &= ~0xfffUL;
+    for (i = 0; i < count; i++) {
+        u64 pa = hv_translate(addr + (i << 12), false, w, NULL);
+        if (!pa)
+            break; // fault, return the translated prefix
+        pages[i] = pa & ~0xfffUL;
+    }
+
+    return i;
+}
+
 u64 hv_pt_walk(u64 addr)
 {
     dprintf("hv_pt_walk(0x%lx)\n", addr);
@@ -340,6 +340,14 @@ int proxy_process(ProxyRequest *request, ProxyReply *reply)
                 reply->retval = destlen;
             break;
         }
+        case P_MEMHASH64: {
+            u64 *out = (u64 *)request->args[3];
+            for (u64 i = 0; i < request->args[2]; i++)
+                out[i] = memhash64((void *)(request->args[0] + i * request->args[1]),
+                                   request->args[1]);
+            reply->retval = request->args[2];
+            break;
+        }
 
         case P_SMP_START_SECONDARIES:
             smp_start_secondaries();
@@ -537,6 +545,21 @@ int proxy_process(ProxyRequest *request, ProxyReply *reply)
         case P_HV_ADD_TIME:
             hv_add_time(request->args[0]);
             break;
+        case P_HV_MAP_BATCH:
+            reply->retval = hv_map_batch((void *)request->args[0], request->args[1],
+                                         request->args[2]);
+            break;
+        case P_HV_TRANSLATE_RANGE:
+            reply->retval = hv_translate_range(request->args[0], request->args[1],
+                                               request->args[2], (void *)request->args[3]);
+            break;
+        case P_VIRTIO_PUT_BUFFERS:
+            virtio_put_buffers(request->args[0], request->args[1], (void *)request->args[2],
+                               request->args[3]);
+            break;
+        case P_HV_TLBI_ALL:
+            hv_tlbi_all();
+            break;
 
         case P_FB_INIT:
             fb_init(request->args[0]);
@@ -81,6 +81,7 @@ typedef enum {
 
     P_XZDEC = 0x400, // Decompression and data processing ops
     P_GZDEC,
+    P_MEMHASH64,
 
     P_SMP_START_SECONDARIES = 0x500, // SMP and system management ops
     P_SMP_CALL,
@@ -145,6 +146,10 @@ typedef enum {
     P_VIRTIO_PUT_BUFFER,
     P_HV_EXIT_CPU,
     P_HV_ADD_TIME,
+    P_HV_TRANSLATE_RANGE,
+    P_HV_MAP_BATCH,
+    P_VIRTIO_PUT_BUFFERS,
+    P_HV_TLBI_ALL,
 
     P_FB_INIT = 0xd00,
     P_FB_SHUTDOWN,
@@ -187,6 +187,81 @@ bool is_heap(void *addr)
     return p > top_of_kernel_data && p < top_of_ram;
 }
 
+#define MEMHASH_PRIME1 0x9e3779b185ebca87UL
+#define MEMHASH_PRIME2 0xc2b2ae3d27d4eb4fUL
+#define MEMHASH_PRIME3 0x165667b19e3779f9UL
+#define MEMHASH_PRIME4 0x85ebca77c2b2ae63UL
+#define MEMHASH_PRIME5 0x27d4eb2f165667c5UL
+
+static inline u64 memhash_rotl(u64 v, int n)
+{
+    return (v << n) | (v >> (64 - n));
+}
+
+static inline u64 memhash_round(u64 acc, u64 word)
+{
+    acc += word * MEMHASH_PRIME2;
+    return memhash_rotl(acc, 31) * MEMHASH_PRIME1;
+}
+
+static inline u64 memhash_merge(u64 h, u64 acc)
+{
+    h ^= memhash_round(0, acc);
+    return h * MEMHASH_PRIME1 + MEMHASH_PRIME4;
+}
+
+/*
+ * Fast non-cryptographic hash of a 8-byte aligned block, for detecting
+ * changed memory without transferring it. This is XXH64 (seed 0) for sizes
+ * that are a multiple of 8, so every input bit avalanches into the result.
+ * All-zero blocks, and only those, hash to 0, so a zero hash proves the block
+ * is zero. proxyclient/m1n1/hv/snapshot.py has a reference copy.
+ */
+u64 memhash64(const void *data, size_t size)
+{
+    const u64 *p = data;
+    size_t i = 0, words = size / 8;
+    u64 any = 0, h;
+
+    if (words >= 4) {
+        u64 v1 = MEMHASH_PRIME1 + MEMHASH_PRIME2, v2 = MEMHASH_PRIME2, v3 = 0, v4 = -MEMHASH_PRIME1;
+
+        for (; i + 4 <= words; i += 4) {
+            any |= p[i + 0] | p[i + 1] | p[i + 2] | p[i + 3];
+            v1 = memhash_round(v1, p[i + 0]);
+            v2 = memhash_round(v2, p[i + 1]);
+            v3 = memhash_round(v3, p[i + 2]);
+            v4 = memhash_round(v4, p[i + 3]);
+        }
+
+        h = memhash_rotl(v1, 1) + memhash_rotl(v2, 7) + memhash_rotl(v3, 12) +
+            memhash_rotl(v4, 18);
+        h = memhash_merge(h, v1);
+        h = memhash_merge(h, v2);
+        h = memhash_merge(h, v3);
+        h = memhash_merge(h, v4);
+    } else {
+        h = MEMHASH_PRIME5;
+    }
+
+    h += size;
+    for (; i < words; i++) {
+        any |= p[i];
+        h ^= memhash_round(0, p[i]);
+        h = memhash_rotl(h, 27) * MEMHASH_PRIME1 + MEMHASH_PRIME4;
+    }
+
+    h ^= h >> 33;
+    h *= MEMHASH_PRIME2;
+    h ^= h >> 29;
+    h *= MEMHASH_PRIME3;
+    h ^= h >> 32;
+
+    if (!any)
+        return 0;
+    return h ? h : 1;
+}
+
 bool supports_arch_retention(void)
 {
     return mrs(AIDR_EL1) & AIDR_EL1_ARCH_RETENTION;
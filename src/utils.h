@@ -522,6 +522,7 @@ void cpu_sleep(bool deep) __attribute__((noreturn));
 void deep_wfi(void);
 
 bool is_heap(void *addr);
+u64 memhash64(const void *data, size_t size);
 bool supports_arch_retention(void);
 bool supports_gxf(void);
 bool supports_pan(void);
@@ -1,9 +1,19 @@
 # SPDX-License-Identifier: MIT
 """m1n1 tests common fixtures"""
 
+import contextlib
+import gzip
+import struct
+import types
+
 import pytest
+from construct import Container
 
 from proxyclient.m1n1.asm import ARMAsm
+from proxyclient.m1n1.hv import HV
+from proxyclient.m1n1.hv.snapshot import memhash64
+from proxyclient.m1n1.proxyutils import ProxyUtils
+from proxyclient.m1n1.sysreg import sysreg_parse
 from proxyclient.m1n1.toolchain import Toolchain
 
 CODE_LOCATION = 0x1238
@@ -71,6 +81,199 @@ NM_OUTPUT_GCC = """0000000000011258 T __bss_end__
 
 NM_ERROR_GCC = " 'a.out': No such file\n"
 
+PAGE = 0x1000
+
+
+class SimTarget:
+    """Simulated proxy target with a guest page table and a round trip log"""
+
+    HEAP = 0x9_0000_0000
+    EXC_INFO = 0x80_0000
+
+    def __init__(self, mapping, mem_size=0x400_0000):
+        self.mapping = dict(mapping)
+        self.mem = bytearray(mem_size)
+        self.trips = []
+        self.heap = self
+        self.map_ops = []
+        self.tlbi = []
+        self.sysregs = {}
+        self.simd_buf = 0x3f0_0000
+        self.simd_state = bytes(range(256)) * 2
+        self.cpu_features = types.SimpleNamespace(apple_sysregs_unlocked=False)
+
+    def malloc(self, size):
+        return self.HEAP
+
+    @contextlib.contextmanager
+    def guarded_malloc(self, size):
+        yield self.HEAP
+
+    def _pa(self, va):
+        page = self.mapping.get(va & ~(PAGE - 1))
+        return 0 if page is None else page | (va & (PAGE - 1))
+
+    def hv_translate(self, addr, s1=False, w=False):
+        self.trips.append(("translate", 0))
+        return self._pa(addr)
+
+    def hv_translate_range(self, addr, count, w, buf):
+        self.trips.append(("translate_range", 0))
+        pages = []
+        for i in range(count):
+            pa = self._pa(addr + i * PAGE)
+            if not pa:
+                break
+            pages.append(pa)
+        self._buf = struct.pack(f"<{len(pages)}Q", *pages)
+        return len(pages)
+
+    def hv_map(self, from_, to, size, incr):
+        self.trips.append(("hv_map", 0))
+        self.map_ops.append((from_, to, size, incr))
+        return 0
+
+    def hv_map_batch(self, ops, count, tlbi_all=False):
+        self.trips.append(("hv_map_batch", 0))
+        for op in struct.iter_unpack("<4Q", self._buf[:32 * count]):
+            self.map_ops.append((*op[:3], op[3] & 1))
+            if op[3] & 2 and not tlbi_all:
+                self.tlbi.append(range(op[0], op[0] + op[2]))
+        if tlbi_all:
+            self.tlbi.append("all")
+        return count
+
+    def hv_tlbi_all(self):
+        self.trips.append(("hv_tlbi_all", 0))
+        self.tlbi.append("all")
+
+    def read(self, addr, width):
+        words = [self.read64(addr + i) for i in range(0, max(8, width // 8), 8)]
+        self.get_exc_count()
+        return words[0] if width <= 64 else words
+
+    def write(self, addr, data, width):
+        if width <= 64:
+            data = [data]
+        for i, word in enumerate(data):
+            self.write64(addr + 8 * i, word)
+        self.get_exc_count()
+
+    def read64(self, addr):
+        self.trips.append(("read64", 0))
+        return struct.unpack_from("<Q", self.mem, addr)[0]
+
+    def write64(self, addr, data):
+        self.trips.append(("write64", 0))
+        struct.pack_into("<Q", self.mem, addr, data)
+
+    def memcpy64(self, dst, src, size):
+        self.trips.append(("memcpy64", 0))
+        self.mem[dst:dst + size] = self.mem[src:src + size]
+
+    def memset64(self, addr, value, size):
+        self.trips.append(("memset64", 0))
+        self.mem[addr:addr + size] = struct.pack("<Q", value) * (size // 8)
+
+    def memhash64(self, addr, block, count, outbuf):
+        self.trips.append(("memhash64", 0))
+        self._buf = b"".join(struct.pack("<Q", memhash64(self.mem[addr + i * block:addr + (i + 1) * block]))
+                             for i in range(count))
+        return count
+
+    def compressed_writemem(self, dest, data, progress=None):
+        self.writemem(dest, data)
+
+    def mrs(self, reg, *, silent=False, call=None):
+        self.trips.append(("mrs", 0))
+        return self.sysregs.get(sysreg_parse(reg), 0)
+
+    def msr(self, reg, val, *, silent=False, call=None):
+        self.trips.append(("msr", 0))
+        self.sysregs[sysreg_parse(reg)] = val
+
+    def get_simd_state(self, buf):
+        self.mem[buf:buf + 512] = self.simd_state
+
+    def put_simd_state(self, buf):
+        self.simd_state = bytes(self.mem[buf:buf + 512])
+
+    def push_simd(self):
+        pass
+
+    def ic_ialluis(self):
+        pass
+
+    def get_exc_count(self):
+        self.trips.append(("get_exc_count", 0))
+        return 0
+
+    def readmem(self, addr, size):
+        self.trips.append(("readmem", size))
+        if addr == self.HEAP:
+            return self._buf[:size]
+        return bytes(self.mem[addr:addr + size])
+
+    def writemem(self, addr, data):
+        self.trips.append(("writemem", len(data)))
+        if addr == self.HEAP:
+            self._buf = bytes(data)
+            return
+        self.mem[addr:addr + len(data)] = data
+
+    def fill_pages(self):
+        """Fill each physical page with its page number"""
+        for i in range(len(self.mem) // PAGE):
+            self.mem[i * PAGE:(i + 1) * PAGE] = bytes([i & 0xff]) * PAGE
+
+    def new_hv(self):
+        return HV(self, self, self)
+
+    def stopped_hv(self):
+        """Return a HV stopped in a guest data abort, with its context loaded"""
+        words = [0x1000 + i for i in range(46)]
+        words[32] = 0x3c5       # SPSR: EL1h, DAIF masked
+        words[34] = 0x96000045  # ESR: data abort, write
+        self.mem[self.EXC_INFO:self.EXC_INFO + 46 * 8] = struct.pack("<46Q", *words)
+        hv = self.new_hv()
+        hv.exc_info = self.EXC_INFO
+        hv._load_context()
+        self.trips.clear()
+        return hv
+
+
+class LoadTarget(SimTarget):
+    """SimTarget with the ProxyUtils segment loader and gzdec"""
+
+    _gz_upload = ProxyUtils._gz_upload
+    write_segments = ProxyUtils.write_segments
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dev = Container(timeout=1)
+
+    @property
+    def proxy(self):
+        return self
+
+    @property
+    def iface(self):
+        return self
+
+    def writemem(self, addr, data, progress=None):
+        super().writemem(addr, data)
+
+    def gzdec(self, inbuf, insize, outbuf, outsize):
+        self.trips.append(("gzdec", 0))
+        data = gzip.decompress(self._buf[:insize])[:outsize]
+        self.mem[outbuf:outbuf + len(data)] = data
+        return len(data)
+
+    def memset8(self, addr, value, size):
+        self.trips.append(("memset8", 0))
+        self.mem[addr:addr + size] = bytes([value]) * size
+
+
 @pytest.fixture
 def fx_asm_object_start():
     """Return start location address"""
@@ -113,3 +316,15 @@ def fx_loadobjs_nm_error():
 def fx_toolchain():
     """Return toolchain"""
     return Toolchain()
+
+
+@pytest.fixture
+def fx_sim_target():
+    """Return the simulated proxy target class"""
+    return SimTarget
+
+
+@pytest.fixture
+def fx_load_target():
+    """Return the simulated proxy target class with the segment loader"""
+    return LoadTarget
@@ -0,0 +1,202 @@
+# SPDX-License-Identifier: MIT
+"""Tests for proxyclient/m1n1/adt.py"""
+
+import struct
+
+import pytest
+from construct import Container
+
+from proxyclient.m1n1.adt import ADTNodeStruct, load_adt
+
+
+def _prop(name, value):
+    return {"name": name, "size": len(value), "value": value}
+
+
+def _node(name, props=(), children=()):
+    properties = [_prop("name", name.encode("ascii") + b"\0"), *props]
+    return {
+        "property_count": len(properties),
+        "child_count": len(children),
+        "properties": properties,
+        "children": list(children),
+    }
+
+
+def _reg(*regs):
+    return b"".join(struct.pack("<QQ", addr, size) for addr, size in regs)
+
+
+def _device(name, addr, size=0x4000):
+    return _node(name, [_prop("reg", _reg((addr, size)))])
+
+
+def _pmgr_devices():
+    dev = bytearray(0x30)
+    dev[3] = 1
+    dev2 = bytearray(0x30)
+    dev2[3] = 2
+    return bytes(dev + dev2)
+
+
+@pytest.fixture
+def fx_adt_blob():
+    """Return a small synthetic ADT blob"""
+    cells = [_prop("#address-cells", struct.pack("<I", 2)),
+             _prop("#size-cells", struct.pack("<I", 2))]
+    arm_io = _node("arm-io", [
+        *cells,
+        _prop("ranges", struct.pack("<QQQ", 0x0, 0x200000000, 0x100000000)),
+    ], [
+        _device("uart0", 0x35200000),
+        _device("aic", 0x3b100000, 0x10000),
+        _node("pmgr", [
+            _prop("reg", _reg((0x3b700000, 0x14000))),
+            _prop("devices", _pmgr_devices()),
+        ]),
+        _node("i2c0", [*cells, _prop("reg", _reg((0x35010000, 0x4000)))], [
+            _node("codec", [_prop("reg", struct.pack("<I", 0x38))]),
+        ]),
+    ])
+    root = _node("device-tree", cells, [
+        arm_io,
+        _node("chosen", [_prop("boot-args", b"debug=0x8\0")]),
+    ])
+    return ADTNodeStruct.build(root)
+
+
+@pytest.fixture
+def fx_adt(fx_adt_blob):
+    """Return the synthetic ADT parsed"""
+    return load_adt(fx_adt_blob)
+
+
+def _lookup_state(lookup, other):
+    state = {}
+    for zone, values in list(lookup.items()) + list(other.items()):
+        for addr in (zone.start, zone.stop - 1):
+            state[addr] = (lookup.lookup(addr), [v[0] for v in lookup.lookup_all(addr)])
+    return state
+
+
+class TestADTLookup:
+    """proxyclient.m1n1.adt.ADTNode lookup tests"""
+
+    def test_roundtrip(self, fx_adt, fx_adt_blob):
+        """Build reproduces the parsed blob"""
+        assert fx_adt.build() == fx_adt_blob
+
+    def test_path_lookup(self, fx_adt):
+        """Paths resolve with and without leading slashes"""
+        uart = fx_adt["/arm-io/uart0"]
+        assert uart.name == "uart0"
+        assert fx_adt["arm-io/uart0"] is uart
+        assert fx_adt["arm-io"]["uart0"] is uart
+        assert fx_adt["/arm-io/i2c0/codec"].reg == 0x38
+        with pytest.raises(KeyError, match="Child node 'uart1' not found"):
+            fx_adt["/arm-io/uart1"]
+        assert "/arm-io/uart0" in fx_adt
+        assert "/arm-io/uart1" not in fx_adt
+
+    def test_index_follows_mutation(self, fx_adt):
+        """Child and path indexes track insertion, removal and renames"""
+        assert "/arm-io/virtio0" not in fx_adt
+        node = fx_adt.create_node("/arm-io/virtio0")
+        assert fx_adt["/arm-io/virtio0"] is node
+
+        node.name = "virtio1"
+        assert "/arm-io/virtio0" not in fx_adt
+        assert fx_adt["/arm-io/virtio1"] is node
+
+        del fx_adt["/arm-io/virtio1"]
+        with pytest.raises(KeyError):
+            fx_adt["/arm-io/virtio1"]
+
+        other = fx_adt.create_node("/arm-io/virtio1")
+        assert fx_adt["/arm-io/virtio1"] is other
+
+    def test_addr_lookup(self, fx_adt):
+        """Address lookup translates reg through the parent ranges"""
+        lookup = fx_adt.build_addr_lookup()
+        assert lookup.lookup(0x235200000)[0] == "uart0[0]"
+        assert lookup.lookup(0x23b10fff0)[0] == "aic[0]"
+        assert lookup.lookup(0x235010000)[0] == "i2c0[0]"
+        assert fx_adt.build_addr_lookup() is lookup
+
+    def test_addr_lookup_incremental(self, fx_adt, fx_adt_blob):
+        """Incremental updates match a lookup built from scratch"""
+        lookup = fx_adt.build_addr_lookup()
+
+        node = fx_adt.create_node("/arm-io/virtio0")
+        node.reg = [Container(addr=0x3c000000, size=0x1000)]
+        fx_adt["/arm-io/uart0"].reg = [Container(addr=0x35204000, size=0x4000)]
+        del fx_adt["/arm-io/aic"]
+
+        assert fx_adt.build_addr_lookup() is lookup
+        assert lookup.lookup(0x23c000000)[0] == "virtio0[0]"
+        assert lookup.lookup(0x235200000)[0] == "unknown"
+        assert lookup.lookup(0x23b100000)[0] == "unknown"
+
+        fresh = load_adt(fx_adt.build()).build_addr_lookup()
+        assert _lookup_state(lookup, fresh) == _lookup_state(fresh, lookup)
+
+    def test_addr_lookup_order(self, fx_adt):
+        """Overlapping entries keep the order of a fresh build after incremental updates"""
+        lookup = fx_adt.build_addr_lookup()
+        # uart0 comes before i2c0 in the tree, so a fresh build returns it first
+        fx_adt["/arm-io/uart0"].reg = [Container(addr=0x35010000, size=0x8000)]
+        fx_adt["/arm-io"]["pmgr"].reg = [Container(addr=0x35014000, size=0x4000)]
+        assert fx_adt.build_addr_lookup() is lookup
+        assert lookup.lookup(0x235010000)[0] == "uart0[0]"
+        assert lookup.lookup(0x235014000)[0] == "uart0[0]"
+
+        fresh = load_adt(fx_adt.build()).build_addr_lookup()
+        assert _lookup_state(lookup, fresh) == _lookup_state(fresh, lookup)
+
+
+class TestADTPatches:
+    """proxyclient.m1n1.adt.ADTNode modification tracking tests"""
+
+    @staticmethod
+    def _apply(blob, patches):
+        data = bytearray(blob)
+        for off, value in patches:
+            data[off:off + len(value)] = value
+        return bytes(data)
+
+    def test_clean(self, fx_adt):
+        """A freshly loaded tree has nothing to patch"""
+        assert fx_adt.build_patches() == []
+
+    def test_same_size(self, fx_adt, fx_adt_blob):
+        """Same-size assignments produce in-place patches"""
+        fx_adt["chosen"].boot_args = "debug=0x9"
+        fx_adt["/arm-io/uart0"].reg = [Container(addr=0x35204000, size=0x4000)]
+        patches = fx_adt.build_patches()
+        assert len(patches) == 2
+        assert self._apply(fx_adt_blob, patches) == fx_adt.build()
+
+    def test_touch(self, fx_adt, fx_adt_blob):
+        """In-place edits are picked up once touched"""
+        fx_adt["/arm-io/aic"].reg[0].size = 0x8000
+        assert fx_adt.build_patches() == []
+        fx_adt["/arm-io/aic"].touch("reg")
+        assert self._apply(fx_adt_blob, fx_adt.build_patches()) == fx_adt.build()
+
+    def test_layout_change(self, fx_adt):
+        """Size or structure changes need a full rebuild"""
+        fx_adt["chosen"].boot_args = "debug=0x100"
+        assert fx_adt.build_patches() is None
+
+        fx_adt._sync(fx_adt.build())
+        assert fx_adt.build_patches() == []
+        fx_adt.create_node("/arm-io/virtio0")
+        assert fx_adt.build_patches() is None
+
+    def test_sync_after_rebuild(self, fx_adt):
+        """Offsets are refreshed after a full rebuild"""
+        fx_adt["chosen"].boot_args = "debug=0x100"
+        blob = fx_adt.build()
+        fx_adt._sync(blob)
+        fx_adt["/arm-io/uart0"].reg = [Container(addr=0x35204000, size=0x4000)]
+        assert self._apply(blob, fx_adt.build_patches()) == fx_adt.build()
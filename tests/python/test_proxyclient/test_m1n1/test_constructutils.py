@@ -0,0 +1,184 @@
+# SPDX-License-Identifier: MIT
+"""Tests for proxyclient/m1n1/constructutils.py"""
+
+import importlib
+import io
+import pathlib
+import pkgutil
+import random
+import sys
+import time
+
+import pytest
+
+# The firmware structure modules import m1n1 as a top-level package, so the
+# classes under test must come from there and not from proxyclient.m1n1
+sys.path.insert(0, str(pathlib.Path(__file__).parents[4] / "proxyclient"))
+
+# pylint: disable=wrong-import-position
+from m1n1.constructutils import ConstructClass, Ver
+from m1n1.fw import agx, dcp
+
+
+def _corpus():
+    """Fixed-size AGX and DCP structures that parse from seeded random data"""
+    classes = {}
+    for pkg in (agx, dcp):
+        for info in pkgutil.iter_modules(pkg.__path__):
+            try:
+                mod = importlib.import_module(f"{pkg.__name__}.{info.name}")
+            except ImportError:
+                continue
+            for value in vars(mod).values():
+                if (isinstance(value, type) and issubclass(value, ConstructClass)
+                        and "subcon" in value.__dict__):
+                    classes[value.__name__] = value
+
+    corpus = []
+    for name, cls in sorted(classes.items()):
+        try:
+            data = random.Random(name).randbytes(cls.sizeof())
+            cls.parse(data)
+        except Exception:
+            # Const and Enum fields reject random data
+            continue
+        corpus.append(pytest.param(cls, data, id=name))
+    return corpus
+
+
+CORPUS = _corpus()
+
+
+@pytest.mark.parametrize("cls,data", CORPUS)
+def test_roundtrip(cls, data):
+    """Build of a parsed structure reproduces the serialized data"""
+    assert cls.build(cls.parse(data)) == data
+
+
+@pytest.mark.parametrize("cls,data", CORPUS)
+def test_compiled_parse(monkeypatch, cls, data):
+    """Compiled and interpreted parsers agree"""
+    obj = cls.parse(data)
+    monkeypatch.setattr(cls, "_parser", cls.subcon)
+    ref = cls.parse(data)
+    assert ({k: v for k, v in obj.items() if not callable(v)} ==
+            {k: v for k, v in ref.items() if not callable(v)})
+    assert obj._pointers == ref._pointers
+
+
+@pytest.mark.parametrize("cls,data", CORPUS)
+def test_layout(cls, data):
+    """Precomputed layout matches the class offsets and child addresses"""
+    obj = cls.parse(data)
+    layout = cls._layout()
+    names = [i[0] for i in layout]
+    for name, off, size, is_pointer in layout:
+        if names.count(name) > 1:
+            continue
+        if cls._off.get(name, (-1, 0))[0] >= 0:
+            assert cls._off[name][0] == off
+        val = obj.get(name, None)
+        if isinstance(val, ConstructClass):
+            assert val._addr == obj._addr + off
+
+
+def test_layout_tail():
+    """Fields after a variable-size field get addresses and metadata per instance"""
+    from construct import Array, Int32ul, Struct, this
+
+    class Child(ConstructClass):
+        subcon = Struct("x" / Int32ul)
+
+    class Parent(ConstructClass):
+        subcon = Struct(
+            "count" / Int32ul,
+            "items" / Array(this.count, Int32ul),
+            "tail" / Int32ul,
+            "child" / Child,
+        )
+
+    meta = {}
+    def meta_fn(addr, size):
+        meta[addr] = size
+
+    for count in (1, 3):
+        data = Parent.subcon.build({"count": count, "items": list(range(count)), "tail": 5, "child": {"x": 7}})
+        stream = io.BytesIO(b"\0" * 0x100 + data)
+        stream.meta_fn = meta_fn
+        stream.seek(0x100)
+        meta.clear()
+        obj = Parent.parse_stream(stream)
+        tail = 0x100 + 4 + 4 * count
+        assert meta[tail] == 4 and meta[tail + 4] == 4
+        assert obj.child._addr == tail + 4
+        assert obj.tail == 5 and obj.child.x == 7
+
+
+@pytest.fixture
+def fx_version():
+    """Restore the target version after the test"""
+    saved = dict(Ver._version)
+    yield
+    for key, value in saved.items():
+        Ver.set_version_key(key, value)
+
+
+def test_ver_cache(fx_version):
+    """Version predicates follow set_version_key"""
+    Ver.set_version_key("V", "V13_0B4")
+    assert Ver.check("V >= V13_0B4")
+    assert not Ver.check("V >= V13_5")
+    Ver.set_version_key("V", "V13_5")
+    assert Ver.check("V >= V13_5")
+    assert Ver.check("V >= V13_0B4 && V < V13_5 || G >= G13")
+
+
+def test_ver_cache_fields(fx_version):
+    """Ver fields are memoized per expression and re-evaluated after a version change"""
+    from construct import Int32ul, Struct
+    s = Struct("a" / Int32ul, "b" / Ver("V >= V13_5", Int32ul), "c" / Int32ul)
+    data = bytes(range(12))
+
+    Ver.set_version_key("V", "V13_5")
+    assert s.parse(data).b == 0x07060504
+    assert Ver._cache["V >= V13_5"] is True
+    Ver.set_version_key("V", "V13_5")
+    assert "V >= V13_5" in Ver._cache
+
+    Ver.set_version_key("V", "V13_0B4")
+    assert "V >= V13_5" not in Ver._cache
+    obj = s.parse(data)
+    assert obj.b is None and obj.c == 0x07060504
+    assert s.build(obj) == data[:8]
+
+
+def bench_ver(count=5):
+    """Time parse and build of the InitData regions with and without cached version predicates"""
+    from m1n1.fw.agx.initdata import AGXHWDataA, AGXHWDataB, InitData_RegionB, InitData_RegionC
+
+    def run(desc):
+        for cls in (InitData_RegionB, InitData_RegionC, AGXHWDataA, AGXHWDataB):
+            data = bytes(cls.sizeof())
+            obj = cls.parse(data)
+            start = time.perf_counter()
+            for i in range(count):
+                cls.parse(data)
+            mid = time.perf_counter()
+            for i in range(count):
+                cls.build(obj)
+            end = time.perf_counter()
+            print(f"{desc:<10} {cls.__name__:<20} parse {(mid - start) / count * 1000:8.2f} ms"
+                  f"  build {(end - mid) / count * 1000:8.2f} ms")
+
+    # Baseline: evaluate every version predicate from scratch
+    active = Ver._active
+    Ver._active = lambda self: self.vcheck(self._version)
+    try:
+        run("uncached")
+    finally:
+        Ver._active = active
+    run("cached")
+
+
+if __name__ == "__main__":
+    bench_ver()
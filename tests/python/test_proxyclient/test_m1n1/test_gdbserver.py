@@ -0,0 +1,202 @@
+# SPDX-License-Identifier: MIT
+"""Tests for proxyclient/m1n1/hv/gdbserver/__init__.py"""
+
+import os
+import socket
+import time
+
+import pytest
+from construct import Container
+
+from proxyclient.m1n1.hv.gdbserver import GDBServer
+from proxyclient.m1n1.proxyutils import ProxyUtils
+from proxyclient.m1n1.sysreg import FPCR, FPSR, sysreg_parse
+
+PAGE = 0x1000
+STACK = 0x10_8000
+
+# GDBServer wakes its loop through an eventfd (Linux, Python 3.10+)
+pytestmark = pytest.mark.skipif(not hasattr(os, "eventfd"), reason="os.eventfd not available")
+
+
+class SimdCache:
+    """ProxyUtils SIMD register cache, mixed into a simulated target"""
+
+    simd = simd_type = None
+    get_simd = ProxyUtils.get_simd
+    push_simd = ProxyUtils.push_simd
+    q = ProxyUtils.q
+
+    @property
+    def proxy(self):
+        return self
+
+    @property
+    def iface(self):
+        return self
+
+
+def _gdb_target(target_cls, mapping):
+    return type("GDBTarget", (SimdCache, target_cls), {})(mapping)
+
+
+@pytest.fixture
+def fx_gdb(tmp_path, fx_sim_target):
+    """Return a GDBServer on a stopped guest with 256 mapped pages at 0x100000"""
+    mapping = {0x10_0000 + i * PAGE: 0x100_0000 + i * PAGE for i in range(256)}
+    target = _gdb_target(fx_sim_target, mapping)
+    target.fill_pages()
+    target.sysregs[sysreg_parse(FPSR)] = 0x10
+    target.sysregs[sysreg_parse(FPCR)] = 0x20
+    hv = target.stopped_hv()
+    hv.ctx.sp[1] = STACK
+    hv.ctx.clean()
+    server = GDBServer(hv, str(tmp_path / "gdb.sock"), None)
+    return server, hv, target
+
+
+def _eval(server, data):
+    return server._GDBServer__eval(data)
+
+
+def _trips(target, name):
+    return sum(1 for trip in target.trips if trip[0] == name)
+
+
+class TestGDBServer:
+    """proxyclient.m1n1.hv.gdbserver.GDBServer tests"""
+
+    def test_cache(self, fx_gdb):
+        """Repeated reads in a stop are served from the cache"""
+        server, hv, target = fx_gdb
+        ref = hv.readmem(0x10_1ff0, 0x40)
+        target.trips.clear()
+        assert _eval(server, b"m101ff0,40") == bytes(ref.hex(), "utf-8")
+        reads = _trips(target, "readmem")
+        assert reads == 2
+        for addr in range(0x10_1000, 0x10_2ff0, 0x10):
+            _eval(server, f"m{addr:x},10".encode())
+        assert _trips(target, "readmem") == reads
+
+        server.notify_in_shell()
+        _eval(server, b"m101ff0,40")
+        assert _trips(target, "readmem") > reads
+
+    def test_stack(self, fx_gdb):
+        """A miss near the stack pointer reads ahead in one transfer"""
+        server, hv, target = fx_gdb
+        ref = hv.readmem(STACK, 0x4000)
+        target.trips.clear()
+        out = b"".join(bytes.fromhex(_eval(server, f"m{addr:x},100".encode()).decode())
+                       for addr in range(STACK, STACK + 0x4000, 0x100))
+        assert out == ref
+        assert target.trips.count(("readmem", 0x4000)) == 1
+        assert _trips(target, "readmem") == 1
+
+    def test_fault(self, fx_gdb):
+        """Reads stop at unmapped memory and are not retried"""
+        server, hv, target = fx_gdb
+        end = 0x10_0000 + 256 * PAGE
+        assert len(_eval(server, f"m{end - 8:x},10".encode())) == 16
+        reads = _trips(target, "readmem")
+        assert _eval(server, f"x{end:x},10".encode()) == b"E14"
+        assert _trips(target, "readmem") == reads
+
+    def test_write(self, fx_gdb):
+        """Writes go through and invalidate cached lines"""
+        server, hv, target = fx_gdb
+        _eval(server, b"m100000,10")
+        assert _eval(server, b"X100004,4:\x23\x7d\x24\x2a") == b"OK"
+        assert _eval(server, b"x100000,8") == bytes(4) + b"\x23\x7d\x24\x2a"
+        assert _eval(server, b"M100000,2:abcd") == b"OK"
+        assert _eval(server, b"m100000,6") == b"abcd0000237d"
+
+    def test_binary_dialects(self, fx_gdb):
+        """GDB gets b-prefixed x replies once it negotiates binary-upload, LLDB gets raw data"""
+        server, hv, target = fx_gdb
+        assert _eval(server, b"x0,0") == b"OK"
+        assert _eval(server, b"x100000,4") == bytes(4)
+
+        assert b"binary-upload+" in _eval(server, b"qSupported:multiprocess+;binary-upload+")
+        assert _eval(server, b"x0,0") == b"b"
+        assert _eval(server, b"x100000,4") == b"b" + bytes(4)
+
+        _eval(server, b"qSupported:multiprocess+")
+        assert _eval(server, b"x100000,4") == bytes(4)
+
+    def test_decode(self, fx_gdb):
+        """Escaped bytes in binary packets are decoded"""
+        server, hv, target = fx_gdb
+        hv._in_shell = True
+        payload = b"X100000,4:}\x03}]}\x04}\x0a"
+        ours, theirs = socket.socketpair()
+        theirs.sendall(b"$" + payload + b"#" + bytes(format(sum(payload) % 256, "02x"), "utf-8"))
+        theirs.shutdown(socket.SHUT_WR)
+        server._GDBServer__handle(ours)
+        assert theirs.recv(64) == b"+$OK#9a"
+        assert bytes(target.mem[0x100_0000:0x100_0004]) == b"\x23\x7d\x24\x2a"
+
+    def test_registers(self, fx_gdb):
+        """SIMD and FP control registers are read once per stop and CPU"""
+        server, hv, target = fx_gdb
+        target.trips.clear()
+        g = _eval(server, b"g")
+        assert _eval(server, b"g") == g
+        assert _eval(server, b"p42") == b"10000000"
+        assert _trips(target, "mrs") == 2
+
+        assert _eval(server, b"P43=30000000") == b"OK"
+        assert target.sysregs[sysreg_parse(FPCR)] == 0x30
+        assert _eval(server, b"p43") == b"30000000"
+        assert _eval(server, b"P1f=0080100000000000") == b"OK"
+        assert hv.ctx.sp[1] == STACK
+
+        _eval(server, b"G" + g)
+        assert target.sysregs[sysreg_parse(FPCR)] == 0x20
+
+    def test_memory_map(self, fx_gdb):
+        """The memory map covers user space and guest RAM"""
+        server, hv, target = fx_gdb
+        hv.xnu_mode = True
+        hv.tba = Container(virt_base=0xfffffe0010000000, mem_size=0x2_0000_0000)
+        assert b"qXfer:memory-map:read+" in _eval(server, b"qSupported")
+        xml = _eval(server, b"qXfer:memory-map:read::0,1000")
+        assert xml.startswith(b"l<?xml")
+        assert b'start="0x0" length="0x100000000000"' in xml
+        assert b'start="0xfffffe0010000000" length="0x200000000"' in xml
+        assert _eval(server, b"qXfer:memory-map:read::0,10").startswith(b"m<?xml")
+
+
+def bench(target_cls, reads=2000, latency=100e-6, bandwidth=8e6):
+    """Model the link cost of a backtrace-like read pattern with and without the cache"""
+    mapping = {0x10_0000 + i * PAGE: 0x100_0000 + i * PAGE for i in range(256)}
+    target = _gdb_target(target_cls, mapping)
+    hv = target.stopped_hv()
+    hv.ctx.sp[1] = STACK
+    server = GDBServer(hv, "/tmp/m1n1-gdb-bench.sock", None)
+    pattern = [f"m{STACK + (i * 0x18) % 0x3000:x},10".encode() for i in range(reads // 2)]
+    pattern += [f"m{0x10_0000 + (i * 0x84) % 0x8000:x},4".encode() for i in range(reads // 2)]
+
+    def run(label, packets):
+        target.trips.clear()
+        start = time.perf_counter()
+        for packet in packets:
+            _eval(server, packet)
+        host = time.perf_counter() - start
+        link = sum(latency + n / bandwidth for _, n in target.trips)
+        print(f"{label:>8}: {len(target.trips):6d} round trips, {link:7.3f}s link, {host:7.3f}s host")
+
+    target.trips.clear()
+    start = time.perf_counter()
+    for packet in pattern:
+        addr, size = (int(f, 16) for f in packet[1:].decode().split(","))
+        hv.readmem(addr, size)
+    link = sum(latency + n / bandwidth for _, n in target.trips)
+    print(f"{'direct':>8}: {len(target.trips):6d} round trips, {link:7.3f}s link, "
+          f"{time.perf_counter() - start:7.3f}s host")
+    run("cached", pattern)
+
+
+if __name__ == "__main__":
+    from conftest import SimTarget
+    bench(SimTarget)
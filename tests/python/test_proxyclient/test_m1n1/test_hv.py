@@ -0,0 +1,837 @@
+# SPDX-License-Identifier: MIT
+"""Tests for proxyclient/m1n1/hv/__init__.py"""
+
+import io
+import plistlib
+import struct
+import sys
+import threading
+import time
+import types
+
+import pytest
+from construct import Container
+
+from proxyclient.m1n1 import trace
+from proxyclient.m1n1.hv import HV, TraceMode
+from proxyclient.m1n1.hv.types import EvtMMIOTrace, MMIOTraceFlags, MSRPolicy, VMProxyHookData
+from proxyclient.m1n1.proxy import ExcContext, ExcInfo, UartInterface
+from proxyclient.m1n1.sysreg import ESR_ISS_MSR, MSR_DIR, sysreg_parse
+from proxyclient.m1n1.utils import irange
+
+PAGE = 0x1000
+
+
+def _reference(target, va, size):
+    return b"".join(bytes([target.mapping[p] // PAGE & 0xff]) * PAGE
+                    for p in range(va & ~(PAGE - 1), va + size, PAGE)
+                    )[va & (PAGE - 1):][:size]
+
+
+@pytest.fixture
+def fx_target(fx_sim_target):
+    """Return a target with 256 contiguous guest pages and a few scattered ones"""
+    mapping = {0x10_0000 + i * PAGE: 0x100_0000 + i * PAGE for i in range(256)}
+    mapping.update({0x20_0000 + i * PAGE: 0x200_0000 - i * PAGE for i in range(1, 5)})
+    target = fx_sim_target(mapping)
+    target.fill_pages()
+    return target
+
+
+class TestHVMemory:
+    """proxyclient.m1n1.hv.HV guest memory access tests"""
+
+    def test_contiguous(self, fx_target):
+        """A physically contiguous range is one translation and one transfer"""
+        hv = fx_target.new_hv()
+        data = hv.readmem(0x10_0000 + 0x123, 255 * PAGE)
+        assert data == _reference(fx_target, 0x10_0123, 255 * PAGE)
+        assert [t for t, _ in fx_target.trips] == ["translate_range", "readmem", "readmem"]
+
+    def test_scattered(self, fx_target):
+        """Discontiguous pages are split into separate transfers"""
+        hv = fx_target.new_hv()
+        data = hv.readmem(0x20_1800, 3 * PAGE)
+        assert data == _reference(fx_target, 0x20_1800, 3 * PAGE)
+        assert len([t for t, _ in fx_target.trips if t == "readmem"]) == 1 + 4
+
+    def test_fault(self, fx_target):
+        """Reads and writes stop at the first unmapped page"""
+        hv = fx_target.new_hv()
+        assert hv.readmem(0x20_4800, 2 * PAGE) == _reference(fx_target, 0x20_4800, 0x800)
+        assert hv.readmem(0x30_0000, PAGE) == b""
+        assert hv.writemem(0x20_4000, bytes(2 * PAGE)) == PAGE
+        assert hv.readmem(0x20_4000, PAGE) == bytes(PAGE)
+
+    def test_write(self, fx_target):
+        """Writes land on the translated pages"""
+        hv = fx_target.new_hv()
+        data = bytes(range(256)) * 48
+        assert hv.writemem(0x20_1f00, data) == len(data)
+        assert hv.readmem(0x20_1f00, len(data)) == data
+        assert fx_target.mem[0x1ff_ff00:0x200_0000] == data[:0x100]
+
+    def test_cache(self, fx_target):
+        """Translations are reused until flushed"""
+        hv = fx_target.new_hv()
+        hv.readmem(0x10_0000, 16 * PAGE)
+        fx_target.trips.clear()
+        hv.readmem(0x10_4000, 4 * PAGE)
+        assert [t for t, _ in fx_target.trips] == ["readmem"]
+
+        fx_target.mapping[0x10_4000] = 0x300_0000
+        hv._flush_xlate()
+        assert hv.readmem(0x10_4000, 4) == b"\0" * 4
+
+
+def _uart():
+    iface = UartInterface.__new__(UartInterface)
+    iface.dev, iface.debug, iface.forbidden_thread = io.BytesIO(), False, None
+    iface.write_lock = threading.RLock()
+    return iface
+
+
+def _mmio_event(addr, write=False, data=0):
+    flags = MMIOTraceFlags(WIDTH=2, WRITE=int(write))
+    return EvtMMIOTrace.build({"flags": flags, "reserved": 0, "pc": 0x1000,
+                               "addr": addr, "data": data})
+
+
+class TestHVMMIODispatch:
+    """proxyclient.m1n1.hv.HV MMIO trace dispatch tests"""
+
+    def test_dispatch(self, fx_target):
+        """Events reach the tracers mapped at their address"""
+        hv = fx_target.new_hv()
+        seen = []
+        hv.add_tracer(irange(0x1000, 0x100), "a", TraceMode.ASYNC,
+                      read=lambda evt, **kw: seen.append(("a", evt.addr, kw)), tag=1)
+        hv.add_tracer(irange(0x1080, 0x100), "b", TraceMode.UNBUF,
+                      write=lambda evt, **kw: seen.append(("b", evt.addr, kw)))
+
+        hv.handle_mmiotrace(_mmio_event(0x1000))
+        hv.handle_mmiotrace(_mmio_event(0x1000, True))
+        hv.handle_mmiotrace(_mmio_event(0x1100, True))
+        assert seen == [("a", 0x1000, {"tag": 1}), ("b", 0x1100, {})]
+
+    def test_invalidate(self, fx_target):
+        """Adding or removing tracers refreshes the cached handlers"""
+        hv = fx_target.new_hv()
+        seen = []
+        hv.add_tracer(irange(0x1000, 0x100), "a", read=lambda evt: seen.append("a"))
+        hv.handle_mmiotrace(_mmio_event(0x1010))
+
+        hv.add_tracer(irange(0x1000, 0x20), "b", read=lambda evt: seen.append("b"))
+        hv.handle_mmiotrace(_mmio_event(0x1010))
+        hv.del_tracer(irange(0x1000, 0x100), "a")
+        hv.handle_mmiotrace(_mmio_event(0x1010))
+        hv.clear_tracers("b")
+        hv.handle_mmiotrace(_mmio_event(0x1010))
+        assert seen == ["a", "b", "a", "b"]
+
+    def test_flush_zone(self, fx_target):
+        """A tracer change only drops the cached handlers inside its zone"""
+        hv = fx_target.new_hv()
+        for base in (0x1000, 0x2000, 0x3000):
+            hv.add_tracer(irange(base, 0x100), f"dev{base:x}", read=lambda evt: None)
+            for off in (0x0, 0x10, 0xfc):
+                hv.handle_mmiotrace(_mmio_event(base + off))
+        hv.add_tracer(irange(0x2010, 0x10), "b", read=lambda evt: None)
+        assert sorted(hv._mmio_dispatch) == hv._mmio_dispatch_addrs
+        assert hv._mmio_dispatch_addrs == [0x1000, 0x1010, 0x10fc, 0x2000, 0x20fc,
+                                           0x3000, 0x3010, 0x30fc]
+
+    def test_fault(self, fx_target, monkeypatch):
+        """A raising tracer goes through shellwrap without being rerun"""
+        hv = fx_target.new_hv()
+        calls = []
+        def tracer(evt):
+            calls.append(evt.addr)
+            raise ValueError("boom")
+        hv.add_tracer(irange(0x1000, 0x100), "a", read=tracer)
+        monkeypatch.setattr(hv, "run_shell", lambda *args: 1)
+        hv.handle_mmiotrace(_mmio_event(0x1000))
+        assert calls == [0x1000]
+
+
+class TestHVAsyncDecode:
+    """proxyclient.m1n1.hv.HV background decoding tests"""
+
+    def test_order(self, fx_target):
+        """ASYNC events are handled in order off the calling thread"""
+        hv = fx_target.new_hv()
+        seen = []
+        def tracer(evt):
+            seen.append((evt.data, hv.ctx))
+        hv.add_tracer(irange(0x1000, 0x100), "a", TraceMode.ASYNC, write=tracer)
+        hv.async_decode()
+        hv.ctx = "exception"
+        for i in range(100):
+            hv.handle_mmiotrace(_mmio_event(0x1000, True, i))
+        hv.decoder.drain()
+        assert seen == [(i, None) for i in range(100)]
+        assert hv.decoder.stats()["handled"] == 100
+        hv.async_decode(False)
+
+    def test_inline(self, fx_target):
+        """Other modes stay inline"""
+        hv = fx_target.new_hv()
+        seen = []
+        hv.add_tracer(irange(0x1000, 0x100), "a", TraceMode.UNBUF,
+                      write=lambda evt: seen.append(evt.data))
+        hv.async_decode()
+        hv.handle_mmiotrace(_mmio_event(0x1000, True, 1))
+        assert seen == [1]
+        assert hv.decoder.stats()["queued"] == 0
+        hv.async_decode(False)
+
+    def test_drop(self, fx_target):
+        """A full queue drops and counts events"""
+        hv = fx_target.new_hv()
+        gate = threading.Event()
+        hv.add_tracer(irange(0x1000, 0x100), "a", TraceMode.ASYNC,
+                      write=lambda evt: gate.wait())
+        hv.async_decode(depth=2)
+        for i in range(10):
+            hv.handle_mmiotrace(_mmio_event(0x1000, True, i))
+        gate.set()
+        hv.decoder.drain()
+        stats = hv.decoder.stats()
+        assert stats["dropped"] > 0
+        assert stats["handled"] + stats["dropped"] == 10
+        hv.async_decode(False)
+
+    def test_pending(self, fx_target):
+        """Inline handlers wait for queued events of the same tracer only"""
+        hv = fx_target.new_hv()
+        seen = []
+        gate = threading.Event()
+        def slow(evt):
+            gate.wait(5)
+            seen.append("a async")
+        hv.add_tracer(irange(0x1000, 0x100), "a", TraceMode.ASYNC, write=slow)
+        hv.add_tracer(irange(0x2000, 0x100), "a", TraceMode.UNBUF,
+                      write=lambda evt: seen.append("a inline"))
+        hv.add_tracer(irange(0x3000, 0x100), "b", TraceMode.UNBUF,
+                      write=lambda evt: seen.append("b inline"))
+        hv.async_decode()
+        hv.handle_mmiotrace(_mmio_event(0x1000, True))
+        hv.handle_mmiotrace(_mmio_event(0x3000, True))
+        gate.set()
+        hv.handle_mmiotrace(_mmio_event(0x2000, True))
+        assert seen == ["b inline", "a async", "a inline"]
+        hv.async_decode(False)
+
+    def test_worker_requests(self, fx_target):
+        """Target requests from the worker fail instead of interleaving on the link"""
+        hv = fx_target.new_hv()
+        iface = hv.iface = _uart()
+        errors = []
+        def tracer(evt):
+            try:
+                iface.cmd(iface.REQ_NOP)
+            except AssertionError as e:
+                errors.append(e)
+        hv.add_tracer(irange(0x1000, 0x100), "a", TraceMode.ASYNC, write=tracer)
+        hv.async_decode()
+        hv.handle_mmiotrace(_mmio_event(0x1000, True))
+        hv.decoder.drain()
+        assert len(errors) == 1 and not iface.dev.getvalue()
+        iface.cmd(iface.REQ_NOP)
+        assert len(iface.dev.getvalue()) == 4 + iface.CMD_LEN + 4
+        hv.async_decode(False)
+        assert iface.forbidden_thread is None
+
+
+class TestHVLog:
+    """proxyclient.m1n1.hv.HV.log tests"""
+
+    def test_sync(self, fx_target, capsys):
+        """Lines are written at once, repeats included"""
+        hv = fx_target.new_hv()
+        hv.log("a")
+        assert capsys.readouterr().out == "a\n"
+        for i in range(3):
+            hv.log("b", 1, sep="=")
+        hv.log(lambda: "c")
+        assert capsys.readouterr().out == "b=1\n" * 3 + "c\n"
+
+    def test_fold(self, fx_target, capsys):
+        """With fold, repeats are counted and the count is written on flush"""
+        hv = fx_target.new_hv()
+        hv.set_log_mode(fold=True)
+        for i in range(3):
+            hv.log("b", 1, sep="=")
+        hv.log(lambda: "c")
+        hv.log(lambda: "c")
+        assert capsys.readouterr().out == "b=1\n  (last message repeated 2 times)\nc\n"
+        hv.logger.flush()
+        assert capsys.readouterr().out == "  (last message repeated 1 times)\n"
+
+    def test_buffered(self, fx_target, capsys):
+        """Buffered lines are formatted on the writer thread, in order"""
+        hv = fx_target.new_hv()
+        hv.set_log_mode(buffered=True)
+        threads = []
+        for i in range(100):
+            hv.log(lambda i=i: threads.append(threading.current_thread()) or f"line {i}")
+        hv.logger.flush()
+        assert capsys.readouterr().out == "".join(f"line {i}\n" for i in range(100))
+        assert set(threads) == {hv.logger.thread}
+        hv.set_log_mode()
+        assert hv.logger.thread is None
+
+    def test_rate(self, fx_target, capsys):
+        """Sources over the rate limit are counted, other messages are kept"""
+        hv = fx_target.new_hv()
+        hv.set_log_mode(rate=5)
+        for i in range(20):
+            hv.log(f"trace {i}", source="dev")
+            hv.log(f"hv {i}")
+        hv.logger.flush()
+        lines = capsys.readouterr().out.splitlines()
+        assert [l for l in lines if l.startswith("trace")] == [f"trace {i}" for i in range(5)]
+        assert len([l for l in lines if l.startswith("hv")]) == 20
+        assert lines[-1] == "[dev] 15 messages suppressed"
+        assert hv.logger.counts["dev"] == [20, 15]
+
+    def test_quiet(self, fx_target, capsys):
+        """Quiet mode only counts"""
+        hv = fx_target.new_hv()
+        hv.set_log_mode(quiet=True)
+        hv.log(lambda: pytest.fail("formatted"), source="pt")
+        hv.logger.flush()
+        assert capsys.readouterr().out == ""
+        assert hv.logger.counts["pt"] == [1, 0]
+
+    def test_file(self, fx_target, tmp_path):
+        """The log file gets the same lines, commented"""
+        hv = fx_target.new_hv()
+        with open(tmp_path / "log", "w") as fd:
+            hv.set_logfile(fd)
+            hv.set_log_mode(buffered=True)
+            hv.log("x")
+            hv.set_log_mode()
+        assert (tmp_path / "log").read_text() == "# x\n"
+
+    def test_print_tracer(self, fx_target, tmp_path, capsys):
+        """PrintTracer lines and replay statements go through the log writer, in order"""
+        hv = fx_target.new_hv()
+        table = types.SimpleNamespace(lookup=lambda addr: ("dev", irange(0x2_0000_0000, 0x4000)))
+        tracer = trace.PrintTracer(hv, table)
+        with open(tmp_path / "log", "w") as fd:
+            hv.set_logfile(fd)
+            hv.set_log_mode(buffered=True)
+            for i in range(50):
+                hv.log(f"line {i}")
+                tracer.event_mmio(EvtMMIOTrace.parse(_mmio_event(0x2_0000_0010, True, i)))
+            hv.set_log_mode()
+        lines = (tmp_path / "log").read_text().splitlines()
+        assert lines[:3] == ["# line 0", "# [cpu0] [0x0000000000001000] MMIO: W.4   "
+                             "0x200000010 (dev, offset 0x10) = 0x0",
+                             "p.write32(0x200000000 + 0x10, 0x0)"]
+        assert lines[-1] == "p.write32(0x200000000 + 0x10, 0x31)"
+        assert len(lines) == 150
+        assert capsys.readouterr().out.count("MMIO: W.4") == 50
+
+    def test_print_tracer_rate(self, fx_target, tmp_path, capsys):
+        """PrintTracer lines are rate limited, but every replay statement is kept"""
+        hv = fx_target.new_hv()
+        table = types.SimpleNamespace(lookup=lambda addr: ("dev", irange(0x2_0000_0000, 0x4000)))
+        tracer = trace.PrintTracer(hv, table)
+        with open(tmp_path / "log", "w") as fd:
+            hv.set_logfile(fd)
+            hv.set_log_mode(rate=5)
+            for i in range(20):
+                tracer.event_mmio(EvtMMIOTrace.parse(_mmio_event(0x2_0000_0010, False)))
+            hv.set_log_mode()
+        lines = (tmp_path / "log").read_text().splitlines()
+        assert lines.count("p.read32(0x200000000 + 0x10)") == 20
+        assert capsys.readouterr().out.count("MMIO: R.4") == 5
+        assert hv.logger.counts["PrintTracer"] == [20, 15]
+
+    def test_timestamps(self, fx_target):
+        """The timestamp is only read for lines that are written"""
+        hv = fx_target.stopped_hv()
+        hv.show_timestamps = True
+        hv.set_log_mode(quiet=True)
+        hv.log("x")
+        assert ("mrs", 0) not in fx_target.trips
+        hv.set_log_mode()
+        hv.log("x")
+        assert ("mrs", 0) in fx_target.trips
+
+
+class TestHVPageTables:
+    """proxyclient.m1n1.hv.HV.pt_update tests"""
+
+    @staticmethod
+    def _hv(target):
+        hv = target.new_hv()
+        hv.log = lambda *args, **kwargs: None
+        hv.add_tracer(irange(0x2_0000_0000, 0x10_0000), "hw", TraceMode.OFF)
+        for i in range(8):
+            hv.add_tracer(irange(0x2_0010_0000 + i * 0x4000, 0x4000), f"dev{i}",
+                          read=lambda evt: None)
+        hv.pt_update()
+        target.map_ops.clear()
+        target.tlbi.clear()
+        target.trips.clear()
+        return hv
+
+    def test_initial(self, fx_target):
+        """The first update maps everything and flushes globally"""
+        hv = self._hv(fx_target)
+        assert hv.pt_stats["last_ops"] == 9
+        assert hv.pt_stats["tlbi_all"] == 1
+
+    def test_minimal(self, fx_target):
+        """Only the zone whose tracers changed is remapped, in one request"""
+        hv = self._hv(fx_target)
+        hv.add_tracer(irange(0x2_0010_4000, 0x4000), "sync", TraceMode.SYNC,
+                      read=lambda *args: None)
+        hv.pt_update()
+        assert fx_target.map_ops == [(0x2_0010_4000, HV.SPTE_PROXY_HOOK_R, 0x4000, 0)]
+        assert [t for t, _ in fx_target.trips] == ["writemem", "hv_map_batch"]
+        # Software mapping to hook: nothing was ever in the TLB
+        assert fx_target.tlbi == []
+
+        hv.del_tracer(irange(0x2_0010_4000, 0x4000), "sync")
+        hv.pt_update()
+        assert len(fx_target.map_ops) == 2
+
+    def test_unchanged(self, fx_target):
+        """Dirtying a zone without changing its mapping emits nothing"""
+        hv = self._hv(fx_target)
+        hv.add_tracer(irange(0x2_0010_0000, 0x4000), "dev0", read=lambda evt: None)
+        hv.pt_update()
+        assert fx_target.trips == []
+        assert hv.pt_stats["last_ops"] == 0
+
+    def test_scoped_tlbi(self, fx_target):
+        """Replacing a small HW mapping invalidates only that range"""
+        hv = self._hv(fx_target)
+        hv.add_tracer(irange(0x2_0000_8000, 0x4000), "x", read=lambda evt: None)
+        hv.pt_update()
+        assert fx_target.tlbi == [range(0x2_0000_8000, 0x2_0000_c000)]
+        assert hv.pt_stats["tlbi_scoped"] == 1
+
+    def test_external_map(self, fx_target):
+        """Mappings made outside pt_update are not trusted"""
+        hv = self._hv(fx_target)
+        hv.map_sw(0x2_0010_0000, 0x1234_0000, 0x4000)
+        fx_target.map_ops.clear()
+        hv.dirty_maps.set(irange(0x2_0010_0000, 0x4000))
+        hv.pt_update()
+        assert len(fx_target.map_ops) == 1
+
+
+class TestHVContext:
+    """proxyclient.m1n1.proxy.ExcContext tests"""
+
+    def test_parse(self, fx_target):
+        """Fields decode the same as ExcInfo.parse()"""
+        hv = fx_target.stopped_hv()
+        ref = ExcInfo.parse(bytes(fx_target.mem[fx_target.EXC_INFO:fx_target.EXC_INFO + ExcInfo.sizeof()]))
+        ctx = hv.ctx
+        assert list(ctx.regs) == list(ref.regs)
+        assert ctx.regs[3:6] == ref.regs[3:6]
+        assert list(ctx.sp) == list(ref.sp)
+        assert ctx.spsr.M == ref.spsr.M and ctx.esr.EC == ref.esr.EC
+        assert (ctx.elr, ctx.cpu_id, ctx.data) == (ref.elr, ref.cpu_id, ref.data)
+        assert ctx.build() == ExcInfo.build(ref)
+
+    def test_unchanged(self, fx_target):
+        """Committing an unmodified context writes nothing"""
+        hv = fx_target.stopped_hv()
+        hv.ctx.regs[0] = hv.ctx.regs[0]
+        hv.ctx.spsr.M = hv.ctx.spsr.M
+        hv._commit_context()
+        assert fx_target.trips == []
+
+    def test_dirty(self, fx_target):
+        """Only modified words are written, nearby ones in a single transfer"""
+        hv = fx_target.stopped_hv()
+        hv.ctx.regs[0] = 1
+        hv.ctx.regs[2] = 2
+        hv.ctx.elr += 4
+        hv._commit_context()
+        assert fx_target.trips == [("writemem", 24), ("writemem", 8)]
+
+        hv._load_context()
+        assert hv.ctx.regs[0:3] == [1, 0x1001, 2]
+        assert hv.ctx.elr == 0x1000 + 33 + 4
+
+    def test_registers(self, fx_target):
+        """In-place register field changes and plain assignments are committed"""
+        hv = fx_target.stopped_hv()
+        hv.ctx.spsr.SS = 1
+        hv._commit_context()
+        assert fx_target.trips == [("writemem", 8)]
+        hv._load_context()
+        assert hv.ctx.spsr.SS == 1
+
+        hv.ctx.spsr = 0x3c4
+        assert hv.ctx.spsr.value == 0x3c4
+        hv.ctx.sp[1] = 0x1234
+        hv._commit_context()
+        hv._load_context()
+        assert hv.ctx.spsr.value == 0x3c4 and hv.ctx.sp[1] == 0x1234
+
+    def test_repr(self, fx_target):
+        """repr() shows every field in ExcInfo order and leaves the context clean"""
+        hv = fx_target.stopped_hv()
+        text = repr(hv.ctx)
+        assert text.startswith("ExcContext(regs=[0x1000, 0x1001,")
+        offsets = [text.index(f"{subcon.name}=") for subcon in ExcInfo.subcons]
+        assert offsets == sorted(offsets)
+        assert "elr=0x1021" in text and "sp=[0x1025, 0x1026, 0x1027]" in text
+        assert "ESR(" in text
+        hv._commit_context()
+        assert fx_target.trips == []
+
+
+class TestHVKick:
+    """proxyclient.m1n1.hv.HV.kick_virtio tests"""
+
+    @staticmethod
+    def _hv(target):
+        hv = target.new_hv()
+        hv.iface = _uart()
+        return hv
+
+    def test_between_requests(self, fx_target):
+        """A kick from another thread waits for the request being written"""
+        hv = self._hv(fx_target)
+        iface = hv.iface
+        with iface.write_lock:
+            iface.cmd(iface.REQ_NOP)
+            thread = threading.Thread(target=hv.kick_virtio)
+            thread.start()
+            thread.join(0.05)
+            iface.cmd(iface.REQ_NOP)
+        thread.join()
+        packet = 4 + iface.CMD_LEN + 4
+        assert iface.dev.getvalue()[2 * packet:] == b"!"
+
+    def test_in_handler(self, fx_target):
+        """No kick is written while a handler runs, it is left for the handler to poll"""
+        hv = self._hv(fx_target)
+        hv._set_in_handler(True)
+        threading.Thread(target=hv.kick_virtio).start()
+        while not hv._virtio_kick:
+            time.sleep(0.001)
+        assert hv.iface.dev.getvalue() == b""
+        hv._set_in_handler(False)
+        hv.kick_virtio()
+        assert hv.iface.dev.getvalue() == b"!"
+
+
+class TestHVSymbols:
+    """proxyclient.m1n1.hv.HV symbol loading tests"""
+
+    def test_kext_symbols(self, fx_target, tmp_path, monkeypatch):
+        """Kext symbols are indexed, including names that were already loaded"""
+        kext = tmp_path / "Foo.kext"
+        (kext / "Contents" / "MacOS").mkdir(parents=True)
+        (kext / "Contents" / "Info.plist").write_bytes(
+            plistlib.dumps({"CFBundleIdentifier": "com.foo", "CFBundleName": "Foo"}))
+        (kext / "Contents" / "MacOS" / "Foo").write_bytes(b"")
+        monkeypatch.setattr("proxyclient.m1n1.hv.MachO", lambda f: {"_a": 0x2000, "_b": 0x3000})
+
+        class Kernel:
+            symbols = {"_main": 0x100, "com.foo:_a": 0x1000, "com.foo:_c": 0x4000}
+            def add_symbols(self, filename, syms, demangle=False):
+                added = {f"{filename}:{name}": addr for name, addr in syms.items()}
+                self.symbols.update(added)
+                return added
+
+        hv = fx_target.new_hv()
+        hv.macho = Kernel()
+        hv._load_macho_symbols()
+        assert hv.symbols.lookup(0x1000) == (0x1000, "com.foo:_a")
+        hv.add_kext_symbols(str(kext))
+        assert hv.symbols.lookup(0x2000) == (0x2000, "com.foo:_a")
+        assert hv.symbols.lookup(0x3000) == (0x3000, "com.foo:_b")
+        assert hv.symbols.lookup(0x1000) == (0x100, "_main")
+
+
+def _msr(hv, reg, rt, write=False):
+    op0, op1, crn, crm, op2 = sysreg_parse(reg)
+    iss = ESR_ISS_MSR(Op0=op0, Op1=op1, CRn=crn, CRm=crm, Op2=op2, Rt=rt,
+                      DIR=MSR_DIR.WRITE if write else MSR_DIR.READ)
+    hv.handle_msr(hv.ctx, iss.value)
+
+
+@pytest.fixture
+def fx_msr_hv(fx_target, monkeypatch):
+    """Return a HV with a loaded context, MSR logging off and no name lookups"""
+    hv = fx_target.stopped_hv()
+    hv.sysreg[hv.ctx.cpu_id] = {}
+    hv.log_msr = False
+    def no_names(enc):
+        raise AssertionError("sysreg_name called with logging disabled")
+    monkeypatch.setattr("proxyclient.m1n1.hv.sysreg_name", no_names)
+    return hv
+
+
+class TestHVMSR:
+    """proxyclient.m1n1.hv.HV.handle_msr tests"""
+
+    def test_policy(self, fx_msr_hv):
+        """The trap table covers debug registers and registered handlers"""
+        hv = fx_msr_hv
+        assert hv.msr_policy[sysreg_parse("DBGBVR4_EL1")] == MSRPolicy.SHADOW
+        assert hv.msr_policy[sysreg_parse("DBGWCR3_EL1")] == MSRPolicy.SHADOW
+        assert hv.msr_policy[sysreg_parse("DC_CIVAC")] == MSRPolicy.XLATE
+        assert sysreg_parse("CNTV_CVAL_EL0") not in hv.msr_policy
+
+        hv.add_msr_handler("CNTV_CVAL_EL0", read=lambda: 0)
+        assert hv.msr_policy[sysreg_parse("CNTV_CVAL_EL0")] == MSRPolicy.HANDLER
+        hv.del_msr_handler("CNTV_CVAL_EL0")
+        assert sysreg_parse("CNTV_CVAL_EL0") not in hv.msr_policy
+
+    def test_shadow(self, fx_msr_hv):
+        """Shadowed registers are kept per CPU without touching the target"""
+        hv = fx_msr_hv
+        hv.ctx.regs[3] = 0x1234
+        _msr(hv, "MDSCR_EL1", 3, write=True)
+        _msr(hv, "MDSCR_EL1", 5)
+        assert hv.ctx.regs[5] == 0x1234
+        assert hv.ctx.elr == 0x1000 + 33 + 8
+        _msr(hv, "MDSCR_EL1", 31)
+        assert hv.ctx.regs[5] == 0x1234
+
+    def test_handler(self, fx_msr_hv):
+        """Registered handlers see guest writes and provide reads"""
+        hv = fx_msr_hv
+        written = []
+        hv.add_msr_handler("CNTV_CVAL_EL0", read=lambda: 42, write=written.append)
+        hv.ctx.regs[1] = 7
+        _msr(hv, "CNTV_CVAL_EL0", 1, write=True)
+        _msr(hv, "CNTV_CVAL_EL0", 2)
+        assert written == [7]
+        assert hv.ctx.regs[2] == 42
+
+    def test_ro(self, fx_msr_hv):
+        """Writes to read-only registers are dropped"""
+        hv = fx_msr_hv
+        hv.ctx.regs[0] = 1
+        _msr(hv, "ACC_CFG_EL1", 0, write=True)
+        assert hv.sysreg[hv.ctx.cpu_id] == {}
+        assert hv.ctx.elr == 0x1000 + 33 + 4
+
+
+HOOK_BUF = 0x80_1000
+DEVICE = 0x300_0000
+
+
+def _hook_hv(target, mode, **kwargs):
+    hv = target.stopped_hv()
+    hv.ctx.data = HOOK_BUF
+    hv.add_tracer(irange(DEVICE, 0x4000), "dev", mode, **kwargs)
+    target.mem[DEVICE:DEVICE + 64] = struct.pack("<8Q", *range(0x100, 0x108))
+    target.trips.clear()
+    return hv
+
+
+def _hook(hv, target, width, write=False, data=None):
+    data = data or [0] * 8
+    target.mem[HOOK_BUF:HOOK_BUF + VMProxyHookData.sizeof()] = VMProxyHookData.build(Container(
+        flags=MMIOTraceFlags(WIDTH=width, WRITE=int(write)), id=0, addr=DEVICE, data=data))
+    hook = VMProxyHookData.parse(bytes(target.mem[HOOK_BUF:HOOK_BUF + VMProxyHookData.sizeof()]))
+    hv.handle_vm_hook_mapped(hv.ctx, hook)
+    return list(struct.unpack_from("<8Q", target.mem, HOOK_BUF + 16))
+
+
+class TestHVHook:
+    """proxyclient.m1n1.hv.HV.handle_vm_hook_mapped tests"""
+
+    def test_sync_read(self, fx_target):
+        """A 256-bit SYNC read is copied and returned in one transfer"""
+        seen = []
+        hv = _hook_hv(fx_target, TraceMode.SYNC, read=lambda evt: seen.append(evt.data))
+        ret = _hook(hv, fx_target, 5)
+        assert ret[:4] == [0x100, 0x101, 0x102, 0x103]
+        assert seen == [0x100, 0x101, 0x102, 0x103]
+        assert [t for t, _ in fx_target.trips] == ["memcpy64", "get_exc_count", "readmem"]
+
+    def test_sync_read64(self, fx_target):
+        """Single word reads keep using u.read"""
+        hv = _hook_hv(fx_target, TraceMode.SYNC, read=lambda evt: None)
+        assert _hook(hv, fx_target, 3)[0] == 0x100
+        assert [t for t, _ in fx_target.trips] == ["read64", "get_exc_count", "writemem"]
+
+    def test_sync_write(self, fx_target):
+        """A 128-bit write is forwarded from the hook buffer"""
+        seen = []
+        hv = _hook_hv(fx_target, TraceMode.WSYNC, write=lambda evt: seen.append(evt.data))
+        _hook(hv, fx_target, 4, write=True, data=[0xaa, 0xbb] + [0] * 6)
+        assert struct.unpack_from("<3Q", fx_target.mem, DEVICE) == (0xaa, 0xbb, 0x102)
+        assert seen == [0xaa, 0xbb]
+        assert [t for t, _ in fx_target.trips] == ["memcpy64", "get_exc_count"]
+
+    def test_hook_read(self, fx_target):
+        """Emulated values are returned with a single write"""
+        hv = _hook_hv(fx_target, TraceMode.HOOK, read=lambda addr, width: [1, 2])
+        assert _hook(hv, fx_target, 4)[:2] == [1, 2]
+        assert [t for t, _ in fx_target.trips] == ["writemem"]
+
+
+def _legacy_readmem(target, va, size):
+    data = b""
+    while size > 0:
+        pa = target.hv_translate(va)
+        if pa == 0:
+            break
+        chunk = min(size, PAGE - va % PAGE)
+        data += target.readmem(pa, chunk)
+        va += chunk
+        size -= chunk
+    return data
+
+
+def bench(target_cls, size=0x100000, latency=100e-6, bandwidth=8e6):
+    """Model guest read throughput over a link with a fixed per-request cost"""
+    mapping = {0x10_0000 + i * PAGE: 0x100_0000 + i * PAGE for i in range(size // PAGE)}
+    target = target_cls(mapping)
+    hv = target.new_hv()
+
+    def run(label, func):
+        target.trips.clear()
+        func(0x10_0000, size)
+        cost = sum(latency + n / bandwidth for _, n in target.trips)
+        print(f"{label:>10}: {len(target.trips):5d} round trips, {size / cost / 1e6:6.2f} MB/s")
+
+    run("per-page", lambda va, size: _legacy_readmem(target, va, size))
+    run("cold", hv.readmem)
+    run("warm", hv.readmem)
+
+
+def bench_mmio(target_cls, count=200000, devices=16):
+    """Measure MMIO trace events dispatched per second"""
+    hv = target_cls({}).new_hv()
+    for i in range(devices):
+        zone = irange(0x2_0000_0000 + i * 0x10000, 0x10000)
+        hv.add_tracer(zone, f"dev{i}", TraceMode.ASYNC,
+                      read=lambda evt, **kwargs: None, write=lambda evt, **kwargs: None)
+        hv.add_tracer(zone, f"log{i}", TraceMode.UNBUF, write=lambda evt, **kwargs: None)
+    events = [_mmio_event(0x2_0000_0000 + (i % devices) * 0x10000 + (i % 64) * 4, i & 1)
+              for i in range(4096)]
+
+    start = time.perf_counter()
+    for i in range(count):
+        hv.handle_mmiotrace(events[i & 4095])
+    print(f"mmiotrace: {count / (time.perf_counter() - start):,.0f} events/s")
+
+
+def bench_async(target_cls, count=20000, batch=64, link_wait=1e-3, work=200):
+    """Model a link that delivers batches of events with a slow ASYNC tracer"""
+    hv = target_cls({}).new_hv()
+    def tracer(evt, **kwargs):
+        sum(range(work))
+    hv.add_tracer(irange(0x2_0000_0000, 0x10000), "slow", TraceMode.ASYNC, read=tracer)
+    events = [_mmio_event(0x2_0000_0000 + (i % 64) * 4) for i in range(batch)]
+
+    for enable in (False, True):
+        hv.async_decode(enable, block=True)
+        start = time.perf_counter()
+        for i in range(count // batch):
+            time.sleep(link_wait) # waiting on the link releases the GIL
+            for evt in events:
+                hv.handle_mmiotrace(evt)
+        if hv.decoder:
+            hv.decoder.drain()
+        elapsed = time.perf_counter() - start
+        print(f"mmiotrace ({'async' if enable else 'inline'}): {count / elapsed:,.0f} events/s")
+    hv.async_decode(False)
+
+
+def bench_context(count=20000):
+    """Compare construct and ExcContext for a load/modify/commit cycle"""
+    data = struct.pack("<46Q", *range(46))
+
+    start = time.perf_counter()
+    for _ in range(count):
+        ctx = ExcInfo.parse(data)
+        ctx.elr += 4
+        new = ExcInfo.build(ctx)
+        if new != data:
+            pass
+    print(f"construct:  {count / (time.perf_counter() - start):10,.0f} contexts/s")
+
+    start = time.perf_counter()
+    for _ in range(count):
+        ctx = ExcContext(data)
+        ctx.elr += 4
+        ctx.dirty_runs()
+    print(f"ExcContext: {count / (time.perf_counter() - start):10,.0f} contexts/s")
+
+
+def bench_msr(target_cls, count=50000):
+    """Measure trapped shadow register accesses handled per second"""
+    target = target_cls({})
+    hv = target.stopped_hv()
+    hv.sysreg[hv.ctx.cpu_id] = {}
+    iss = [ESR_ISS_MSR(Op0=2, Op1=0, CRn=0, CRm=i % 5, Op2=4 + (i & 1), Rt=1,
+                       DIR=i & 1).value for i in range(10)]
+    for log_msr in (True, False):
+        hv.log_msr = log_msr
+        hv.log = lambda *args, **kwargs: None
+        start = time.perf_counter()
+        for i in range(count):
+            hv.handle_msr(hv.ctx, iss[i % 10])
+        print(f"handle_msr (log {'on' if log_msr else 'off'}): "
+              f"{count / (time.perf_counter() - start):,.0f} traps/s")
+
+
+def bench_hook(target_cls, count=2000, latency=100e-6):
+    """Model hook latency as round trips for 64/128/256-bit SYNC reads"""
+    target = target_cls({})
+    hv = _hook_hv(target, TraceMode.SYNC, read=lambda evt: None)
+    for width in (3, 4, 5):
+        target.trips.clear()
+        for _ in range(count):
+            _hook(hv, target, width)
+        trips = len(target.trips) / count
+        legacy = 2 * (1 << max(0, width - 3)) + 1
+        print(f"{8 << width:3d}-bit hook: {trips:.0f} round trips ({legacy} before), "
+              f"{trips * latency * 1e6:.0f} us/access")
+
+
+def bench_log(target_cls, count=100000, write_cost=20e-6):
+    """Model a slow terminal: time spent in HV.log by the caller, per mode"""
+    import io
+    for label, kwargs in (("sync", {}), ("buffered", {"buffered": True}),
+                          ("rate", {"buffered": True, "rate": 1000}), ("quiet", {"quiet": True})):
+        hv = target_cls({}).new_hv()
+        hv.set_log_mode(**kwargs)
+
+        class SlowTerminal(io.StringIO):
+            def write(self, text):
+                time.sleep(write_cost)
+                return super().write(text)
+
+        stdout, sys.stdout = sys.stdout, SlowTerminal()
+        try:
+            start = time.perf_counter()
+            for i in range(count):
+                hv.log(lambda i=i: f"PT[{i:09x}:{i + 1:09x}] -> HW:dev", source="pt")
+            elapsed = time.perf_counter() - start
+            hv.logger.flush()
+            lines = sys.stdout.getvalue().count("\n")
+        finally:
+            sys.stdout = stdout
+        hv.set_log_mode()
+        print(f"{label:>8}: {count} lines in {elapsed:.3f}s caller time, {lines} written")
+
+
+if __name__ == "__main__":
+    from conftest import SimTarget
+    bench(SimTarget)
+    bench_mmio(SimTarget)
+    bench_async(SimTarget)
+    bench_context()
+    bench_msr(SimTarget)
+    bench_hook(SimTarget)
+    bench_log(SimTarget)
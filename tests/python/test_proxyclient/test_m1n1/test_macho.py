@@ -0,0 +1,272 @@
+# SPDX-License-Identifier: MIT
+"""Tests for proxyclient/m1n1/macho.py"""
+
+import os
+import shutil
+import struct
+import time
+
+import pytest
+
+from proxyclient.m1n1.macho import Demangler, MachO
+
+BASE = 0xfffffe0007004000
+UUID = bytes(range(16))
+
+
+def _macho(symbols, uuid=UUID, shared=(), segments=()):
+    """Build a minimal Mach-O with a symbol table for name -> address symbols
+
+    Names in shared are stored as the tail of the string of the preceding name.
+    segments is a list of (name, vmaddr, vmsize, data)."""
+    strtab = bytearray(b" \x00")
+    offsets = {}
+    prev = None
+    for name in symbols:
+        if name in shared:
+            offsets[name] = offsets[prev] + len(prev) - len(name)
+        else:
+            offsets[name] = len(strtab)
+            strtab += name.encode() + b"\x00"
+            prev = name
+
+    cmds = []
+    if uuid is not None:
+        cmds.append(struct.pack("<II", 0x1b, 24) + uuid)
+    symoff = 32 + 24 * (len(cmds) + 1) + 72 * len(segments)
+    stroff = symoff + 16 * len(symbols)
+    cmds.append(struct.pack("<IIIIII", 0x2, 24, symoff, len(symbols), stroff, len(strtab)))
+    fileoff = stroff + len(strtab)
+    for name, vmaddr, vmsize, data in segments:
+        cmds.append(struct.pack("<II16sQQQQiiII", 0x19, 72, name.encode(), vmaddr, vmsize,
+                                fileoff, len(data), 7, 7, 0, 0))
+        fileoff += len(data)
+    nlist = b"".join(struct.pack("<IBBhQ", offsets[name], 0xf, 1, 0, addr)
+                     for name, addr in symbols.items())
+    header = struct.pack("<IIIIIIII", 0xfeedfacf, 0x0100000c, 0, 2, len(cmds),
+                         sum(len(cmd) for cmd in cmds), 0, 0)
+    return (header + b"".join(cmds) + nlist + bytes(strtab) +
+            b"".join(data for name, vmaddr, vmsize, data in segments))
+
+
+def _symbols(count):
+    return {f"_sym{i}": BASE + i * 16 for i in range(count)}
+
+
+def _kernel(text=0x4000, bss=0x10000):
+    return [
+        ("__TEXT", BASE, text, bytes(range(256)) * (text // 256)),
+        ("__DATA", BASE + text, bss, b"\x5a" * 0x100),
+        ("PYLD", BASE + text + bss, 0x4000, b"\xa5" * 0x10),
+    ]
+
+
+needs_cxxfilt = pytest.mark.skipif(shutil.which("c++filt") is None, reason="c++filt not found")
+
+
+class TestMachO:
+    """proxyclient.m1n1.macho.MachO tests"""
+
+    def test_load_symbols(self, monkeypatch):
+        """Names are sliced out of the string table, including shared suffixes"""
+        monkeypatch.delenv("M1N1SYMCACHE", raising=False)
+        symbols = {"_kernel_bootstrap": BASE, "_bootstrap": BASE + 8, "": 0, "_panic": BASE + 16}
+        macho = MachO(_macho(symbols, shared=("_bootstrap", "")))
+        assert macho.uuid == UUID
+        macho.load_symbols()
+        assert macho.symbols == symbols
+
+    def test_cache(self, tmp_path, monkeypatch):
+        """Symbols are cached by UUID and reused while the symbol table matches"""
+        monkeypatch.setenv("M1N1SYMCACHE", str(tmp_path))
+        symbols = _symbols(100)
+        macho = MachO(_macho(symbols))
+        macho.load_symbols()
+        assert macho.symbols == symbols
+        cache = tmp_path / (UUID.hex() + ".sym")
+        assert cache.exists()
+
+        data = bytearray(cache.read_bytes())
+        data[-1:] = b"X"
+        cache.write_bytes(data)
+        macho.load_symbols()
+        assert macho.symbols["_sym9X"] == symbols["_sym99"]
+
+        # A different symbol table under the same UUID is not served from the cache
+        other = _symbols(101)
+        macho = MachO(_macho(other))
+        macho.load_symbols()
+        assert macho.symbols == other
+
+    def test_no_uuid(self, tmp_path, monkeypatch):
+        """Files without a UUID are not cached"""
+        monkeypatch.setenv("M1N1SYMCACHE", str(tmp_path))
+        macho = MachO(_macho(_symbols(10), uuid=None))
+        assert macho.uuid is None
+        macho.load_symbols()
+        assert len(macho.symbols) == 10
+        assert not os.listdir(tmp_path)
+
+    def test_segments(self, tmp_path):
+        """Segments are views of the mapped file, with zero fill left to the loader"""
+        path = tmp_path / "kernel"
+        path.write_bytes(_macho({}, segments=_kernel()))
+        macho = MachO(open(path, "rb"))
+        segments = list(macho.segments())
+        assert [(dest, len(data), clear) for dest, data, clear in segments] == [
+            (0, 0x4000, 0), (0x4000, 0x100, 0x10000 - 0x100), (0x14000, 0x10, 4)]
+        assert isinstance(segments[0][1], memoryview)
+        assert macho.load_size() == 0x14000 + 0x10 + 4
+
+        image = macho.prepare_image()
+        assert len(image) == macho.load_size()
+        assert image[:0x4000] == bytes(range(256)) * 64
+        assert image[0x4000:0x4100] == b"\x5a" * 0x100
+        assert not any(image[0x4100:0x14000])
+        assert image[0x14000:] == b"\xa5" * 0x10 + bytes(4)
+
+        hooked = MachO(_macho({}, segments=_kernel())).prepare_image(
+            lambda data, segname, *args: data.upper() if segname == "__DATA" else data)
+        assert hooked[0x4000:0x4100] == b"\x5a" * 0x100
+
+    def test_add_symbols(self, monkeypatch):
+        """Symbols from a separate file are relocated to the fileset entry and returned"""
+        monkeypatch.delenv("M1N1SYMCACHE", raising=False)
+        kernel = MachO(_macho({"_main": BASE}))
+        kernel.load_symbols()
+        kernel.subfiles = {"com.foo": MachO(_macho({}, segments=[("__TEXT", BASE + 0x10000, 0x1000, b"")]))}
+        syms = MachO(_macho({"_a": 0x4010, "_b": 0x4020}, segments=[("__TEXT", 0x4000, 0x1000, b"")]))
+        added = kernel.add_symbols("com.foo", syms)
+        assert added == {"com.foo:_a": BASE + 0x10010, "com.foo:_b": BASE + 0x10020}
+        assert kernel.symbols == {"_main": BASE, **added}
+
+    def test_write_segments(self, fx_load_target):
+        """Uploaded segments match the prepared image, without sending zero fill"""
+        macho = MachO(_macho({}, segments=_kernel(bss=0x100000)))
+        target = fx_load_target({})
+        target.mem[:] = b"\xff" * len(target.mem)
+        base = 0x10_0000
+        target.write_segments(base, macho.segments())
+        image = macho.prepare_image()
+        assert target.mem[base:base + len(image)] == image
+        sent = sum(n for name, n in target.trips if name == "writemem")
+        assert sent < 0x4000
+        assert target.trips.count(("memset64", 0)) == 1
+        assert target.trips.count(("memset8", 0)) == 1
+
+    def test_segment_gaps(self, fx_load_target):
+        """Gaps between segments are zeroed like the prepared image, in any command order"""
+        layout = [
+            ("__DATA", BASE + 0x8000, 0x1000, b"\x5a" * 0x100),
+            ("__TEXT", BASE, 0x4000, b"\x11" * 0x2000),
+            ("__LINK", BASE + 0x10000, 0x2000, b"\x22" * 0x2000),
+        ]
+        macho = MachO(_macho({}, segments=layout))
+        assert sorted((dest, clear) for dest, data, clear in macho.segments()) == [
+            (0, 0x8000 - 0x2000), (0x8000, 0x10000 - 0x8100), (0x10000, 0)]
+
+        target = fx_load_target({})
+        target.mem[:] = b"\xff" * len(target.mem)
+        base = 0x10_0000
+        target.write_segments(base, macho.segments())
+        image = macho.prepare_image()
+        assert len(image) == 0x12000
+        assert target.mem[base:base + len(image)] == image
+
+
+class TestDemangler:
+    """proxyclient.m1n1.macho.Demangler tests"""
+
+    @needs_cxxfilt
+    def test_demangle(self, tmp_path):
+        """Mangled names go through c++filt in batches, the rest are returned as is"""
+        demangler = Demangler(str(tmp_path))
+        demangler.BATCH = 3
+        names = ["_ZN3foo3barEv", "_panic", "_ZN3foo3bazEi", "", "_ZN3foo3barEv",
+                 "_ZN3fooC2Ev", "_ZN3fooD2Ev", "Zed"]
+        out = demangler.demangle(names)
+        assert out == ["foo::bar()", "_panic", "foo::baz(int)", "", "foo::bar()",
+                       "foo::foo()", "foo::~foo()", "Zed"]
+        demangler.close()
+
+        lines = (tmp_path / "demangle.txt").read_text().splitlines()
+        assert sorted(lines) == ["_ZN3foo3barEv\tfoo::bar()", "_ZN3foo3bazEi\tfoo::baz(int)",
+                                 "_ZN3fooC2Ev\tfoo::foo()", "_ZN3fooD2Ev\tfoo::~foo()"]
+
+    def test_cache(self, tmp_path):
+        """Cached names are not demangled again"""
+        (tmp_path / "demangle.txt").write_text("_ZN3foo3barEv\tcached::bar()\n")
+        demangler = Demangler(str(tmp_path))
+        assert demangler.demangle(["_ZN3foo3barEv", "_start"]) == ["cached::bar()", "_start"]
+        assert demangler.proc is None
+
+    @needs_cxxfilt
+    def test_load_symbols(self, tmp_path, monkeypatch):
+        """load_symbols(demangle=True) keys symbols by demangled name"""
+        monkeypatch.setenv("M1N1SYMCACHE", str(tmp_path))
+        macho = MachO(_macho({"_ZN3foo3barEv": BASE, "_main": BASE + 4}))
+        macho.load_symbols(demangle=True)
+        assert macho.symbols == {"foo::bar()": BASE, "_main": BASE + 4}
+
+
+def bench(count=200000):
+    """Time load_symbols on a kernel-sized symbol table, cold and cached"""
+    import tempfile
+    data = _macho(_symbols(count))
+    with tempfile.TemporaryDirectory() as cache_dir:
+        os.environ["M1N1SYMCACHE"] = cache_dir
+        for label in ("parse", "cached"):
+            macho = MachO(data)
+            start = time.perf_counter()
+            macho.load_symbols()
+            print(f"{label:>8}: {count} symbols in {time.perf_counter() - start:.3f}s")
+
+
+def bench_demangle(count=100000):
+    """Time demangling with c++filt arguments and with the batched pipe, cold and cached"""
+    import subprocess
+    import tempfile
+    names = [f"_ZN3foo{len(str(i)) + 3}bar{i}Ev" for i in range(count)]
+    start = time.perf_counter()
+    for i in range(0, count, 10000):
+        subprocess.run(["c++filt"] + names[i:i + 10000], stdout=subprocess.PIPE, check=True)
+    print(f"    argv: {count} names in {time.perf_counter() - start:.3f}s")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for label in ("pipe", "cached"):
+            demangler = Demangler(cache_dir)
+            start = time.perf_counter()
+            demangler.demangle(names)
+            print(f"{label:>8}: {count} names in {time.perf_counter() - start:.3f}s")
+            demangler.close()
+
+
+def bench_load(target_cls, segments=4, size=0x40_0000, bss=0x1000_0000, bandwidth=50e6):
+    """Compare whole-image and streamed loading of a kernel with a large zero-fill segment"""
+    chunk = os.urandom(0x1000)
+    layout = [(f"__SEG{i}", BASE + i * size, size, (chunk + bytes(0x1000)) * (size // 0x2000))
+              for i in range(segments)]
+    layout.append(("__BSS", BASE + segments * size, bss, b""))
+    macho = MachO(_macho({}, segments=layout))
+    base = 0x10_0000
+
+    class SlowTarget(target_cls):
+        def writemem(self, addr, data, progress=None):
+            time.sleep(len(data) / bandwidth)
+            super().writemem(addr, data)
+
+    for label in ("image", "segments"):
+        target = SlowTarget({}, mem_size=base + segments * size + bss)
+        start = time.perf_counter()
+        if label == "image":
+            target.write_segments(base, [(0, macho.prepare_image(), 0)])
+        else:
+            target.write_segments(base, macho.segments())
+        sent = sum(n for name, n in target.trips if name == "writemem")
+        print(f"{label:>8}: {sent / 1e6:7.2f} MB sent, {time.perf_counter() - start:6.3f}s")
+
+
+if __name__ == "__main__":
+    bench()
+    bench_demangle()
+    from conftest import LoadTarget
+    bench_load(LoadTarget)
@@ -0,0 +1,231 @@
+# SPDX-License-Identifier: MIT
+"""Tests for proxyclient/m1n1/hv/ninep.py"""
+
+import os
+import pathlib
+import struct
+import threading
+import time
+
+import pytest
+
+from proxyclient.m1n1.hv.ninep import DMDIR, NinePServer, P9
+
+
+def _s(s):
+    s = s.encode()
+    return struct.pack("<H", len(s)) + s
+
+
+def _msg(mtype, tag, body=b""):
+    return struct.pack("<IBH", 7 + len(body), mtype, tag) + body
+
+
+def _reply(resp):
+    size, mtype, tag = struct.unpack_from("<IBH", resp)
+    assert size == len(resp)
+    return mtype, tag, bytes(resp[7:])
+
+
+class Client:
+    """Synchronous 9P2000 client on top of NinePServer.handle"""
+
+    def __init__(self, server):
+        self.server = server
+        self.tag = 0
+
+    def call(self, mtype, body=b""):
+        self.tag += 1
+        resp = self.server.handle(_msg(mtype, self.tag, body))
+        rtype, tag, rbody = _reply(resp)
+        assert tag == self.tag
+        if rtype == P9.Rerror:
+            raise OSError(rbody[2:].decode())
+        assert rtype == mtype + 1
+        return rbody
+
+    def attach(self):
+        self.call(P9.Tversion, struct.pack("<I", 8192) + _s("9P2000.L"))
+        return self.call(P9.Tattach, struct.pack("<II", 0, 0xffffffff) + _s("root") + _s(""))
+
+    def walk(self, fid, newfid, *names):
+        body = self.call(P9.Twalk, struct.pack("<IIH", fid, newfid, len(names)) +
+                         b"".join(_s(n) for n in names))
+        return struct.unpack_from("<H", body)[0]
+
+    def open(self, fid, mode=0):
+        return self.call(P9.Topen, struct.pack("<IB", fid, mode))
+
+    def read(self, fid, offset, count):
+        body = self.call(P9.Tread, struct.pack("<IQI", fid, offset, count))
+        return body[4:4 + struct.unpack_from("<I", body)[0]]
+
+    def write(self, fid, offset, data):
+        body = self.call(P9.Twrite, struct.pack("<IQI", fid, offset, len(data)) + data)
+        return struct.unpack_from("<I", body)[0]
+
+    def clunk(self, fid):
+        self.call(P9.Tclunk, struct.pack("<I", fid))
+
+
+def _names(stats):
+    names = []
+    while stats:
+        size, = struct.unpack_from("<H", stats)
+        entry = stats[2:2 + size]
+        nlen, = struct.unpack_from("<H", entry, 39)
+        names.append(entry[41:41 + nlen].decode())
+        stats = stats[2 + size:]
+    return names
+
+
+@pytest.fixture
+def fx_9p(tmp_path):
+    """Return a client attached to a server on a small directory tree"""
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "dir" / "file").write_bytes(bytes(range(256)) * 64)
+    for i in range(20):
+        (tmp_path / f"f{i:02d}").write_text(str(i))
+    server = NinePServer(tmp_path)
+    client = Client(server)
+    client.attach()
+    yield client, tmp_path
+    server.close()
+
+
+class TestNinePServer:
+    """proxyclient.m1n1.hv.ninep.NinePServer tests"""
+
+    def test_read(self, fx_9p):
+        """Walked files read back at any offset"""
+        client, root = fx_9p
+        assert client.walk(0, 1, "dir", "file") == 2
+        client.open(1)
+        assert client.read(1, 0x1ff0, 0x20) == (bytes(range(256)) * 64)[0x1ff0:0x2010]
+        assert client.read(1, 0x4000, 0x20) == b""
+        client.clunk(1)
+        with pytest.raises(OSError, match="unknown fid"):
+            client.read(1, 0, 1)
+
+    def test_walk(self, fx_9p):
+        """Partial walks return the qids found, and do not escape the root"""
+        client, root = fx_9p
+        assert client.walk(0, 1, "dir", "nothing") == 1
+        with pytest.raises(OSError):
+            client.open(1)
+        with pytest.raises(OSError, match="No such file"):
+            client.walk(0, 1, "nothing")
+        assert client.walk(0, 2, "..", "..", "dir") == 3
+        client.walk(2, 3, "file")
+
+    def test_readdir(self, fx_9p):
+        """Directory reads return whole stat entries across calls"""
+        client, root = fx_9p
+        client.walk(0, 1)
+        client.open(1)
+        names, offset = [], 0
+        while True:
+            chunk = client.read(1, offset, 200)
+            if not chunk:
+                break
+            names += _names(chunk)
+            offset += len(chunk)
+        assert names == sorted(os.listdir(root))
+
+    def test_create(self, fx_9p):
+        """Files and directories can be created, written, renamed and removed"""
+        client, root = fx_9p
+        client.walk(0, 1)
+        client.call(P9.Tcreate, struct.pack("<I", 1) + _s("new") + struct.pack("<IB", 0o644, 2))
+        assert client.write(1, 4, b"data") == 4
+        assert (root / "new").read_bytes() == bytes(4) + b"data"
+        client.clunk(1)
+
+        client.walk(0, 2)
+        client.call(P9.Tcreate, struct.pack("<I", 2) + _s("sub") + struct.pack("<IB", DMDIR | 0o755, 0))
+        assert (root / "sub").is_dir()
+
+        client.walk(0, 3, "new")
+        wstat = (struct.pack("<HHI", 0, 0, 0) + bytes(13) +
+                 struct.pack("<IIIQ", 0xffffffff, 0xffffffff, 0xffffffff, 2) +
+                 _s("renamed") + _s("") + _s("") + _s(""))
+        client.call(P9.Twstat, struct.pack("<IH", 3, len(wstat)) + wstat)
+        assert (root / "renamed").read_bytes() == bytes(2)
+        client.call(P9.Tremove, struct.pack("<I", 3))
+        assert not (root / "renamed").exists()
+
+    def test_stat(self, fx_9p):
+        """Stat reports the size and the directory bit"""
+        client, root = fx_9p
+        client.walk(0, 1, "dir")
+        body = client.call(P9.Tstat, struct.pack("<I", 1))
+        mode, = struct.unpack_from("<I", body, 4 + 2 + 4 + 13)
+        assert mode & DMDIR
+        client.walk(1, 2, "file")
+        body = client.call(P9.Tstat, struct.pack("<I", 2))
+        assert struct.unpack_from("<Q", body, 4 + 2 + 4 + 13 + 12)[0] == 0x4000
+
+    def test_concurrent(self, fx_9p):
+        """Tagged requests complete independently, and flush waits for its target"""
+        client, root = fx_9p
+        server = client.server
+        client.walk(0, 1, "dir", "file")
+        client.open(1)
+        gate = threading.Event()
+        orig = server.HANDLERS[P9.Tstat]
+        server.HANDLERS = dict(server.HANDLERS)
+        server.HANDLERS[P9.Tstat] = lambda self, r: (gate.wait(), orig(self, r))[1]
+        try:
+            order = []
+            server.submit(_msg(P9.Tstat, 100, struct.pack("<I", 1)), lambda r: order.append(_reply(r)[1]))
+            server.submit(_msg(P9.Tflush, 101, struct.pack("<H", 100)), lambda r: order.append(_reply(r)[1]))
+            for tag in range(10):
+                server.submit(_msg(P9.Tread, tag, struct.pack("<IQI", 1, tag * 16, 16)),
+                              lambda r: order.append(_reply(r)[1]))
+            deadline = time.time() + 5
+            while len(order) < 10 and time.time() < deadline:
+                time.sleep(0.001)
+            assert sorted(order) == list(range(10))
+            gate.set()
+            while len(order) < 12 and time.time() < deadline:
+                time.sleep(0.001)
+            assert order[10:] == [100, 101]
+        finally:
+            gate.set()
+
+
+def bench(count=400, size=0x10000, workers=4, delay=1e-3):
+    """Compare serial and pooled reads on a host filesystem with delay seconds of latency"""
+    import tempfile
+    with tempfile.TemporaryDirectory() as root:
+        pathlib.Path(root, "data").write_bytes(os.urandom(size * 16))
+        server = NinePServer(root, workers)
+        orig = server.HANDLERS[P9.Tread]
+        server.HANDLERS = dict(server.HANDLERS)
+        server.HANDLERS[P9.Tread] = lambda self, r: (time.sleep(delay), orig(self, r))[1]
+        client = Client(server)
+        client.attach()
+        client.walk(0, 1, "data")
+        client.open(1)
+        reqs = [_msg(P9.Tread, i, struct.pack("<IQI", 1, (i % 16) * size, size)) for i in range(count)]
+
+        start = time.perf_counter()
+        for req in reqs:
+            server.handle(req)
+        serial = time.perf_counter() - start
+
+        done = threading.Semaphore(0)
+        start = time.perf_counter()
+        for req in reqs:
+            server.submit(req, lambda r: done.release())
+        for _ in reqs:
+            done.acquire()
+        pooled = time.perf_counter() - start
+        total = count * size / 1e6
+        print(f"serial: {total / serial:8.1f} MB/s")
+        print(f"pooled: {total / pooled:8.1f} MB/s ({workers} workers)")
+        server.close()
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,132 @@
+# SPDX-License-Identifier: MIT
+"""Tests for proxyclient/m1n1/proxyutils.py"""
+
+import os
+import struct
+
+import pytest
+from construct import Container
+
+from proxyclient.m1n1.adt import ADTNodeStruct
+from proxyclient.m1n1.proxyutils import LazyADT, ProxyUtils
+
+ADT_BASE = 0x100_0000
+ADT_SIZE = 0x2_0004
+
+
+def _utils(target):
+    u = ProxyUtils.__new__(ProxyUtils)
+    u.iface = u.proxy = u.heap = target
+    u.ba = Container(devtree=ADT_BASE, virt_base=0, phys_base=0, devtree_size=ADT_SIZE)
+    u.adt_data = None
+    u.adt = LazyADT(u)
+    return u
+
+
+def _adt_blob():
+    def node(name, props, children=()):
+        props = [("name", name.encode() + b"\0"), *props]
+        return {"property_count": len(props), "child_count": len(children),
+                "properties": [{"name": k, "size": len(v), "value": v} for k, v in props],
+                "children": list(children)}
+    cells = [("#address-cells", struct.pack("<I", 2)), ("#size-cells", struct.pack("<I", 2))]
+    ranges = ("ranges", struct.pack("<QQQ", 0, 0x200000000, 0x100000000))
+    uart = node("uart0", [("reg", struct.pack("<QQ", 0x35200000, 0x4000))])
+    pmgr = node("pmgr", [("devices", bytes(3) + b"\x01" + bytes(0x2c) + bytes(3) + b"\x02" + bytes(0x2c))])
+    return ADTNodeStruct.build(node("device-tree", cells, [node("arm-io", cells + [ranges], [uart, pmgr])]))
+
+
+@pytest.fixture
+def fx_target(fx_sim_target):
+    """Return a target with a random blob where the ADT lives"""
+    target = fx_sim_target({})
+    target.mem[ADT_BASE:ADT_BASE + ADT_SIZE] = os.urandom(ADT_SIZE)
+    return target
+
+
+def _fetched(target):
+    return sum(n for name, n in target.trips if name == "readmem" and n > 0x100)
+
+
+class TestADTCache:
+    """proxyclient.m1n1.proxyutils.ProxyUtils.get_adt cache tests"""
+
+    def test_cached(self, fx_target, tmp_path, monkeypatch):
+        """A second fetch of the same blob is served from the cache"""
+        monkeypatch.setenv("M1N1ADTCACHE", str(tmp_path))
+        blob = bytes(fx_target.mem[ADT_BASE:ADT_BASE + ADT_SIZE])
+        assert _utils(fx_target).get_adt() == blob
+        assert _fetched(fx_target) == ADT_SIZE
+
+        fx_target.trips.clear()
+        assert _utils(fx_target).get_adt() == blob
+        assert _fetched(fx_target) == 0
+
+    @pytest.mark.parametrize("offset", [0x8000, ADT_SIZE - 2])
+    def test_changed(self, fx_target, tmp_path, monkeypatch, offset):
+        """A blob of the same size that changed anywhere is fetched again"""
+        monkeypatch.setenv("M1N1ADTCACHE", str(tmp_path))
+        _utils(fx_target).get_adt()
+        fx_target.mem[ADT_BASE + offset] ^= 0x80
+        blob = bytes(fx_target.mem[ADT_BASE:ADT_BASE + ADT_SIZE])
+        fx_target.trips.clear()
+        assert _utils(fx_target).get_adt() == blob
+        assert _fetched(fx_target) == ADT_SIZE
+
+    def test_disabled(self, fx_target, monkeypatch):
+        """Without M1N1ADTCACHE the target is not asked to hash"""
+        monkeypatch.delenv("M1N1ADTCACHE", raising=False)
+        _utils(fx_target).get_adt()
+        assert ("memhash64", 0) not in fx_target.trips
+
+
+class TestPushADT:
+    """proxyclient.m1n1.proxyutils.ProxyUtils.push_adt tests"""
+
+    @pytest.fixture
+    def fx_utils(self, monkeypatch, fx_sim_target):
+        monkeypatch.delenv("M1N1ADTCACHE", raising=False)
+        target = fx_sim_target({})
+        blob = _adt_blob()
+        # The ADT region is larger than the blob
+        target.mem[ADT_BASE:ADT_BASE + ADT_SIZE] = blob + b"\xee" * (ADT_SIZE - len(blob))
+        u = _utils(target)
+        u.adt["/arm-io/uart0"]
+        target.trips.clear()
+        return u, target
+
+    def test_unchanged(self, fx_utils, capsys):
+        """An unmodified ADT is not pushed"""
+        u, target = fx_utils
+        u.push_adt()
+        assert "nothing to push" in capsys.readouterr().out
+        assert not target.trips
+
+    def test_patch(self, fx_utils):
+        """Assigned properties are patched in place"""
+        u, target = fx_utils
+        u.adt["/arm-io/uart0"].reg = [Container(addr=0x35204000, size=0x4000)]
+        u.push_adt()
+        assert [n for name, n in target.trips if name == "writemem"] == [16]
+        blob = u.adt.build()
+        assert target.mem[ADT_BASE:ADT_BASE + len(blob)] == blob
+
+    def test_in_place(self, fx_utils):
+        """Values modified in place without touch() are still pushed"""
+        u, target = fx_utils
+        u.adt["/arm-io/uart0"].reg[0].size = 0x8000
+        u.push_adt()
+        blob = u.adt.build()
+        assert target.mem[ADT_BASE:ADT_BASE + len(blob)] == blob
+        assert u.adt["/arm-io/uart0"].reg[0].size == 0x8000
+        assert struct.pack("<Q", 0x8000) in target.mem[ADT_BASE:ADT_BASE + ADT_SIZE]
+
+    def test_mixed(self, fx_utils, capsys):
+        """In-place edits are pushed along with assigned properties"""
+        u, target = fx_utils
+        u.adt["/arm-io/uart0"].reg = [Container(addr=0x35204000, size=0x4000)]
+        u.adt["/arm-io/pmgr"].devices[0].id2 = 7
+        u.push_adt()
+        assert "full rebuild" in capsys.readouterr().out
+        blob = u.adt.build()
+        assert target.mem[ADT_BASE:ADT_BASE + len(blob)] == blob
@@ -0,0 +1,127 @@
+# SPDX-License-Identifier: MIT
+"""Tests for proxyclient/m1n1/hv/resident.py"""
+
+import os
+import time
+
+import pytest
+
+from proxyclient.m1n1.hv.resident import ResidentImage
+
+BASE = 0x10_0000
+CHUNK = ResidentImage.CHUNK
+
+
+def _image(chunks=8, tail=0x123):
+    return os.urandom(chunks * CHUNK + tail)
+
+
+def _sent(target):
+    return sum(n for name, n in target.trips if name == "writemem" and n > 0x100)
+
+
+@pytest.fixture
+def fx_cache(tmp_path, monkeypatch):
+    """Point M1N1LOADCACHE at a temporary directory"""
+    monkeypatch.setenv("M1N1LOADCACHE", str(tmp_path))
+    return tmp_path
+
+
+class TestResidentImage:
+    """proxyclient.m1n1.hv.resident.ResidentImage tests"""
+
+    def test_reload(self, fx_load_target, monkeypatch):
+        """A second load of the same image only sends the partial chunk and zero fill"""
+        monkeypatch.delenv("M1N1LOADCACHE", raising=False)
+        target = fx_load_target({})
+        resident = ResidentImage(target)
+        image = _image()
+        segments = [(0, image, 0x2000)]
+
+        assert resident.write_segments(BASE, segments) == {"chunks_sent": 8, "chunks_skipped": 0}
+        assert target.mem[BASE:BASE + len(image)] == image
+
+        target.trips.clear()
+        target.mem[BASE + len(image):BASE + len(image) + 0x2000] = b"\xff" * 0x2000
+        assert resident.write_segments(BASE, segments) == {"chunks_sent": 0, "chunks_skipped": 8}
+        assert _sent(target) < CHUNK
+        assert target.mem[BASE:BASE + len(image) + 0x2000] == image + bytes(0x2000)
+
+    def test_changed(self, fx_load_target, monkeypatch):
+        """Chunks changed on either side are sent again, in contiguous runs"""
+        monkeypatch.delenv("M1N1LOADCACHE", raising=False)
+        target = fx_load_target({})
+        resident = ResidentImage(target)
+        image = bytearray(_image(tail=0))
+        resident.write_segments(BASE, [(0, image, 0)])
+
+        # The guest scribbled over chunks 2 and 3, and the image changed in chunk 6
+        target.mem[BASE + 2 * CHUNK + 5] ^= 1
+        target.mem[BASE + 3 * CHUNK + 5] ^= 1
+        image[6 * CHUNK] ^= 1
+        target.trips.clear()
+        assert resident.write_segments(BASE, [(0, image, 0)]) == {"chunks_sent": 3, "chunks_skipped": 5}
+        assert target.mem[BASE:BASE + len(image)] == image
+        assert _sent(target) < 4 * CHUNK
+
+        # A different base address shares nothing with the record
+        assert resident.write_segments(BASE + CHUNK, [(0, image, 0)])["chunks_skipped"] == 0
+
+    def test_high_bits(self, fx_load_target, monkeypatch):
+        """A chunk changed only in bit 63 of two words is sent again"""
+        monkeypatch.delenv("M1N1LOADCACHE", raising=False)
+        target = fx_load_target({})
+        resident = ResidentImage(target)
+        image = _image(tail=0)
+        resident.write_segments(BASE, [(0, image, 0)])
+
+        target.mem[BASE + 4 * CHUNK + 7] ^= 0x80
+        target.mem[BASE + 4 * CHUNK + 39] ^= 0x80
+        assert resident.write_segments(BASE, [(0, image, 0)]) == {"chunks_sent": 1, "chunks_skipped": 7}
+        assert target.mem[BASE:BASE + len(image)] == image
+
+    def test_persist(self, fx_load_target, fx_cache):
+        """The record is kept in M1N1LOADCACHE across instances"""
+        target = fx_load_target({})
+        image = _image()
+        ResidentImage(target).write_segments(BASE, [(0, image, 0)])
+        assert (fx_cache / "resident.rec").exists()
+
+        resident = ResidentImage(target)
+        assert len(resident.record) == 8
+        assert resident.write_segments(BASE, [(0, image, 0)])["chunks_skipped"] == 8
+
+        # A fresh target without the image fails verification
+        target = fx_load_target({})
+        assert ResidentImage(target).write_segments(BASE, [(0, image, 0)])["chunks_sent"] == 8
+        assert target.mem[BASE:BASE + len(image)] == image
+
+    def test_corrupt_record(self, fx_load_target, fx_cache):
+        """A record without the magic is ignored"""
+        (fx_cache / "resident.rec").write_bytes(b"garbage" * 10)
+        assert not ResidentImage(fx_load_target({})).record
+
+
+def bench(target_cls, size=0x200_0000, bandwidth=50e6):
+    """Time loading the same image twice over a simulated slow link"""
+    import tempfile
+    image = _image(size // CHUNK)
+
+    class SlowTarget(target_cls):
+        def writemem(self, addr, data, progress=None):
+            time.sleep(len(data) / bandwidth)
+            super().writemem(addr, data)
+
+    target = SlowTarget({}, mem_size=BASE + len(image) + CHUNK)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        os.environ["M1N1LOADCACHE"] = cache_dir
+        for label in ("cold", "resident"):
+            target.trips.clear()
+            start = time.perf_counter()
+            ResidentImage(target).write_segments(BASE, [(0, image, 0)])
+            print(f"{label:>8}: {_sent(target) / 1e6:7.2f} MB sent, {time.perf_counter() - start:6.3f}s")
+
+
+if __name__ == "__main__":
+    from conftest import LoadTarget
+    bench(LoadTarget)
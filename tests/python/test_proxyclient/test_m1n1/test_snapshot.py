@@ -0,0 +1,217 @@
+# SPDX-License-Identifier: MIT
+"""Tests for proxyclient/m1n1/hv/snapshot.py"""
+
+import pathlib
+import time
+
+import pytest
+
+from proxyclient.m1n1.hv.snapshot import PAGE_SIZE, GuestSnapshot, SnapshotFile, memhash64
+from proxyclient.m1n1.sysreg import TPIDR_EL1, VBAR_EL12
+from proxyclient.m1n1.utils import irange
+
+RAM = 0x100_0000
+PAGES = 16
+
+
+@pytest.fixture
+def fx_guest(fx_sim_target):
+    """Return a stopped HV guest with 16 pages of RAM, half of them zero"""
+    target = fx_sim_target({})
+    for i in range(0, PAGES, 2):
+        target.mem[RAM + i * PAGE_SIZE:RAM + (i + 1) * PAGE_SIZE] = bytes([i + 1]) * PAGE_SIZE
+    # Two identical pages
+    target.mem[RAM + 14 * PAGE_SIZE:RAM + 15 * PAGE_SIZE] = bytes([1]) * PAGE_SIZE
+    target.sysregs[VBAR_EL12] = 0xfffffe0007004000
+    target.sysregs[TPIDR_EL1] = 0x1234
+    hv = target.stopped_hv()
+    hv.guest_ram = lambda: [irange(RAM, PAGES * PAGE_SIZE)]
+    hv.log = lambda *args, **kwargs: None
+    hv.sysreg[hv.ctx.cpu_id] = {(3, 0, 0, 2, 2): 5}
+    return hv, target
+
+
+def _ram(target):
+    return bytes(target.mem[RAM:RAM + PAGES * PAGE_SIZE])
+
+
+class TestSnapshot:
+    """proxyclient.m1n1.hv.snapshot tests"""
+
+    def test_memhash(self):
+        """The reference hash notices single word changes"""
+        page = bytearray(PAGE_SIZE)
+        h = memhash64(page)
+        page[0x1238] = 1
+        assert memhash64(page) != h
+        assert memhash64(page) != memhash64(page[:-32])
+
+    def test_memhash_zero(self):
+        """Only all-zero data hashes to 0, and high bit flips do not cancel out"""
+        assert memhash64(bytes(PAGE_SIZE)) == 0
+        page = bytearray(PAGE_SIZE)
+        page[7] = page[39] = 0x80
+        assert memhash64(page) != 0
+        h = memhash64(page)
+        page[0x1007] = page[0x2007] = 0x80
+        assert memhash64(page) != h
+
+    def test_high_bits(self, fx_guest, tmp_path, capsys):
+        """Pages differing from the snapshot only in pairs of bit 63 are still restored"""
+        hv, target = fx_guest
+        path = tmp_path / "snap.bin"
+        page = RAM + PAGE_SIZE
+        target.mem[page + 7] = target.mem[page + 39] = 0x80
+        ram = _ram(target)
+        hv.snapshot(path, "flags")
+        assert f"{PAGES // 2 - 1} zero" in capsys.readouterr().out
+
+        target.mem[page:page + PAGE_SIZE] = bytes(PAGE_SIZE)
+        target.mem[RAM + 3 * PAGE_SIZE + 15] = target.mem[RAM + 3 * PAGE_SIZE + 47] = 0x80
+        hv.restore_snapshot(path)
+        assert _ram(target) == ram
+
+    def test_tracers(self, fx_guest, tmp_path, capsys):
+        """The tracer layout is restored with the current handlers, and stage 2 follows it"""
+        hv, target = fx_guest
+        path = tmp_path / "snap.bin"
+        dev, moved, new, gone = (irange(0x2_0000_0000 + i * 0x4000, 0x4000) for i in range(4))
+        hv.add_tracer(dev, "dev", read=lambda evt: None)
+        hv.add_tracer(gone, "gone", read=lambda evt: None)
+        hv.pt_update()
+        hv.snapshot(path, "traced")
+
+        handler = lambda evt: None
+        hv.del_tracer(dev, "dev")
+        hv.add_tracer(moved, "dev", read=handler)
+        hv.add_tracer(new, "new", read=handler)
+        hv.clear_tracers("gone")
+        hv.pt_update()
+        target.tlbi.clear()
+
+        hv.restore_snapshot(path)
+        assert "no handlers for gone" in capsys.readouterr().out
+        assert hv.mmio_maps[dev.start]["dev"][2] is handler
+        assert not hv.mmio_maps[moved.start] and not hv.mmio_maps[new.start]
+        assert not hv.mmio_maps[gone.start]
+        assert hv._pt_state.lookup(dev.start)[0] == "sw"
+        for zone in (moved, new, gone):
+            assert hv._pt_state.lookup(zone.start) == ("unmap",)
+        assert target.tlbi[-1] == "all"
+        assert ("hv_tlbi_all", 0) in target.trips
+
+    def test_open_failed(self, tmp_path):
+        """A file that failed to open is not closed again on collection"""
+        with pytest.raises(OSError):
+            SnapshotFile(tmp_path)
+        SnapshotFile.__new__(SnapshotFile).__del__()
+
+    def test_roundtrip(self, fx_guest, tmp_path, capsys):
+        """Restoring brings back RAM, CPU state and shadow registers"""
+        hv, target = fx_guest
+        path = tmp_path / "snap.bin"
+        ram = _ram(target)
+        hv.snapshot(path, "boot")
+
+        target.mem[RAM + 3 * PAGE_SIZE] = 0xff
+        target.mem[RAM + 6 * PAGE_SIZE:RAM + 7 * PAGE_SIZE] = bytes(PAGE_SIZE)
+        target.mem[RAM + 8 * PAGE_SIZE] = 0xff
+        target.mem[RAM + 9 * PAGE_SIZE] = 0xff
+        hv.ctx.regs[0] = 0xdead
+        hv.ctx.elr = 0
+        target.sysregs[TPIDR_EL1] = 0
+        target.simd_state = bytes(512)
+        hv.sysreg[hv.ctx.cpu_id] = {}
+
+        target.trips.clear()
+        hv.restore_snapshot(path)
+        assert _ram(target) == ram
+        assert hv.ctx.regs[0] == 0x1000 and hv.ctx.elr == 0x1000 + 33
+        assert target.sysregs[TPIDR_EL1] == 0x1234
+        assert target.simd_state == bytes(range(256)) * 2
+        assert hv.sysreg[hv.ctx.cpu_id] == {(3, 0, 0, 2, 2): 5}
+        # Page 3 is cleared, page 6 and pages 8-9 are rewritten
+        assert ("writemem", 2 * PAGE_SIZE) in target.trips
+        assert ("writemem", PAGE_SIZE) in target.trips
+        assert ("memset64", 0) in target.trips
+        assert "Restored: 4 of 16 pages written" in capsys.readouterr().out
+
+    def test_incremental(self, fx_guest, tmp_path):
+        """Unchanged pages are not read, and equal pages are stored once"""
+        hv, target = fx_guest
+        path = tmp_path / "snap.bin"
+        snap = GuestSnapshot(hv, path)
+        snap.take("a")
+        assert snap.stats == {"pages": 16, "read": 8, "zero": 8, "new": 7}
+
+        target.mem[RAM + 1 * PAGE_SIZE] = 0x42
+        snap.take("b")
+        assert snap.stats == {"pages": 16, "read": 1, "zero": 0, "new": 1}
+        snap.file.close()
+
+        # Also across sessions
+        snap = GuestSnapshot(hv, path)
+        snap.take("c")
+        assert snap.stats["read"] == 0
+        assert sorted(snap.file.snapshots) == ["a", "b", "c"]
+        snap.file.close()
+
+    def test_named(self, fx_guest, tmp_path):
+        """Older snapshots can be restored by name"""
+        hv, target = fx_guest
+        path = tmp_path / "snap.bin"
+        ram = _ram(target)
+        hv.snapshot(path, "a")
+        target.mem[RAM] = 0x42
+        hv.snapshot(path, "b")
+        hv.restore_snapshot(path, "a")
+        assert _ram(target) == ram
+
+    def test_truncated(self, fx_guest, tmp_path):
+        """A partially written record at the end is dropped"""
+        hv, target = fx_guest
+        path = tmp_path / "snap.bin"
+        hv.snapshot(path, "a")
+        target.mem[RAM] = 0x42
+        hv.snapshot(path, "b")
+        path.write_bytes(path.read_bytes()[:-10])
+
+        f = SnapshotFile(path)
+        assert list(f.snapshots) == ["a"]
+        f.close()
+        hv.snapshot(path, "c")
+        assert sorted(SnapshotFile(path).snapshots) == ["a", "c"]
+
+
+def bench(target_cls, pages=1024, dirty=16, latency=100e-6, bandwidth=8e6):
+    """Model the link cost of full and incremental snapshots"""
+    target = target_cls({}, mem_size=0x100_0000 + pages * PAGE_SIZE)
+    for i in range(pages):
+        target.mem[RAM + i * PAGE_SIZE:RAM + i * PAGE_SIZE + 8] = i.to_bytes(8, "little")
+    hv = target.stopped_hv()
+    path = "/tmp/m1n1-snapshot-bench.bin"
+    pathlib.Path(path).unlink(missing_ok=True)
+    snap = GuestSnapshot(hv, path)
+
+    def run(label):
+        target.trips.clear()
+        start = time.perf_counter()
+        snap.take(ranges=[irange(RAM, pages * PAGE_SIZE)])
+        host = time.perf_counter() - start
+        link = sum(latency + n / bandwidth for _, n in target.trips)
+        print(f"{label:>12}: {snap.stats['read']:5d} pages read, "
+              f"{link:7.3f}s link, {host:7.3f}s host")
+
+    full = pages * PAGE_SIZE / bandwidth
+    print(f"{'raw dump':>12}: {pages:5d} pages read, {full:7.3f}s link")
+    run("first")
+    for i in range(dirty):
+        target.mem[RAM + i * 61 % pages * PAGE_SIZE + 8] ^= 1
+    run("incremental")
+    snap.file.close()
+    pathlib.Path(path).unlink()
+
+
+if __name__ == "__main__":
+    from conftest import SimTarget
+    bench(SimTarget)
@@ -0,0 +1,121 @@
+# SPDX-License-Identifier: MIT
+"""Tests for proxyclient/m1n1/hv/symbols.py"""
+
+import bisect
+import random
+import time
+
+from proxyclient.m1n1.hv.symbols import SymbolIndex
+
+BASE = 0xfffffe0007004000
+
+
+def _symbols(count, prefix="sym", seed=0):
+    rng = random.Random(seed)
+    return {f"{prefix}{i}": BASE + rng.randrange(0, count * 64) * 4 for i in range(count)}
+
+
+def _reference(symbols, addr):
+    table = sorted((v, k) for k, v in symbols.items())
+    idx = bisect.bisect_left(table, (addr + 1, "")) - 1
+    if idx < 0 or idx >= len(table):
+        return None, None
+    return table[idx]
+
+
+class TestSymbolIndex:
+    """proxyclient.m1n1.hv.symbols.SymbolIndex tests"""
+
+    def test_lookup(self):
+        """Lookups match a bisect over the sorted (address, name) list"""
+        symbols = _symbols(1000)
+        index = SymbolIndex()
+        index.add(symbols)
+        rng = random.Random(1)
+        for _ in range(2000):
+            addr = BASE - 0x100 + rng.randrange(0, 1000 * 256 + 0x200)
+            assert index.lookup(addr) == _reference(symbols, addr)
+        assert index.lookup(0) == (None, None)
+        assert index.lookup(-1) == (None, None)
+
+    def test_incremental(self):
+        """Symbol sets added one at a time give the same index"""
+        kernel = _symbols(1000)
+        kexts = [_symbols(100, f"kext{i}:", seed=i + 1) for i in range(5)]
+        index = SymbolIndex()
+        index.add(kernel)
+        addr = BASE + 0x1234
+        index.lookup(addr)
+        combined = dict(kernel)
+        for kext in kexts:
+            index.add(kext)
+            combined.update(kext)
+            assert index.lookup(addr) == _reference(combined, addr)
+        assert len(index) == len(combined)
+        assert index.names == combined
+
+    def test_moved(self):
+        """Re-adding a symbol at a new address drops the old entry"""
+        index = SymbolIndex()
+        index.add({"a": 0x1000, "b": 0x2000})
+        index.add({"a": 0x1000})
+        assert len(index) == 2
+        index.add({"a": 0x3000})
+        assert len(index) == 2
+        assert index.lookup(0x1800) == (None, None)
+        assert index.lookup(0x3004) == (0x3000, "a")
+
+    def test_format(self):
+        """Formatted names are cached and the cache is bounded"""
+        index = SymbolIndex()
+        index.CACHE_SIZE = 4
+        index.add({"_start": 0x1000})
+        assert index.format(0x1010) == "_start+0x10"
+        assert index.format(0x800) is None
+        for addr in range(0x1000, 0x1010):
+            index.format(addr)
+        assert len(index._cache) == 4
+        index.add({"_end": 0x1008})
+        assert index.format(0x100c) == "_end+0x4"
+
+
+def bench(count=500000, kexts=50, lookups=200000):
+    """Compare the sorted tuple list with SymbolIndex on a synthetic table"""
+    kernel = _symbols(count)
+    sets = [_symbols(count // 500, f"kext{i}:", seed=i + 1) for i in range(kexts)]
+    rng = random.Random(2)
+    hot = [BASE + rng.randrange(0, count * 256) for _ in range(512)]
+    addrs = [hot[rng.randrange(len(hot))] for _ in range(lookups)]
+
+    start = time.perf_counter()
+    combined = dict(kernel)
+    table = sorted((v, k) for k, v in combined.items())
+    for kext in sets:
+        combined.update(kext)
+        table = sorted((v, k) for k, v in combined.items())
+    print(f"list build:   {time.perf_counter() - start:8.3f}s")
+
+    start = time.perf_counter()
+    for addr in addrs:
+        idx = bisect.bisect_left(table, (addr + 1, "")) - 1
+        saddr, name = table[idx]
+        f"{name}+0x{addr - saddr:x}"
+    print(f"list lookup:  {lookups / (time.perf_counter() - start):12,.0f} lookups/s")
+
+    start = time.perf_counter()
+    index = SymbolIndex()
+    index.add(kernel)
+    len(index)
+    for kext in sets:
+        index.add(kext)
+        len(index)
+    print(f"index build:  {time.perf_counter() - start:8.3f}s")
+
+    start = time.perf_counter()
+    for addr in addrs:
+        index.format(addr)
+    print(f"index lookup: {lookups / (time.perf_counter() - start):12,.0f} lookups/s")
+
+
+if __name__ == "__main__":
+    bench()
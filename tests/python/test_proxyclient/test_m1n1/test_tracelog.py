@@ -0,0 +1,161 @@
+# SPDX-License-Identifier: MIT
+"""Tests for proxyclient/m1n1/hv/tracelog.py"""
+
+import pathlib
+import threading
+import time
+
+import pytest
+from construct import Container
+
+from proxyclient.m1n1.hv.tracelog import TraceLogReader, TraceLogWriter
+from proxyclient.m1n1.hv.types import MMIOTraceFlags
+from proxyclient.m1n1.hw.i2c import I2CRegs
+from proxyclient.m1n1.utils import AddrLookup
+
+I2C_BASE = 0x2_3501_0000
+
+
+class NullBackend:
+    """Register backend for regmaps that are only used to decode"""
+
+    def read(self, addr, width):
+        raise NotImplementedError
+
+    def write(self, addr, data, width):
+        raise NotImplementedError
+
+
+def _evt(addr, data=0, cpu=0, write=False):
+    return Container(flags=MMIOTraceFlags(WIDTH=2, CPU=cpu, WRITE=int(write)),
+                     reserved=0, pc=0xfffffe0007001000, addr=addr, data=data)
+
+
+@pytest.fixture
+def fx_lookup():
+    """Return a device lookup with an i2c and a uart block"""
+    lookup = AddrLookup()
+    lookup.add(range(I2C_BASE, I2C_BASE + 0x4000), "i2c0[0]")
+    lookup.add(range(0x2_3520_0000, 0x2_3520_4000), "uart0[0]")
+    return lookup
+
+
+@pytest.fixture
+def fx_log(tmp_path, fx_lookup):
+    """Return the path of a log with i2c and uart traffic over three chunks"""
+    path = tmp_path / "trace.bin"
+    log = TraceLogWriter(path, fx_lookup)
+    log.CHUNK_RECORDS = 4
+    regmap = I2CRegs(NullBackend(), I2C_BASE)
+    for i in range(10):
+        log.mmio(_evt(I2C_BASE + 0x1c, 0x200 | i, cpu=i % 2, write=True),
+                 "ADTDevTracer@/arm-io/i2c0", regmap=regmap)
+    log.mmio(_evt(0x2_3520_0020, 0x41), "PrintTracer")
+    log.irq(Container(flags=1, type=1, num=42), dev="aic")
+    log.close()
+    return path
+
+
+class TestTraceLog:
+    """proxyclient.m1n1.hv.tracelog tests"""
+
+    def test_roundtrip(self, fx_log):
+        """All records are read back with their names resolved"""
+        log = TraceLogReader(fx_log)
+        assert len(log.chunks) == 3
+        records = list(log.records())
+        assert len(records) == 12
+        assert [r.data for r in records[:10]] == [0x200 | i for i in range(10)]
+        assert log.names[records[0].dev] == "i2c0[0]"
+        assert log.names[records[10].dev] == "uart0[0]"
+        assert log.names[records[11].dev] == "aic"
+
+    def test_filters(self, fx_log):
+        """Queries filter by address, CPU, device and time"""
+        log = TraceLogReader(fx_log)
+        assert len(list(log.records(addr=range(I2C_BASE, I2C_BASE + 0x4000)))) == 10
+        assert len(list(log.records(cpus={1}))) == 5
+        assert len(list(log.records(devices=log.match_names(["uart*"])))) == 1
+        assert len(list(log.records(devices=log.match_names(["*/i2c0"])))) == 10
+        assert list(log.records(t_start=log.chunks[-1].t_max + 1)) == []
+
+    def test_format(self, fx_log):
+        """Register accesses are decoded with the recorded register map"""
+        log = TraceLogReader(fx_log)
+        lines = [log.format(rec) for rec in log.records()]
+        assert "CTL = " in lines[0] and "W.4" in lines[0]
+        assert "0x235200020 = 0x41 (uart0[0])" in lines[10]
+        assert "IRQ: aic: 42" in lines[11]
+
+    def test_append(self, fx_log, fx_lookup):
+        """Reopening a log appends to it and keeps the name table"""
+        log = TraceLogWriter(fx_log, fx_lookup)
+        log.mmio(_evt(0x2_3520_0024, 0x42), "PrintTracer")
+        log.close()
+
+        reader = TraceLogReader(fx_log)
+        assert reader.names.count("PrintTracer") == 1
+        last = list(reader.records())[-1]
+        assert reader.names[last.ident] == "PrintTracer"
+        assert last.data == 0x42
+
+    def test_threads(self, tmp_path, fx_lookup):
+        """Records from two threads all land in whole chunks"""
+        path = tmp_path / "trace.bin"
+        log = TraceLogWriter(path, fx_lookup)
+        log.CHUNK_RECORDS = 7
+        def worker():
+            for i in range(2000):
+                log.mmio(_evt(I2C_BASE + 4 * (i & 15), i, write=True), f"t{i % 5}")
+        thread = threading.Thread(target=worker)
+        thread.start()
+        for i in range(2000):
+            log.irq(Container(flags=1, type=1, num=i), dev="aic")
+        thread.join()
+        log.close()
+
+        records = list(TraceLogReader(path).records())
+        assert len(records) == 4000
+        assert sorted(r.data for r in records if r.kind == 2) == list(range(2000))
+
+    def test_truncated(self, fx_log):
+        """A partially written chunk at the end is ignored"""
+        data = fx_log.read_bytes()
+        fx_log.write_bytes(data[:-10])
+        assert len(list(TraceLogReader(fx_log).records())) == 8
+
+
+def bench(count=200000, path="/tmp/m1n1-tracelog-bench.bin"):
+    """Compare binary logging against formatting text lines"""
+    lookup = AddrLookup()
+    lookup.add(range(I2C_BASE, I2C_BASE + 0x4000), "i2c0[0]")
+    regmap = I2CRegs(NullBackend(), I2C_BASE)
+    events = [_evt(I2C_BASE + (i % 0x12) * 4, i, cpu=i % 8, write=i & 1) for i in range(4096)]
+
+    start = time.perf_counter()
+    for i in range(count):
+        evt = events[i & 4095]
+        reg = regmap.get_name(evt.addr)
+        if reg is None:
+            s = f"{evt.addr:#x} = {evt.data:#x}"
+        else:
+            s = f"{reg} = {regmap.lookup_addr(evt.addr)[2](evt.data)!s}"
+        line = f"[cpu{evt.flags.CPU}] [i2c] MMIO: {'W' if evt.flags.WRITE else 'R'}.4  " + s
+    print(f"text:   {count / (time.perf_counter() - start):12,.0f} events/s")
+
+    start = time.perf_counter()
+    log = TraceLogWriter(path, lookup)
+    for i in range(count):
+        log.mmio(events[i & 4095], "i2c", regmap=regmap)
+    log.close()
+    print(f"binary: {count / (time.perf_counter() - start):12,.0f} events/s")
+
+    reader = TraceLogReader(path)
+    start = time.perf_counter()
+    hits = sum(1 for _ in reader.records(addr=range(I2C_BASE, I2C_BASE + 4), cpus={2}))
+    print(f"query:  {count / (time.perf_counter() - start):12,.0f} events/s scanned ({hits} hits)")
+    pathlib.Path(path).unlink()
+
+
+if __name__ == "__main__":
+    bench()
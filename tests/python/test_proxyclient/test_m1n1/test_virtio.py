@@ -0,0 +1,442 @@
+# SPDX-License-Identifier: MIT
+"""Tests for proxyclient/m1n1/hv/virtio.py"""
+
+import os
+import pathlib
+import struct
+import subprocess
+import sys
+import threading
+import time
+import types
+
+import pytest
+from construct import Container
+
+from proxyclient.m1n1.hv.ninep import P9
+from proxyclient.m1n1.hv.virtio import (Virtio9PServer, Virtio9PTransport, VirtioBlk, VirtioDev,
+                                        VirtioExcInfo, coalesce)
+
+QSIZE = 16
+DESC = 0x10_0000
+AVAIL = DESC + 16 * QSIZE
+BUFS = 0x20_0000
+NEXT, WRITE = 1, 2
+
+
+class UsedRing:
+    """virtio used ring, mixed into a simulated target"""
+
+    def __init__(self):
+        super().__init__({})
+        self.used = []
+
+    def virtio_put_buffer(self, base, qu, idx, length):
+        self.trips.append(("virtio_put_buffer", 0))
+        self.used.append((idx, length))
+
+    def virtio_put_buffers(self, base, qu, bufs, count):
+        self.trips.append(("virtio_put_buffers", 0))
+        assert bufs == self.HEAP
+        self.used.extend(struct.iter_unpack("<II", self._buf[:8 * count]))
+
+
+def _virtio_target(target_cls):
+    return type("VirtioTarget", (UsedRing, target_cls), {})
+
+
+@pytest.fixture
+def fx_virtio_target(fx_sim_target):
+    """Return the simulated target class with a virtio used ring"""
+    return _virtio_target(fx_sim_target)
+
+
+class Echo9P(Virtio9PTransport):
+    """9P transport answering each request with its reversed payload"""
+
+    def __init__(self):
+        VirtioDev.__init__(self)
+        self.tag = b"m1n1"
+        self.requests = []
+
+    def call(self, req):
+        self.requests.append(req)
+        return req[::-1]
+
+
+class Queue:
+    """Guest side of a split virtqueue"""
+
+    def __init__(self, target, avail=AVAIL):
+        self.target = target
+        self.avail = avail
+        self.free = 0
+        self.idx = 0
+        self.buf = BUFS
+
+    def desc(self, idx, addr, size, flags, nxt=0):
+        struct.pack_into("<QIHH", self.target.mem, DESC + 16 * idx, addr, size, flags, nxt)
+
+    def alloc(self, size):
+        addr = self.buf
+        self.buf += size
+        return addr
+
+    def push(self, sizes, wsizes, data=None):
+        """Queue a chain of driver buffers then device buffers, return the head"""
+        head = self.free
+        bufs = []
+        chain = [(size, 0) for size in sizes] + [(size, WRITE) for size in wsizes]
+        for i, (size, flags) in enumerate(chain):
+            idx = self.free
+            self.free = (self.free + 1) % QSIZE
+            addr = self.alloc(size)
+            if not flags and data is not None:
+                self.target.mem[addr:addr + size] = data[:size]
+                data = data[size:]
+            last = i == len(chain) - 1
+            self.desc(idx, addr, size, flags | (0 if last else NEXT), self.free)
+            bufs.append((addr, size))
+        struct.pack_into("<H", self.target.mem, self.avail + 4 + 2 * (self.idx % QSIZE), head)
+        self.idx += 1
+        return head, bufs
+
+    def info(self, start, count):
+        return VirtioExcInfo.parse(VirtioExcInfo.build(Container(
+            devbase=0x2_0000_0000, qu=0, start=start, count=count, size=QSIZE,
+            descbase=DESC, availbase=self.avail)))
+
+
+def _dev(dev, target):
+    dev.hv = types.SimpleNamespace(iface=target, p=target, u=target, kicks=0)
+    dev.hv.kick_virtio = lambda: setattr(dev.hv, "kicks", dev.hv.kicks + 1)
+    return dev
+
+
+@pytest.fixture
+def fx_virtio(fx_virtio_target):
+    """Return an echo 9P device on an empty virtqueue"""
+    target = fx_virtio_target()
+    return _dev(Echo9P(), target), target, Queue(target)
+
+
+class TestVirtio:
+    """proxyclient.m1n1.hv.virtio tests"""
+
+    def test_coalesce(self):
+        """Adjacent buffers merge, others do not"""
+        assert coalesce([(0x100, 0x10), (0x110, 0x20), (0x200, 8)]) == [[0x100, 0x30], [0x200, 8]]
+        assert coalesce([]) == []
+
+    def test_batch(self, fx_virtio):
+        """All pending requests are handled from one queue read"""
+        dev, target, q = fx_virtio
+        reqs = [bytes(range(i, i + 24)) for i in range(3)]
+        chains = [q.push([8, 16], [16, 16], req) for req in reqs]
+        dev.handle_exc(q.info(0, 3))
+
+        assert dev.requests == reqs
+        for (head, bufs), req in zip(chains, reqs):
+            resp = b"".join(bytes(target.mem[addr:addr + size]) for addr, size in bufs[2:])
+            assert resp[:24] == req[::-1]
+        assert target.used == [(head, 24) for head, _ in chains]
+        # One read for the rings, one per request, one write per response
+        assert [t for t, _ in target.trips].count("readmem") == 4
+        assert [t for t, _ in target.trips].count("writemem") == 4
+        assert [t for t, _ in target.trips].count("virtio_put_buffers") == 1
+
+    def test_wrap(self, fx_virtio):
+        """Available ring entries wrap around the queue size"""
+        dev, target, q = fx_virtio
+        q.idx = q.free = QSIZE - 2
+        heads = [q.push([4], [4], b"abcd")[0] for _ in range(4)]
+        dev.handle_exc(q.info(QSIZE - 2, 4))
+        assert [head for head, _ in target.used] == heads == [14, 0, 2, 4]
+
+    def test_single(self, fx_virtio):
+        """A lone request takes the single buffer path"""
+        dev, target, q = fx_virtio
+        q.push([4], [8], b"abcd")
+        dev.handle_exc(q.info(0, 1))
+        assert target.used == [(0, 4)]
+        assert ("virtio_put_buffers", 0) not in target.trips
+
+    def test_apart(self, fx_virtio_target):
+        """Rings that are not back to back are read separately"""
+        target = fx_virtio_target()
+        dev = _dev(Echo9P(), target)
+        q = Queue(target, avail=0x30_0000)
+        q.push([4], [4], b"abcd")
+        dev.handle_exc(q.info(0, 1))
+        assert target.trips[:2] == [("readmem", 16 * QSIZE), ("readmem", 4 + 2 * QSIZE)]
+        assert target.used == [(0, 4)]
+
+
+def _9p(mtype, tag, body=b""):
+    return struct.pack("<IBH", 7 + len(body), mtype, tag) + body
+
+
+class TestVirtio9PServer:
+    """proxyclient.m1n1.hv.virtio.Virtio9PServer tests"""
+
+    def test_async(self, tmp_path, fx_virtio_target):
+        """Slow requests are returned on a later poll after a kick"""
+        (tmp_path / "file").write_bytes(b"hello")
+        target = fx_virtio_target()
+        dev = _dev(Virtio9PServer(root=str(tmp_path)), target)
+        dev.base = 0x2_0000_0000
+        server = dev.server
+        gate = threading.Event()
+        orig = server.HANDLERS[P9.Tstat]
+        server.HANDLERS = dict(server.HANDLERS)
+        server.HANDLERS[P9.Tstat] = lambda self, r: (gate.wait(), orig(self, r))[1]
+        q = Queue(target)
+        try:
+            version = struct.pack("<IH", 8192, 6) + b"9P2000"
+            attach = struct.pack("<IIH", 0, 0xffffffff, 0) + struct.pack("<H", 0)
+            q.push([19], [64], _9p(P9.Tversion, 0xffff, version))
+            dev.handle_exc(q.info(0, 1))
+            q.push([19], [64], _9p(P9.Tattach, 1, attach))
+            dev.handle_exc(q.info(1, 1))
+            q.push([11], [128], _9p(P9.Tstat, 2, struct.pack("<I", 0)))
+            _, (_, resp) = q.push([17], [64], _9p(P9.Twalk, 3, struct.pack("<IIH", 0, 1, 0)))
+            dev.handle_exc(q.info(2, 2))
+            # The walk is answered, the stat is still blocked
+            assert [head for head, _ in target.used] == [0, 2, 6]
+            assert struct.unpack_from("<B", target.mem, resp[0] + 4)[0] == P9.Twalk + 1
+
+            kicks = dev.hv.kicks
+            gate.set()
+            deadline = time.time() + 5
+            while dev.hv.kicks == kicks and time.time() < deadline:
+                time.sleep(0.001)
+            assert dev.poll()
+            assert [head for head, _ in target.used] == [0, 2, 6, 4]
+            assert not dev.poll()
+        finally:
+            gate.set()
+            dev.close()
+
+
+SECTOR = 512
+
+
+def _image(path, sectors=64):
+    path.write_bytes(b"".join(bytes([i]) * SECTOR for i in range(sectors)))
+    return path
+
+
+def _blk(q, rtype, sector, data=None, size=SECTOR):
+    header = struct.pack("<IIQ", rtype, 0, sector)
+    if data is None:
+        return q.push([16], [size, 1], header)
+    return q.push([16, len(data)], [1], header + data)
+
+
+@pytest.fixture
+def fx_blk(tmp_path, fx_virtio_target):
+    """Return a writable 64 sector virtio-blk device and its queue"""
+    target = fx_virtio_target()
+    dev = _dev(VirtioBlk(_image(tmp_path / "disk.img")), target)
+    yield dev, target, Queue(target)
+    dev.close()
+
+
+class TestVirtioBlk:
+    """proxyclient.m1n1.hv.virtio.VirtioBlk tests"""
+
+    def test_config(self, fx_blk):
+        """Capacity and block size are in the config space"""
+        dev, target, q = fx_blk
+        capacity, _, seg_max, _, _, _, blk_size = struct.unpack("<QIIHBBI", dev.config_data)
+        assert (capacity, blk_size) == (64, SECTOR)
+        assert not dev.feats & VirtioBlk.F_RO
+
+    def test_read(self, fx_blk):
+        """Reads return the sectors and an OK status"""
+        dev, target, q = fx_blk
+        chains = [_blk(q, 0, 3, size=2 * SECTOR), _blk(q, 0, 5)]
+        dev.handle_exc(q.info(0, 2))
+        (_, (_, data, status)), (_, (_, data2, status2)) = chains
+        assert bytes(target.mem[data[0]:data[0] + 2 * SECTOR]) == bytes([3]) * SECTOR + bytes([4]) * SECTOR
+        assert bytes(target.mem[data2[0]:data2[0] + SECTOR]) == bytes([5]) * SECTOR
+        assert target.mem[status[0]] == target.mem[status2[0]] == 0
+        assert target.used == [(0, 2 * SECTOR + 1), (3, SECTOR + 1)]
+        assert dev.stats["in"][:2] == [2, 3 * SECTOR]
+
+    def test_coalesced(self, fx_blk):
+        """Responses to adjacent guest buffers go out in one write"""
+        dev, target, q = fx_blk
+        q.free = 0
+        head = q.alloc(16 * 4)
+        data = q.alloc(4 * (SECTOR + 1))
+        for i in range(4):
+            struct.pack_into("<IIQ", target.mem, head + 16 * i, 0, 0, i)
+            q.desc(3 * i, head + 16 * i, 16, NEXT, 3 * i + 1)
+            q.desc(3 * i + 1, data + i * (SECTOR + 1), SECTOR, NEXT | WRITE, 3 * i + 2)
+            q.desc(3 * i + 2, data + i * (SECTOR + 1) + SECTOR, 1, WRITE)
+            struct.pack_into("<H", target.mem, AVAIL + 4 + 2 * i, 3 * i)
+        dev.handle_exc(q.info(0, 4))
+        assert ("writemem", 4 * (SECTOR + 1)) in target.trips
+        assert bytes(target.mem[data + 3 * (SECTOR + 1):data + 4 * (SECTOR + 1)]) == bytes([3]) * SECTOR + b"\0"
+
+    def test_write(self, fx_blk, tmp_path):
+        """Writes reach the image"""
+        dev, target, q = fx_blk
+        _blk(q, 1, 2, b"\xaa" * SECTOR)
+        _blk(q, 4, 0, b"")
+        dev.handle_exc(q.info(0, 2))
+        assert (tmp_path / "disk.img").read_bytes()[2 * SECTOR:3 * SECTOR] == b"\xaa" * SECTOR
+        assert [length for _, length in target.used] == [1, 1]
+
+    def test_errors(self, fx_blk):
+        """Out of range and unknown requests fail"""
+        dev, target, q = fx_blk
+        _, (_, _, status) = _blk(q, 0, 64)
+        _, (_, status2) = q.push([16], [1], struct.pack("<IIQ", 99, 0, 0))
+        dev.handle_exc(q.info(0, 2))
+        assert (target.mem[status[0]], target.mem[status2[0]]) == (1, 2)
+        _, (_, id_buf, _) = _blk(q, 8, 0, size=20)
+        dev.handle_exc(q.info(2, 1))
+        assert bytes(target.mem[id_buf[0]:id_buf[0] + 20]) == b"m1n1".ljust(20, b"\0")
+
+    def test_overlay(self, tmp_path, fx_virtio_target):
+        """Overlay writes leave the image alone and persist across opens"""
+        image = _image(tmp_path / "base.img")
+        overlay = tmp_path / "cow.img"
+        orig = image.read_bytes()
+        for run in range(2):
+            target = fx_virtio_target()
+            dev = _dev(VirtioBlk(image, overlay=overlay), target)
+            q = Queue(target)
+            if run == 0:
+                _blk(q, 1, 9, b"\x55" * 100)
+                dev.handle_exc(q.info(0, 1))
+            _, (_, data, _) = _blk(q, 0, 7, size=4 * SECTOR)
+            dev.handle_exc(q.info(q.idx - 1, 1))
+            dev.close()
+            expect = bytes([7]) * SECTOR + bytes([8]) * SECTOR + b"\x55" * 100 + bytes([9]) * 412 + bytes([10]) * SECTOR
+            assert bytes(target.mem[data[0]:data[0] + 4 * SECTOR]) == expect
+        assert image.read_bytes() == orig
+        assert not dev.feats & VirtioBlk.F_RO
+
+    def test_readonly(self, tmp_path, fx_virtio_target):
+        """Read-only images refuse writes"""
+        target = fx_virtio_target()
+        dev = _dev(VirtioBlk(_image(tmp_path / "disk.img"), readonly=True), target)
+        q = Queue(target)
+        _, (_, _, status) = _blk(q, 1, 0, b"\x11" * SECTOR)
+        dev.handle_exc(q.info(0, 1))
+        assert dev.feats & VirtioBlk.F_RO
+        assert target.mem[status[0]] == 1
+        dev.close()
+
+
+STANDIN = r"""
+import os, sys
+fin, fout = sys.stdin.fileno(), sys.stdout.fileno()
+while True:
+    hdr = os.read(fin, 4)
+    if not hdr:
+        break
+    size = int.from_bytes(hdr, "little")
+    req = b""
+    while len(req) < size - 4:
+        req += os.read(fin, size - 4 - len(req))
+    count = int.from_bytes(req[-4:], "little")
+    resp = b"\x75" + req[1:3] + count.to_bytes(4, "little") + bytes(count)
+    os.write(fout, (len(resp) + 4).to_bytes(4, "little") + resp)
+"""
+
+
+def _legacy(dev, target, q, heads):
+    """The one-request-per-exit flow this module replaced"""
+    for head in heads:
+        # Each request was its own exception exit and return
+        target.trips.append(("exit", 0))
+        idx, req = head, b""
+        while True:
+            addr, size, flags, nxt = struct.unpack("<QIHH", target.readmem(DESC + 16 * idx, 16))
+            if flags & WRITE:
+                break
+            req += target.readmem(addr, size)
+            if not flags & NEXT:
+                break
+            idx = nxt
+        resp = dev.call(req)
+        length = len(resp)
+        while resp:
+            target.writemem(addr, resp[:size])
+            resp = resp[size:]
+            if not flags & NEXT:
+                break
+            addr, size, flags, nxt = struct.unpack("<QIHH", target.readmem(DESC + 16 * nxt, 16))
+        target.virtio_put_buffer(0, 0, head, length)
+
+
+def bench(target_cls, rounds=200, batch=5, size=8192, latency=100e-6, bandwidth=8e6):
+    """Model 9P read throughput against a u9fs stand-in, per exit and batched"""
+    target = _virtio_target(target_cls)()
+    dev = Virtio9PTransport.__new__(Virtio9PTransport)
+    VirtioDev.__init__(dev)
+    _dev(dev, target)
+    p_stdin, dev.fin = os.pipe()
+    dev.fout, p_stdout = os.pipe()
+    proc = subprocess.Popen([sys.executable, "-c", STANDIN], stdin=p_stdin, stdout=p_stdout)
+    os.close(p_stdin)
+    os.close(p_stdout)
+    tread = struct.pack("<IBHIQI", 23, 116, 1, 0, 0, size)
+
+    def run(label, handler):
+        target.trips.clear()
+        start = time.perf_counter()
+        for _ in range(rounds):
+            q = Queue(target)
+            heads = [q.push([len(tread)], [11, size], tread)[0] for _ in range(batch)]
+            handler(q, heads)
+        host = time.perf_counter() - start
+        link = sum(latency + n / bandwidth for _, n in target.trips)
+        total = rounds * batch * size
+        print(f"{label:>8}: {len(target.trips):6d} round trips, "
+              f"{total / (link + host) / 1e6:6.2f} MB/s ({link:6.3f}s link, {host:6.3f}s host)")
+
+    run("per-exit", lambda q, heads: _legacy(dev, target, q, heads))
+
+    def batched(q, heads):
+        target.trips.append(("exit", 0))
+        dev.handle_exc(q.info(0, len(heads)))
+
+    run("batched", batched)
+    os.close(dev.fin)
+    proc.wait()
+
+
+def bench_blk(target_cls, rounds=200, batch=5, size=0x10000, latency=100e-6, bandwidth=8e6):
+    """Model sequential virtio-blk read throughput and print the latency stats"""
+    path = pathlib.Path("/tmp/m1n1-virtio-blk-bench.img")
+    path.write_bytes(bytes(rounds * batch * size))
+    target = _virtio_target(target_cls)()
+    target.mem = bytearray(0x400_0000)
+    dev = _dev(VirtioBlk(path), target)
+    target.trips.clear()
+    start = time.perf_counter()
+    sector = 0
+    for _ in range(rounds):
+        q = Queue(target)
+        for _ in range(batch):
+            _blk(q, 0, sector, size=size)
+            sector += size // SECTOR
+        dev.handle_exc(q.info(0, batch))
+    host = time.perf_counter() - start
+    link = sum(latency + n / bandwidth for _, n in target.trips)
+    print(f"{'blk':>8}: {len(target.trips):6d} round trips, "
+          f"{rounds * batch * size / (link + host) / 1e6:6.2f} MB/s ({link:6.3f}s link, {host:6.3f}s host)")
+    print(dev.format_stats())
+    dev.close()
+    path.unlink()
+
+
+if __name__ == "__main__":
+    from conftest import SimTarget
+    bench(SimTarget)
+    bench_blk(SimTarget)
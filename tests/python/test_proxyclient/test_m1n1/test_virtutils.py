@@ -0,0 +1,193 @@
+# SPDX-License-Identifier: MIT
+"""Tests for proxyclient/m1n1/hv/virtutils.py"""
+
+import pathlib
+import random
+import struct
+import sys
+import time
+
+import pytest
+from construct import Container
+
+from proxyclient.m1n1.adt import ADTNodeStruct, load_adt
+from proxyclient.m1n1.hv.virtutils import (ResourceIndex, alloc_aic_irq, alloc_mmio_base,
+                                            usable_aic_irq_range, usable_mmio_range)
+from proxyclient.m1n1.utils import align_up
+
+AIC_PHANDLE = 0x2a
+ARM_IO = 0x2_0000_0000
+
+
+def _prop(name, value):
+    return {"name": name, "size": len(value), "value": value}
+
+
+def _node(name, props=(), children=()):
+    properties = [_prop("name", name.encode("ascii") + b"\0"), *props]
+    return {
+        "property_count": len(properties),
+        "child_count": len(children),
+        "properties": properties,
+        "children": list(children),
+    }
+
+
+def _u32(*values):
+    return struct.pack(f"<{len(values)}I", *values)
+
+
+def _device(name, addr, size=0x4000, irqs=()):
+    props = [_prop("reg", struct.pack("<QQ", addr, size))]
+    if irqs:
+        props += [_prop("interrupt-parent", _u32(AIC_PHANDLE)), _prop("interrupts", _u32(*irqs))]
+    return _node(name, props)
+
+
+def _adt_blob(count=40, seed=0):
+    """Build an ADT with count devices spread over arm-io, some of them with IRQs"""
+    rng = random.Random(seed)
+    cells = [_prop("#address-cells", _u32(2)), _prop("#size-cells", _u32(2))]
+    devices = [_node("aic", [
+        _prop("reg", struct.pack("<QQ", 0x0, 0x8000)),
+        _prop("compatible", b"aic,1\0"),
+        _prop("AAPL,phandle", _u32(AIC_PHANDLE)),
+    ]), _node("pmgr", [
+        _prop("reg", struct.pack("<QQ", 0xff0_0000, 0x4000)),
+        _prop("devices", bytes(3) + b"\x01" + bytes(0x2c) + bytes(3) + b"\x02" + bytes(0x2c)),
+    ])]
+    addr = 0x8000
+    irq = 0
+    for i in range(count):
+        addr += rng.choice((0, 0, 0x1000, 0x4000, 0x10000))
+        size = rng.choice((0x1000, 0x4000, 0xc000))
+        irqs = ()
+        if rng.random() < 0.7:
+            irq += rng.choice((1, 1, 2, 5))
+            irqs = (irq,)
+        devices.append(_device(f"dev{i}", addr, size, irqs))
+        addr += size
+    arm_io = _node("arm-io", [*cells, _prop("ranges", struct.pack("<QQQ", 0, ARM_IO, 0x1000_0000))],
+                   devices)
+    return ADTNodeStruct.build(_node("device-tree", cells, [arm_io]))
+
+
+def _reference(adt, size, alignment=0x4000):
+    """Allocate by scanning the whole tree"""
+    aic = getattr(adt["/arm-io/aic"], "AAPL,phandle")
+    used = set()
+    busy = []
+    stack = [adt]
+    while stack:
+        node = stack.pop()
+        stack.extend(node)
+        if getattr(node, "interrupt_parent", None) == aic:
+            used.update(node.interrupts)
+        busy += [zone for zone, name in node._reg_entries()]
+    irq = next((no for no in usable_aic_irq_range(adt) if no not in used), None)
+
+    span = usable_mmio_range(adt)
+    busy = [range(max(zone.start, span.start), min(zone.stop, span.stop)) for zone in busy
+            if zone.start < span.stop and zone.stop > span.start]
+    pos = span.start
+    for zone in sorted(busy, key=lambda r: r.start) + [range(span.stop, span.stop)]:
+        base = align_up(pos, alignment)
+        if zone.start > base + size:
+            return base, irq
+        pos = max(pos, zone.stop)
+    return None, irq
+
+
+def _add(adt, name, base, irq, size=0x1000):
+    node = adt.create_node(f"/arm-io/{name}")
+    node.reg = [Container(addr=node.to_bus_addr(base), size=size)]
+    node.interrupt_parent = AIC_PHANDLE
+    node.interrupts = (irq,)
+    return node
+
+
+@pytest.fixture
+def fx_adt():
+    """Return a parsed ADT with a few dozen devices"""
+    return load_adt(_adt_blob())
+
+
+class TestResourceIndex:
+    """proxyclient.m1n1.hv.virtutils.ResourceIndex tests"""
+
+    @pytest.mark.parametrize("size,alignment", [(0x1000, 0x4000), (0x1000, 0x1000), (0x10000, 0x4000)])
+    def test_alloc(self, fx_adt, size, alignment):
+        """Allocations match a scan of the whole tree"""
+        index = ResourceIndex(fx_adt)
+        ref_base, ref_irq = _reference(fx_adt, size, alignment)
+        assert index.alloc_mmio_base(size, alignment) == ref_base
+        assert index.alloc_aic_irq() == ref_irq
+        assert alloc_mmio_base(fx_adt, size, alignment) == ref_base
+        assert alloc_aic_irq(fx_adt) == ref_irq
+        assert fx_adt._trackers == [index.changes]
+        index.close()
+        assert not fx_adt._trackers
+
+    def test_follows_changes(self, fx_adt):
+        """The index follows node and property changes"""
+        index = ResourceIndex(fx_adt)
+        for i in range(8):
+            base, irq = index.alloc_mmio_base(0x1000), index.alloc_aic_irq()
+            assert (base, irq) == _reference(fx_adt, 0x1000)
+            _add(fx_adt, f"virtio{i}", base, irq)
+
+        fx_adt["/arm-io/virtio3"].name = "renamed"
+        del fx_adt["/arm-io/virtio1"]
+        dev = fx_adt["/arm-io/dev5"]
+        dev.reg = [Container(addr=0x0800_0000, size=0x4000)]
+        fx_adt["/arm-io/dev7"].interrupts = (0x300,)
+        node = next(n for n in fx_adt["/arm-io"] if n.name.startswith("dev") and "interrupts" in n._properties)
+        node.interrupts[0] = 0x301
+        node.touch("interrupts")
+        assert (index.alloc_mmio_base(0x1000), index.alloc_aic_irq()) == _reference(fx_adt, 0x1000)
+
+        fresh = ResourceIndex(load_adt(fx_adt.build()))
+        assert index.mmio == fresh.mmio
+        assert index.irqs == fresh.irqs
+        assert 0x301 in index.irqs
+
+    def test_detached(self, fx_adt):
+        """Nodes changed after being removed from the tree are ignored"""
+        index = ResourceIndex(fx_adt)
+        node = _add(fx_adt, "virtio0", *_reference(fx_adt, 0x1000))
+        index.update()
+        del fx_adt["/arm-io/virtio0"]
+        node.interrupts = (1,)
+        assert index.alloc_aic_irq() == _reference(fx_adt, 0x1000)[1]
+        assert node not in index.nodes
+
+    def test_exhausted(self, fx_adt):
+        """Allocations fail when nothing is free"""
+        index = ResourceIndex(fx_adt)
+        assert index.alloc_mmio_base(0x1000_0000) is None
+        for irq in range(0x400):
+            if irq not in index.irq_count:
+                _add(fx_adt, f"irq{irq}", ARM_IO + 0x800_0000 + irq * 0x1000, irq)
+        assert index.alloc_aic_irq() is None
+
+
+def bench(path=None, count=1500, devices=16):
+    """Time allocating and adding devices with and without the index
+
+    path is a saved ADT blob to use instead of a synthetic one."""
+    blob = pathlib.Path(path).read_bytes() if path else _adt_blob(count)
+    for label in ("scan", "index"):
+        adt = load_adt(blob)
+        index = ResourceIndex(adt) if label == "index" else None
+        start = time.perf_counter()
+        for i in range(devices):
+            if index is None:
+                base, irq = _reference(adt, 0x1000)
+            else:
+                base, irq = index.alloc_mmio_base(0x1000), index.alloc_aic_irq()
+            _add(adt, f"virtio{i}", base, irq)
+        print(f"{label:>8}: {devices} devices in {time.perf_counter() - start:.3f}s")
+
+
+if __name__ == "__main__":
+    bench(*sys.argv[1:2])